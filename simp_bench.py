@@ -0,0 +1,1725 @@
+"""
+Benchmarks for the SIMP daemon and protocol. Run `python simp_bench.py --help` for the list.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from simp_protocol import (DEFAULT_MTU, decode_client_message, decode_json_message, encode_client_message,
+                           encode_json_message, is_json_message)
+from simp_client import CLIENT_CREDIT, EventLoop, HeadlessClient
+from simp_transport import TRANSPORTS, open_client_socket
+
+BENCH_IP = "127.0.0.1"
+REORDER_DELAY = 0.002                   # Extra delay of a datagram the impairment proxy reorders
+RETRANSMISSION_REPORT_INTERVAL = 0.05   # How often daemon processes publish their retransmission count
+PROXY_START_TIMEOUT = 5.0
+BENCH_ROOM = "bench"
+
+
+def percentile(samples, p):
+    """
+    Returns the p-th percentile (0-100) of a list of samples.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _report_retransmissions(daemon, retransmissions):
+    while True:
+        retransmissions.value = daemon.retransmit.retransmissions   # AsyncDaemon replaces its queue on start
+        time.sleep(RETRANSMISSION_REPORT_INTERVAL)
+
+
+def _run_daemon(mode, daemon_port, client_port, options, retransmissions=None):
+    sys.stdout = open(os.devnull, "w")
+    import simp_daemon
+    daemon_class = simp_daemon.AsyncDaemon if mode == "asyncio" else simp_daemon.Daemon
+    daemon = daemon_class(daemon_port, client_port, **options)
+    if retransmissions is not None:
+        threading.Thread(target=_report_retransmissions, args=(daemon, retransmissions), daemon=True).start()
+    daemon.run()
+
+
+def start_daemon(mode, daemon_port, client_port, retransmissions=None, **options):
+    """
+    Starts a daemon ("threaded" or "asyncio") in its own process, options go to its constructor.
+    If retransmissions (a shared multiprocessing.Value) is given, the daemon keeps its count of
+    retransmitted datagrams there.
+    """
+    process = multiprocessing.Process(target=_run_daemon,
+                                      args=(mode, daemon_port, client_port, options, retransmissions), daemon=True)
+    process.start()
+    return process
+
+
+def _run_sharded(daemon_port, client_port, workers, options):
+    sys.stdout = open(os.devnull, "w")
+    from simp_shard import ShardedDaemon
+    ShardedDaemon(daemon_port, client_port, workers, **options).run()
+
+
+def start_sharded_daemon(daemon_port, client_port, workers, **options):
+    """
+    Starts a ShardedDaemon in its own process. It isn't a daemonic process because it starts the
+    worker processes, terminate() stops it together with them.
+    """
+    process = multiprocessing.Process(target=_run_sharded, args=(daemon_port, client_port, workers, options))
+    process.start()
+    return process
+
+
+def serve_daemon(daemon):
+    """
+    Serves a daemon from threads of this process. Unlike Daemon.run() they don't keep the process
+    alive and print nothing.
+    """
+    from simp_daemon import AsyncDaemon
+    if isinstance(daemon, AsyncDaemon):
+        threading.Thread(target=asyncio.run, args=(daemon.serve(),), daemon=True).start()
+        return
+    daemon.retransmit.start()
+    for target in (daemon.handle_daemon_messages, daemon.handle_client_messages):
+        threading.Thread(target=target, daemon=True).start()
+    if daemon.multicast_socket is not None:
+        threading.Thread(target=daemon.handle_daemon_messages, args=(daemon.multicast_socket,), daemon=True).start()
+
+
+def process_cpu_seconds(pid):
+    """
+    User plus system CPU time used so far by another process (Linux only, None elsewhere).
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class _ProxySide(asyncio.DatagramProtocol):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def datagram_received(self, data, addr):
+        self.handler(data, addr)
+
+
+class ImpairmentProxy:
+    """
+    UDP proxy that sits in front of a daemon and impairs the link: datagrams are dropped with
+    probability loss and delayed by delay +- jitter seconds (jitter also reorders them). With
+    probability reorder a datagram is held back another REORDER_DELAY so the next ones overtake
+    it, with probability duplicate it is sent twice.
+    Daemons talk to listen_port as if it was the daemon on target_port. If counters (a shared
+    array of two integers) is given, the datagrams passed in each direction are counted there.
+    """
+    def __init__(self, listen_port, target_port, loss=0.0, delay=0.0, jitter=0.0, seed=None, counters=None,
+                 reorder=0.0, duplicate=0.0, ready=None):
+        self.listen_port = listen_port
+        self.target_addr = (BENCH_IP, target_port)
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.random = random.Random(seed)
+        self.counters = counters
+        self.ready = ready                      # Event set once the proxy listens
+        self.peer_addr = None
+        self.front = None                       # Socket the other daemon sends to
+        self.back = None                        # Socket that talks to the target daemon
+        self.loop = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.back, _ = await self.loop.create_datagram_endpoint(
+            lambda: _ProxySide(self.from_back), local_addr=(BENCH_IP, 0))
+        self.front, _ = await self.loop.create_datagram_endpoint(
+            lambda: _ProxySide(self.from_front), local_addr=(BENCH_IP, self.listen_port))
+        if self.ready is not None:
+            self.ready.set()
+        await asyncio.Future()
+
+    def from_front(self, data, addr):
+        self.peer_addr = addr
+        if self.counters is not None:
+            self.counters[0] += 1
+        self.impair(self.back, data, self.target_addr)
+
+    def from_back(self, data, addr):
+        if self.peer_addr is not None:
+            if self.counters is not None:
+                self.counters[1] += 1
+            self.impair(self.front, data, self.peer_addr)
+
+    def impair(self, transport, data, addr):
+        if self.random.random() < self.loss:
+            return
+        # Only draw for the impairments that are on, so the loss pattern of a seed stays the same
+        copies = 2 if self.duplicate and self.random.random() < self.duplicate else 1
+        for _ in range(copies):
+            delay = self.delay + self.random.uniform(-self.jitter, self.jitter)
+            if self.reorder and self.random.random() < self.reorder:
+                delay += REORDER_DELAY
+            if delay > 0:
+                self.loop.call_later(delay, transport.sendto, data, addr)
+            else:
+                transport.sendto(data, addr)
+
+
+def start_proxy(listen_port, target_port, **impairments):
+    """
+    Starts an ImpairmentProxy in its own process and waits until it listens.
+    """
+    ready = multiprocessing.Event()
+    proxy = ImpairmentProxy(listen_port, target_port, ready=ready, **impairments)
+    process = multiprocessing.Process(target=proxy.run, daemon=True)
+    process.start()
+    ready.wait(PROXY_START_TIMEOUT)
+    return process
+
+
+class BenchClient:
+    """
+    Minimal client that speaks the client protocol (JSON, or binary with binary=True), without any
+    user interaction. With batch=True it asks the daemon for batches and unpacks them, datagrams
+    counts what arrived. With credit it does flow control, the caller gives the credit back.
+    """
+    def __init__(self, daemon_port, username, timeout=5.0, batch=False, binary=False, transport="udp", credit=0):
+        self.socket, self.daemon_addr = open_client_socket(transport, BENCH_IP, daemon_port)
+        self.username = username
+        self.batch = batch
+        self.binary = binary
+        self.credit = credit
+        self.buffer = bytearray(65535)
+        self.backlog = []                       # Unpacked messages of a received batch
+        self.datagrams = 0
+        self.socket.settimeout(timeout)
+
+    def send(self, msg):
+        data = encode_client_message(msg) if self.binary else encode_json_message(msg)
+        self.socket.sendto(data, self.daemon_addr)
+
+    def recv(self):
+        if self.backlog:
+            return self.backlog.pop(0)
+        size, _ = self.socket.recvfrom_into(self.buffer)
+        self.datagrams += 1
+        data = memoryview(self.buffer)[:size]
+        msg = decode_json_message(data) if is_json_message(data) else decode_client_message(data)
+        if msg['type'] == 'batch':
+            self.backlog = msg['messages']
+            return self.backlog.pop(0)
+        return msg
+
+    def expect(self, msg_type):
+        while True:
+            msg = self.recv()
+            if msg['type'] == msg_type:
+                return msg
+
+    def connect(self, retries=50):
+        for _ in range(retries):               # The daemon process may still be starting
+            try:
+                msg = {'type': 'connect', 'username': self.username, 'batch': self.batch}
+                if self.credit:
+                    msg['credit'] = self.credit
+                self.send(msg)
+                return self.expect('connected')
+            except socket.timeout:
+                continue
+            except OSError:                     # Its AF_UNIX socket doesn't exist yet
+                time.sleep(0.1)
+        raise RuntimeError(f"daemon at {self.daemon_addr} did not answer")
+
+    def close(self):
+        self.socket.close()
+
+
+def open_chat(initiator, responder, responder_daemon_port):
+    """
+    Runs the three-way handshake between two connected clients and returns its duration.
+    """
+    start = time.perf_counter()
+    initiator.send({'type': 'start_chat', 'target_port': str(responder_daemon_port)})
+    responder.expect('chat_request')
+    responder.send({'type': 'chat_response', 'accept': True})
+    initiator.expect('chat_started')
+    return time.perf_counter() - start
+
+
+def bench_daemon_mode(mode, messages, base_port):
+    """
+    Ping-pong chat between two daemons of the given mode. Every chat message costs five datagrams:
+    client->daemon, daemon->daemon, the ACK, the forward to the peer client and message_ack.
+    """
+    processes = [start_daemon(mode, base_port, base_port + 1),
+                 start_daemon(mode, base_port + 2, base_port + 3)]
+    alice = BenchClient(base_port + 1, "alice")
+    bob = BenchClient(base_port + 3, "bob")
+    try:
+        alice.connect()
+        bob.connect()
+        handshake = open_chat(alice, bob, base_port + 2)
+
+        latencies = []
+        start = time.perf_counter()
+        for i in range(messages):
+            sender, receiver = (alice, bob) if i % 2 == 0 else (bob, alice)
+            sent_at = time.perf_counter()
+            sender.send({'type': 'chat_message', 'message': f"message {i}"})
+            receiver.expect('chat_message')
+            latencies.append(time.perf_counter() - sent_at)
+            sender.expect('message_ack')
+        elapsed = time.perf_counter() - start
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    return {
+        'mode': mode,
+        'messages': messages,
+        'handshake_ms': handshake * 1000,
+        'messages_per_sec': messages / elapsed,
+        'datagrams_per_sec': 5 * messages / elapsed,
+        'p50_latency_us': percentile(latencies, 50) * 1e6,
+        'p99_latency_us': percentile(latencies, 99) * 1e6,
+    }
+
+
+def cmd_daemon(args):
+    modes = ["threaded", "asyncio"] if args.mode == "both" else [args.mode]
+    results = []
+    for index, mode in enumerate(modes):
+        result = bench_daemon_mode(mode, args.messages, args.base_port + 10 * index)
+        results.append(result)
+        print(f"{mode:>9}: {result['messages_per_sec']:9.0f} msg/s  {result['datagrams_per_sec']:9.0f} datagrams/s  "
+              f"p50 {result['p50_latency_us']:7.0f} us  p99 {result['p99_latency_us']:7.0f} us")
+    return results
+
+
+def cmd_sessions(args):
+    """
+    Memory per idle session, lookup cost and eviction cost of the session table.
+    """
+    from simp_protocol import MAX_SESSION_ID
+    from simp_session import ESTABLISHED, LocalClient, Session, SessionTable
+
+    args.sessions = min(args.sessions, MAX_SESSION_ID)   # A table never holds more
+    client = LocalClient("local", (BENCH_IP, 1))
+    table = SessionTable(idle_timeout=60, max_sessions=args.sessions)
+    keys = [((BENCH_IP, 10000 + i % 50000), f"user{i}") for i in range(args.sessions)]   # Usernames made up front
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i, (addr, username) in enumerate(keys):
+        table.add(Session(addr, username, client, ESTABLISHED, True, float(i)))
+    traced = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    estimated = table.memory_usage() / len(table)
+
+    start = time.perf_counter()
+    for addr, username in keys:
+        table.get(addr, username)
+    lookup = (time.perf_counter() - start) / len(keys)
+
+    start = time.perf_counter()
+    evicted = table.evict_idle(float(args.sessions) + 60)
+    eviction = time.perf_counter() - start
+
+    result = {
+        'sessions': args.sessions,
+        'bytes_per_session': traced / args.sessions,
+        'estimated_bytes_per_session': estimated,
+        'lookup_ns': lookup * 1e9,
+        'evicted': len(evicted),
+        'eviction_ms': eviction * 1000,
+    }
+    print(f"{args.sessions} sessions: {result['bytes_per_session']:.0f} bytes each "
+          f"(memory_usage() says {estimated:.0f}), lookup {result['lookup_ns']:.0f} ns, "
+          f"evicted {len(evicted)} in {result['eviction_ms']:.1f} ms")
+    return [result]
+
+
+def drain_acks(sender):
+    """
+    Reads whatever the sender's daemon has sent without blocking, returns the number of message_acks.
+    """
+    acked = 0
+    sender.socket.setblocking(False)
+    try:
+        while True:
+            if sender.recv()['type'] == 'message_ack':
+                acked += 1
+    except BlockingIOError:
+        pass
+    sender.socket.settimeout(30)
+    return acked
+
+
+def stream_messages(sender, receiver, messages, max_in_flight):
+    """
+    Sends messages from sender to receiver as fast as the daemons take them and checks that they
+    arrive in order. At most max_in_flight messages are sent but not yet read by the receiver:
+    a message_ack only says the peer daemon took the message, so bounding by those would still
+    overflow the receiver's socket buffer.
+    """
+    sent = received = 0
+    while received < messages:
+        while sent < messages and sent - received < max_in_flight:
+            sender.send({'type': 'chat_message', 'message': f"message {sent}"})
+            sent += 1
+        msg = receiver.recv()
+        if msg['type'] == 'chat_message':
+            assert msg['message'] == f"message {received}", "out of order delivery"
+            received += 1
+        drain_acks(sender)  # Keeps the sender's socket buffer from filling up with them
+
+
+def bench_window(window, messages, loss, delay, base_port, max_in_flight=64):
+    """
+    One-way bulk transfer from alice to bob through an impairment proxy. In the turn-taking mode
+    (window 0) bob has to answer every message before alice may send the next one.
+    """
+    processes = [start_daemon("threaded", base_port, base_port + 1, window=window),
+                 start_daemon("threaded", base_port + 2, base_port + 3, window=window),
+                 start_proxy(base_port + 4, base_port + 2, loss=loss, delay=delay / 2, seed=base_port)]
+    alice = BenchClient(base_port + 1, "alice", timeout=30)
+    bob = BenchClient(base_port + 3, "bob", timeout=30)
+    try:
+        alice.connect()
+        bob.connect()
+        open_chat(alice, bob, base_port + 4)
+
+        start = time.perf_counter()
+        if window > 1:
+            stream_messages(alice, bob, messages, max_in_flight)
+        else:
+            for i in range(messages):
+                alice.send({'type': 'chat_message', 'message': f"message {i}"})
+                bob.expect('chat_message')
+                bob.send({'type': 'chat_message', 'message': "ok"})
+                alice.expect('chat_message')
+        elapsed = time.perf_counter() - start
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+    return {'window': window, 'messages': messages, 'loss': loss, 'rtt_ms': delay * 1000,
+            'messages_per_sec': messages / elapsed}
+
+
+def cmd_window(args):
+    results = []
+    for index, window in enumerate(args.windows):
+        result = bench_window(window, args.messages, args.loss, args.rtt / 1000, args.base_port + 10 * index)
+        results.append(result)
+        mode = f"window {window}" if window > 1 else "turn-taking"
+        print(f"{mode:>12}: {result['messages_per_sec']:8.0f} msg/s  (loss {args.loss:.0%}, RTT {args.rtt:g} ms)")
+    return results
+
+
+def bench_batch(batch_delay, messages, burst, pause, delay, base_port):
+    """
+    Alice sends bursts of short messages (like someone typing fast or pasting lines) to bob over
+    a windowed session. Counts the datagrams between the daemons (at the proxy) and the datagrams
+    bob's client receives, and how long each message takes from alice's client to bob's client.
+    """
+    counters = multiprocessing.Array('q', 2)
+    options = {'window': 32, 'batch_delay': batch_delay}
+    processes = [start_daemon("threaded", base_port, base_port + 1, **options),
+                 start_daemon("threaded", base_port + 2, base_port + 3, **options),
+                 start_proxy(base_port + 4, base_port + 2, delay=delay / 2, counters=counters)]
+    alice = BenchClient(base_port + 1, "alice", timeout=30, batch=True)
+    bob = BenchClient(base_port + 3, "bob", timeout=30, batch=True)
+    try:
+        alice.connect()
+        bob.connect()
+        open_chat(alice, bob, base_port + 4)
+        time.sleep(0.1)
+        counters[0] = counters[1] = 0
+        bob.datagrams = 0
+
+        latencies = []
+        start = time.perf_counter()
+        for first in range(0, messages, burst):
+            count = min(burst, messages - first)
+            sent_at = []
+            for i in range(first, first + count):
+                sent_at.append(time.perf_counter())
+                alice.send({'type': 'chat_message', 'message': f"message {i}"})
+            for i in range(count):
+                msg = bob.expect('chat_message')
+                assert msg['message'] == f"message {first + i}", "out of order delivery"
+                latencies.append(time.perf_counter() - sent_at[i])
+            time.sleep(pause)
+        elapsed = time.perf_counter() - start
+        time.sleep(0.1)                         # Let the last ACKs pass the proxy
+        daemon_datagrams = counters[0] + counters[1]
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+    return {
+        'batch_delay_ms': batch_delay * 1000,
+        'messages': messages,
+        'burst': burst,
+        'rtt_ms': delay * 1000,
+        'daemon_datagrams_per_message': daemon_datagrams / messages,
+        'client_datagrams_per_message': bob.datagrams / messages,
+        'messages_per_sec': messages / elapsed,
+        'p50_latency_us': percentile(latencies, 50) * 1e6,
+        'p99_latency_us': percentile(latencies, 99) * 1e6,
+    }
+
+
+def cmd_batch(args):
+    results = []
+    for index, batch_delay in enumerate(args.delays):
+        result = bench_batch(batch_delay / 1000, args.messages, args.burst, args.pause / 1000, args.rtt / 1000,
+                             args.base_port + 10 * index)
+        results.append(result)
+        print(f"batch delay {batch_delay:>4g} ms: {result['daemon_datagrams_per_message']:5.2f} daemon datagrams/msg  "
+              f"{result['client_datagrams_per_message']:5.2f} client datagrams/msg  "
+              f"p50 {result['p50_latency_us']:7.0f} us  p99 {result['p99_latency_us']:7.0f} us")
+    return results
+
+
+def bench_encoding(binary, messages, base_port):
+    """
+    Ping-pong chat like bench_daemon_mode, with both clients talking JSON or the binary format to
+    their daemons. CPU per message counts both daemons and the benchmark process (the clients).
+    """
+    processes = [start_daemon("threaded", base_port, base_port + 1),
+                 start_daemon("threaded", base_port + 2, base_port + 3)]
+    alice = BenchClient(base_port + 1, "alice", binary=binary)
+    bob = BenchClient(base_port + 3, "bob", binary=binary)
+    try:
+        alice.connect()
+        bob.connect()
+        open_chat(alice, bob, base_port + 2)
+
+        cpu_before = [process_cpu_seconds(process.pid) for process in processes]
+        own_cpu_before = time.process_time()
+        latencies = []
+        start = time.perf_counter()
+        for i in range(messages):
+            sender, receiver = (alice, bob) if i % 2 == 0 else (bob, alice)
+            sent_at = time.perf_counter()
+            sender.send({'type': 'chat_message', 'message': f"message {i}"})
+            receiver.expect('chat_message')
+            latencies.append(time.perf_counter() - sent_at)
+            sender.expect('message_ack')
+        elapsed = time.perf_counter() - start
+        own_cpu = time.process_time() - own_cpu_before
+        cpu_after = [process_cpu_seconds(process.pid) for process in processes]
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    daemon_cpu = None
+    if None not in cpu_before + cpu_after:
+        daemon_cpu = sum(after - before for before, after in zip(cpu_before, cpu_after))
+    return {
+        'encoding': "binary" if binary else "json",
+        'messages': messages,
+        'messages_per_sec': messages / elapsed,
+        'p50_latency_us': percentile(latencies, 50) * 1e6,
+        'p99_latency_us': percentile(latencies, 99) * 1e6,
+        'daemon_cpu_us_per_message': daemon_cpu / messages * 1e6 if daemon_cpu is not None else None,
+        'client_cpu_us_per_message': own_cpu / messages * 1e6,
+    }
+
+
+def cmd_encoding(args):
+    """
+    JSON vs binary client messages: encode+decode ops/sec of a chat message, then a ping-pong chat.
+    """
+    msg = {'type': 'chat_message', 'from': "alice", 'message': "x" * args.payload}
+    json_ops = ops_per_sec(lambda: json.loads(json.dumps(msg).encode()), args.seconds)
+    binary_ops = ops_per_sec(lambda: decode_client_message(encode_client_message(msg)), args.seconds)
+    print(f"encode+decode chat_message: json {json_ops:9.0f} ops/s  binary {binary_ops:9.0f} ops/s  "
+          f"({binary_ops / json_ops:.1f}x)")
+    results = [{'case': "encode+decode chat_message", 'json_ops_per_sec': json_ops, 'binary_ops_per_sec': binary_ops}]
+
+    for index, binary in enumerate([False, True]):
+        result = bench_encoding(binary, args.messages, args.base_port + 10 * index)
+        results.append(result)
+        daemon_cpu = result['daemon_cpu_us_per_message']
+        print(f"{result['encoding']:>6}: {result['messages_per_sec']:8.0f} msg/s  "
+              f"p50 {result['p50_latency_us']:6.0f} us  p99 {result['p99_latency_us']:6.0f} us  "
+              f"CPU/msg daemons {daemon_cpu if daemon_cpu is not None else float('nan'):5.1f} us  "
+              f"clients {result['client_cpu_us_per_message']:5.1f} us")
+    return results
+
+
+def bench_transport(transport, mode, messages, base_port, max_in_flight=64):
+    """
+    Round trip between a client and its own daemon (connect -> connected, nothing else involved),
+    a ping-pong chat like bench_daemon_mode, and a one-way stream over a windowed chat, with both
+    clients on the given transport.
+    """
+    processes = [start_daemon(mode, base_port, base_port + 1, transport=transport, window=64),
+                 start_daemon(mode, base_port + 2, base_port + 3, transport=transport, window=64)]
+    alice = BenchClient(base_port + 1, "alice", binary=True, transport=transport)
+    bob = BenchClient(base_port + 3, "bob", binary=True, transport=transport)
+    try:
+        alice.connect()
+        bob.connect()
+        round_trips = []
+        for _ in range(messages):
+            sent_at = time.perf_counter()
+            alice.send({'type': 'connect', 'username': "alice"})
+            alice.expect('connected')
+            round_trips.append(time.perf_counter() - sent_at)
+
+        open_chat(alice, bob, base_port + 2)
+        start = time.perf_counter()
+        for i in range(messages):
+            sender, receiver = (alice, bob) if i % 2 == 0 else (bob, alice)
+            sender.send({'type': 'chat_message', 'message': f"message {i}"})
+            receiver.expect('chat_message')
+            sender.expect('message_ack')
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        stream_messages(alice, bob, messages, max_in_flight)
+        stream_elapsed = time.perf_counter() - start
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+    return {
+        'transport': transport,
+        'mode': mode,
+        'messages': messages,
+        'local_p50_round_trip_us': percentile(round_trips, 50) * 1e6,
+        'local_p99_round_trip_us': percentile(round_trips, 99) * 1e6,
+        'chat_messages_per_sec': messages / elapsed,
+        'stream_messages_per_sec': messages / stream_elapsed,
+    }
+
+
+def cmd_transport(args):
+    results = []
+    for index, transport in enumerate(args.transports):
+        result = bench_transport(transport, args.mode, args.messages, args.base_port + 10 * index)
+        results.append(result)
+        print(f"{transport:>5}: client<->daemon round trip p50 {result['local_p50_round_trip_us']:6.0f} us  "
+              f"p99 {result['local_p99_round_trip_us']:6.0f} us  ping-pong {result['chat_messages_per_sec']:6.0f} msg/s  "
+              f"stream {result['stream_messages_per_sec']:6.0f} msg/s")
+    return results
+
+
+def bench_fragment(mtu, size, chunk, loss, delay, base_port, max_unacked=8):
+    """
+    Streams size bytes of random data from alice to bob over a windowed chat through a lossy
+    proxy, checks that they arrive intact, then sends chat messages too big for one datagram back.
+    The daemons fragment everything to fit the MTU and reassemble it.
+    """
+    counters = multiprocessing.Array('q', 2)
+    options = {'window': 64, 'mtu': mtu}
+    processes = [start_daemon("threaded", base_port, base_port + 1, **options),
+                 start_daemon("threaded", base_port + 2, base_port + 3, **options),
+                 start_proxy(base_port + 4, base_port + 2, loss=loss, delay=delay / 2, seed=base_port,
+                             counters=counters)]
+    alice = BenchClient(base_port + 1, "alice", timeout=30, binary=True)
+    bob = BenchClient(base_port + 3, "bob", timeout=30, binary=True)
+    rng = random.Random(base_port)
+    sent_digest = hashlib.sha256()
+    received_digest = hashlib.sha256()
+    try:
+        alice.connect()
+        bob.connect()
+        open_chat(alice, bob, base_port + 4)
+        counters[0] = counters[1] = 0
+
+        start = time.perf_counter()
+        sent = received = chunks = acked = 0
+        while received < size:
+            while sent < size and chunks - acked < max_unacked:
+                data = rng.randbytes(min(chunk, size - sent))
+                sent_digest.update(data)
+                sent += len(data)
+                chunks += 1
+                alice.send({'type': 'stream_chunk', 'data': data, 'last': sent == size})
+            if received < sent:
+                msg = bob.recv()
+                if msg['type'] == 'stream_chunk':
+                    received_digest.update(msg['data'])
+                    received += len(msg['data'])
+            elif alice.recv()['type'] == 'message_ack':
+                acked += 1
+            acked += drain_acks(alice)
+        elapsed = time.perf_counter() - start
+        assert sent_digest.digest() == received_digest.digest(), "stream corrupted"
+        datagrams = counters[0] + counters[1]
+
+        large = "x" * 30000
+        start = time.perf_counter()
+        for _ in range(10):
+            bob.send({'type': 'chat_message', 'message': large})
+            assert alice.expect('chat_message')['message'] == large, "message corrupted"
+        large_elapsed = time.perf_counter() - start
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+    return {
+        'mtu': mtu,
+        'bytes': size,
+        'loss': loss,
+        'rtt_ms': delay * 1000,
+        'megabytes_per_sec': size / elapsed / 1e6,
+        'daemon_datagrams': datagrams,
+        'large_message_ms': large_elapsed / 10 * 1000,
+    }
+
+
+def cmd_fragment(args):
+    results = []
+    for index, mtu in enumerate(args.mtus):
+        result = bench_fragment(mtu, args.megabytes << 20, args.chunk, args.loss, args.rtt / 1000,
+                                args.base_port + 10 * index)
+        results.append(result)
+        print(f"MTU {mtu:>5}: {result['megabytes_per_sec']:6.2f} MB/s  {result['daemon_datagrams']:6d} datagrams  "
+              f"30 kB message {result['large_message_ms']:6.1f} ms  (loss {args.loss:.0%}, RTT {args.rtt:g} ms)")
+    return results
+
+
+class LoadClient(HeadlessClient):
+    """
+    Headless client of the load benchmark. Every chat message carries the time it was sent
+    (" @<perf_counter_ns>"), so the receiver can measure the delivery latency. Responders echo
+    every message they get. In the turn-taking mode a client waits for the answer after every
+    message instead of running into 'Not your turn'.
+    """
+    def __init__(self, harness, daemon_port, username, target_port=None, target_username=None, **options):
+        super().__init__(daemon_port, username, target_port, target_username, wait_end=True, **options)
+        self.harness = harness
+        self.initiator = target_port is not None
+
+    def send_line(self, line, now):
+        text = line.rpartition(" @")[0] or line     # Sent again after 'Not your turn': stamp it anew
+        super().send_line(f"{text} @{time.perf_counter_ns()}", now)
+        if self.harness.turns:
+            self.blocked = True
+
+    def handle_message(self, msg):
+        msg_type = msg['type']
+        if msg_type == 'message_ack' and self.in_flight and not self.stream_unacked:
+            self.harness.acked += 1
+        super().handle_message(msg)
+        if msg_type == 'chat_started':
+            self.harness.chat_started(self)
+        elif msg_type == 'message_ack':
+            pass
+        elif msg_type == 'chat_message':
+            text, _, sent_at = msg['message'].rpartition(" @")
+            self.harness.latencies.append(time.perf_counter_ns() - int(sent_at))
+            self.harness.received += 1
+            if not self.initiator:
+                self.lines.append(text)
+        elif msg_type == 'chat_ended':
+            self.harness.ended += 1
+        else:
+            return
+        self.harness.check_done()
+
+
+class LoadHarness:
+    """
+    Runs the clients of the load benchmark on one EventLoop: first all chats are opened, then the
+    initiators send their messages and the responders echo them, until every message has arrived
+    and been confirmed (or the timeout is over).
+    """
+    def __init__(self, pairs, messages, window):
+        self.loop = EventLoop()
+        self.pairs = pairs
+        self.messages = messages
+        self.turns = window < 2                     # Turn-taking mode
+        self.initiators = []
+        self.responders = []
+        self.expected = 2 * pairs * messages        # Every message and its echo
+        self.handshake_times = []
+        self.latencies = []                         # Delivery latencies in ns
+        self.received = 0
+        self.acked = 0
+        self.ended = 0
+        self.started_at = None
+        self.established_at = None
+        self.finished_at = None
+        self.cpu_at_established = None
+        self.daemon_pids = []                       # Daemon processes whose CPU time is measured as well
+        self.daemon_cpu_at_established = None
+        self.timer = None
+
+    def add_pair(self, index, initiator_port, responder_port, responder_daemon_port, rate=0.0, **options):
+        responder = LoadClient(self, responder_port, f"r{index}", **options)   # Echoes right away
+        initiator = LoadClient(self, initiator_port, f"i{index}", str(responder_daemon_port), responder.username,
+                               rate=rate, **options)
+        self.responders.append(responder)
+        self.initiators.append(initiator)
+
+    def chat_started(self, client):
+        self.handshake_times.append(time.perf_counter() - self.started_at)
+        if len(self.handshake_times) < self.pairs:
+            return
+        self.established_at = time.perf_counter()
+        self.cpu_at_established = time.process_time()
+        self.daemon_cpu_at_established = [process_cpu_seconds(pid) for pid in self.daemon_pids]
+        for index, initiator in enumerate(self.initiators):
+            initiator.lines.extend(f"{index} {i}" for i in range(self.messages))
+            initiator.pump()
+
+    def check_done(self):
+        if self.finished_at is None and self.received >= self.expected and self.acked >= self.expected:
+            self.finish()
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        if self.timer is not None:
+            self.timer.cancel()
+        for client in self.initiators + self.responders:
+            if client.loop is not None:
+                client.send({
+                    'type': 'quit'
+                })
+                client.stop()
+
+    def run(self, timeout):
+        for client in self.responders + self.initiators:   # Responders first, they have to be known
+            client.start(self.loop)
+        self.started_at = time.perf_counter()
+        self.timer = self.loop.call_later(timeout, self.finish)
+        self.loop.run()
+
+
+def wait_for_daemon(client_port):
+    probe = BenchClient(client_port, "probe", timeout=0.2)
+    try:
+        probe.connect()
+    finally:
+        probe.close()
+
+
+def bench_load(daemons, pairs, messages, max_unacked, rate, window, mode, processes, binary, loss, reorder,
+               duplicate, delay, jitter, seed, timeout, base_port):
+    """
+    Starts daemons (in this process or as subprocesses) with an impairment proxy in front of each,
+    and opens pairs chats between headless clients, chat k from daemon k % daemons to the next
+    daemon in the ring (so every proxy has one daemon in front). Then every initiator sends
+    messages messages which its responder echoes. CPU per message counts the daemons and the
+    clients, not the proxies (they are the network).
+    """
+    from simp_daemon import AsyncDaemon, Daemon
+
+    options = {'window': window}
+    impairments = {'loss': loss, 'reorder': reorder, 'duplicate': duplicate, 'delay': delay / 2, 'jitter': jitter}
+    ports = [(base_port + 10 * i, base_port + 10 * i + 1, base_port + 10 * i + 2) for i in range(daemons)]
+    counters = [multiprocessing.Array('q', 2) for _ in range(daemons)]
+    children = [start_proxy(proxy_port, daemon_port, seed=seed + i, counters=counters[i], **impairments)
+                for i, (daemon_port, _, proxy_port) in enumerate(ports)]
+    retransmission_counts = []
+    instances = []
+    for daemon_port, client_port, _ in ports:
+        if processes:
+            count = multiprocessing.Value('q', 0)
+            retransmission_counts.append(count)
+            children.append(start_daemon(mode, daemon_port, client_port, count, **options))
+        else:
+            daemon_class = AsyncDaemon if mode == "asyncio" else Daemon
+            instances.append(daemon_class(daemon_port, client_port, **options))
+            serve_daemon(instances[-1])
+
+    harness = LoadHarness(pairs, messages, window)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")          # Daemons in this process print every retransmission
+    try:
+        for _, client_port, _ in ports:
+            wait_for_daemon(client_port)
+        for k in range(pairs):
+            _, initiator_port, _ = ports[k % daemons]
+            _, responder_port, proxy_port = ports[(k + 1) % daemons]
+            harness.add_pair(k, initiator_port, responder_port, proxy_port, rate=rate, max_unacked=max_unacked,
+                             binary=binary)
+        for counter in counters:
+            counter[0] = counter[1] = 0
+        harness.daemon_pids = [child.pid for child in children[daemons:]]
+        harness.run(timeout)
+        own_cpu = time.process_time() - harness.cpu_at_established if harness.established_at else None
+        cpu_after = [process_cpu_seconds(child.pid) for child in children[daemons:]]
+        time.sleep(2 * RETRANSMISSION_REPORT_INTERVAL)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        for client in harness.initiators + harness.responders:
+            client.socket.close()
+        for child in children:
+            child.terminate()
+            child.join()
+
+    if processes:
+        retransmissions = sum(count.value for count in retransmission_counts)
+    else:
+        retransmissions = sum(daemon.retransmit.retransmissions for daemon in instances)
+    daemon_cpu = None
+    cpu_before = harness.daemon_cpu_at_established or [None]
+    if processes and None not in cpu_before + cpu_after:
+        daemon_cpu = sum(after - before for before, after in zip(cpu_before, cpu_after))
+    delivered = min(harness.received, harness.expected)
+    elapsed = (harness.finished_at - harness.established_at) if harness.established_at else None
+    setup = harness.handshake_times[-1] if harness.handshake_times else None
+    latencies = [latency / 1000 for latency in harness.latencies]
+    cpu = own_cpu + (daemon_cpu or 0) if own_cpu is not None else None
+    return {
+        'daemons': daemons,
+        'pairs': pairs,
+        'messages': harness.expected,
+        'window': window,
+        'mode': mode,
+        'processes': processes,
+        'encoding': "binary" if binary else "json",
+        'unacked': max_unacked,
+        'rate': rate,
+        'loss': loss,
+        'reorder': reorder,
+        'duplicate': duplicate,
+        'rtt_ms': delay * 1000,
+        'jitter_ms': jitter * 1000,
+        'seed': seed,
+        'completed': harness.received >= harness.expected and harness.acked >= harness.expected,
+        'chats_opened': len(harness.handshake_times),
+        'handshakes_per_sec': len(harness.handshake_times) / setup if setup else None,
+        'p50_handshake_ms': percentile(harness.handshake_times, 50) * 1000,
+        'delivered': delivered,
+        'acked': harness.acked,
+        'messages_per_sec': delivered / elapsed if elapsed else None,
+        'p50_latency_us': percentile(latencies, 50),
+        'p99_latency_us': percentile(latencies, 99),
+        'p999_latency_us': percentile(latencies, 99.9),
+        'retransmissions': retransmissions,
+        'retransmissions_per_message': retransmissions / delivered if delivered else None,
+        'daemon_datagrams': sum(counter[0] + counter[1] for counter in counters),
+        'cpu_us_per_message': cpu / delivered * 1e6 if cpu is not None and delivered else None,
+        'daemon_cpu_us_per_message': daemon_cpu / delivered * 1e6 if daemon_cpu is not None and delivered else None,
+        'errors': sum(client.stats['errors'] for client in harness.initiators + harness.responders),
+    }
+
+
+def _format(value, format_spec):
+    return format(value, format_spec) if value is not None else "-"
+
+
+def cmd_load(args):
+    result = bench_load(args.daemons, args.pairs, args.messages, args.unacked, args.rate, args.window, args.mode,
+                        args.processes, args.binary, args.loss, args.reorder, args.duplicate, args.rtt / 1000,
+                        args.jitter / 1000, args.seed, args.timeout, args.base_port)
+    print(f"{result['daemons']} daemons, {result['pairs']} chats ({result['mode']}"
+          f"{', processes' if result['processes'] else ''}, window {result['window']}, {result['encoding']}): "
+          f"{'completed' if result['completed'] else 'INCOMPLETE'}")
+    print(f"  handshakes {_format(result['handshakes_per_sec'], '.0f')}/s  p50 {result['p50_handshake_ms']:.1f} ms")
+    print(f"  {result['delivered']}/{result['messages']} messages  {_format(result['messages_per_sec'], '.0f')} msg/s  "
+          f"latency p50 {result['p50_latency_us']:.0f} us  p99 {result['p99_latency_us']:.0f} us  "
+          f"p99.9 {result['p999_latency_us']:.0f} us")
+    print(f"  {result['retransmissions']} retransmissions  {result['daemon_datagrams']} datagrams between daemons  "
+          f"CPU {_format(result['cpu_us_per_message'], '.1f')} us/msg  (loss {args.loss:.0%}, reorder "
+          f"{args.reorder:.0%}, duplicate {args.duplicate:.0%}, RTT {args.rtt:g} ms)")
+    return [result]
+
+
+def bench_workers(workers, peers, pairs, messages, max_unacked, window, binary, timeout, base_port):
+    """
+    One hub daemon with workers worker processes (a plain daemon process for 1) and peers single
+    process daemons around it. Chat k goes from peer k % peers to the hub, so the hub carries all
+    the load while the kernel spreads the peers over its workers. The peer ports are 11 apart,
+    which puts them on different workers for any worker count that isn't a multiple of 11.
+    """
+    options = {'window': window}
+    hub_port, hub_client_port = base_port, base_port + 1
+    peer_ports = [(base_port + 11 * (i + 1), base_port + 11 * (i + 1) + 1) for i in range(peers)]
+    if workers > 1:
+        children = [start_sharded_daemon(hub_port, hub_client_port, workers, **options)]
+    else:
+        children = [start_daemon("threaded", hub_port, hub_client_port, **options)]
+    children += [start_daemon("threaded", daemon_port, client_port, **options)
+                 for daemon_port, client_port in peer_ports]
+
+    harness = LoadHarness(pairs, messages, window)
+    try:
+        for client_port in [hub_client_port] + [client_port for _, client_port in peer_ports]:
+            wait_for_daemon(client_port)
+        for k in range(pairs):
+            harness.add_pair(k, peer_ports[k % peers][1], hub_client_port, hub_port, max_unacked=max_unacked,
+                             binary=binary)
+        harness.run(timeout)
+    finally:
+        for client in harness.initiators + harness.responders:
+            client.socket.close()
+        for child in children:
+            child.terminate()
+            child.join()
+
+    delivered = min(harness.received, harness.expected)
+    elapsed = (harness.finished_at - harness.established_at) if harness.established_at else None
+    latencies = [latency / 1000 for latency in harness.latencies]
+    return {
+        'workers': workers,
+        'peers': peers,
+        'pairs': pairs,
+        'messages': harness.expected,
+        'window': window,
+        'encoding': "binary" if binary else "json",
+        'unacked': max_unacked,
+        'cpus': os.cpu_count(),
+        'completed': harness.received >= harness.expected and harness.acked >= harness.expected,
+        'delivered': delivered,
+        'messages_per_sec': delivered / elapsed if elapsed else None,
+        'p50_latency_us': percentile(latencies, 50),
+        'p99_latency_us': percentile(latencies, 99),
+        'errors': sum(client.stats['errors'] for client in harness.initiators + harness.responders),
+    }
+
+
+def cmd_workers(args):
+    results = []
+    for index, workers in enumerate(args.workers):
+        result = bench_workers(workers, args.peers, args.pairs, args.messages, args.unacked, args.window, args.binary,
+                               args.timeout, args.base_port + 200 * index)
+        baseline = results[0]['messages_per_sec'] if results else result['messages_per_sec']
+        result['speedup'] = result['messages_per_sec'] / baseline if baseline and result['messages_per_sec'] else None
+        results.append(result)
+        print(f"{workers:>3} workers: {result['delivered']}/{result['messages']} messages  "
+              f"{_format(result['messages_per_sec'], '.0f')} msg/s  ({_format(result['speedup'], '.2f')}x)  "
+              f"latency p50 {result['p50_latency_us']:.0f} us  p99 {result['p99_latency_us']:.0f} us"
+              f"{'' if result['completed'] else '  INCOMPLETE'}")
+    print(f"  {args.peers} peer daemons, {args.pairs} chats, window {args.window}, {os.cpu_count()} CPUs")
+    return results
+
+
+class RoomClient(HeadlessClient):
+    """
+    Headless client of the group benchmark, in the bench room hosted by the daemon on hub_port
+    (None for a client of the hub daemon itself). Messages carry the time they were sent like in
+    the load benchmark.
+    """
+    def __init__(self, harness, daemon_port, username, hub_port=None, **options):
+        super().__init__(daemon_port, username, hub_port, wait_end=True, room=BENCH_ROOM, **options)
+        self.harness = harness
+
+    def send_line(self, line, now):
+        super().send_line(f"{line} @{time.perf_counter_ns()}", now)
+
+    def handle_message(self, msg):
+        msg_type = msg['type']
+        if msg_type == 'message_ack' and self.in_flight:
+            self.harness.acked += 1
+        super().handle_message(msg)
+        if msg_type == 'room_joined':
+            self.harness.room_joined()
+        elif msg_type == 'chat_message':
+            text, _, sent_at = msg['message'].rpartition(" @")
+            self.harness.delivered(text, time.perf_counter_ns() - int(sent_at))
+        elif msg_type == 'message_ack':
+            pass
+        else:
+            return
+        self.harness.check_done()
+
+
+class GroupHarness:
+    """
+    Runs the clients of the group benchmark on one EventLoop: once all of them are in the room, the
+    first one sends its messages, until every other member got every message (or the timeout is over).
+    """
+    def __init__(self, messages):
+        self.loop = EventLoop()
+        self.messages = messages
+        self.clients = []
+        self.joined = 0
+        self.latencies = []                         # Delivery latencies in ns
+        self.completion = {}                        # Message -> latency of its last delivery in ns
+        self.received = 0
+        self.acked = 0
+        self.expected = 0
+        self.joined_at = None
+        self.finished_at = None
+        self.hub_pid = None
+        self.hub_cpu_at_joined = None
+        self.timer = None
+
+    def add_client(self, daemon_port, hub_port, **options):
+        self.clients.append(RoomClient(self, daemon_port, f"m{len(self.clients)}", hub_port, **options))
+
+    def room_joined(self):
+        self.joined += 1
+        if self.joined < len(self.clients):
+            return
+        self.expected = self.messages * (len(self.clients) - 1)
+        self.joined_at = time.perf_counter()
+        self.hub_cpu_at_joined = process_cpu_seconds(self.hub_pid)
+        sender = self.clients[0]
+        sender.lines.extend(str(i) for i in range(self.messages))
+        sender.pump()
+
+    def delivered(self, text, latency):
+        self.latencies.append(latency)
+        self.completion[text] = max(self.completion.get(text, 0), latency)
+        self.received += 1
+
+    def check_done(self):
+        if (self.finished_at is None and self.joined_at is not None and self.received >= self.expected
+                and self.acked >= self.messages):
+            self.finish()
+
+    def finish(self):
+        self.finished_at = time.perf_counter()
+        if self.timer is not None:
+            self.timer.cancel()
+        for client in self.clients:
+            if client.loop is not None:
+                client.send({
+                    'type': 'quit'
+                })
+                client.stop()
+
+    def run(self, timeout):
+        for client in self.clients:
+            client.start(self.loop)
+        self.timer = self.loop.call_later(timeout, self.finish)
+        self.loop.run()
+
+
+def bench_group(size, daemons, messages, max_unacked, rate, multicast, timeout, base_port):
+    """
+    One room with size members: a hub daemon process hosting it, and daemons member daemon processes
+    whose clients join it (the first member is on the hub). The first member sends messages messages
+    at rate per second, every other member gets each of them. Hub CPU per message is the cost of one
+    fan-out.
+    """
+    options = {'multicast': multicast}
+    hub_port, hub_client_port = base_port, base_port + 1
+    ports = [(base_port + 10 * (i + 1), base_port + 10 * (i + 1) + 1) for i in range(daemons)]
+    children = [start_daemon("threaded", daemon_port, client_port, **options)
+                for daemon_port, client_port in [(hub_port, hub_client_port)] + ports]
+
+    harness = GroupHarness(messages)
+    harness.hub_pid = children[0].pid
+    try:
+        for client_port in [hub_client_port] + [client_port for _, client_port in ports]:
+            wait_for_daemon(client_port)
+        harness.add_client(hub_client_port, None, max_unacked=max_unacked, rate=rate, binary=True)
+        for k in range(size - 1):
+            harness.add_client(ports[k % daemons][1], hub_port, binary=True)
+        harness.run(timeout)
+        hub_cpu = process_cpu_seconds(harness.hub_pid)
+    finally:
+        for client in harness.clients:
+            client.socket.close()
+        for child in children:
+            child.terminate()
+            child.join()
+
+    if None in (hub_cpu, harness.hub_cpu_at_joined):
+        hub_cpu = None
+    else:
+        hub_cpu -= harness.hub_cpu_at_joined
+    elapsed = (harness.finished_at - harness.joined_at) if harness.joined_at else None
+    latencies = [latency / 1000 for latency in harness.latencies]
+    completion = [latency / 1000 for latency in harness.completion.values()]
+    return {
+        'size': size,
+        'daemons': daemons,
+        'messages': messages,
+        'unacked': max_unacked,
+        'rate': rate,
+        'multicast': f"{multicast[0]}:{multicast[1]}" if multicast else None,
+        'completed': harness.joined_at is not None and harness.received >= harness.expected,
+        'delivered': harness.received,
+        'expected': harness.expected,
+        'deliveries_per_sec': harness.received / elapsed if elapsed else None,
+        'p50_latency_us': percentile(latencies, 50),
+        'p99_latency_us': percentile(latencies, 99),
+        'p50_fanout_us': percentile(completion, 50),
+        'p99_fanout_us': percentile(completion, 99),
+        'hub_cpu_us_per_message': hub_cpu / messages * 1e6 if hub_cpu is not None else None,
+        'errors': sum(client.stats['errors'] for client in harness.clients),
+    }
+
+
+def cmd_group(args):
+    from simp_group import parse_multicast_addr
+    results = []
+    modes = [None] + ([parse_multicast_addr(args.multicast)] if args.multicast else [])
+    for index, size in enumerate(args.sizes):
+        for multicast in modes:
+            base_port = args.base_port + 200 * (len(modes) * index + (multicast is not None))
+            result = bench_group(size, min(args.daemons, size - 1), args.messages, args.unacked, args.rate,
+                                 multicast, args.timeout, base_port)
+            results.append(result)
+            print(f"{size:>4} members ({result['daemons']} member daemons, "
+                  f"{'multicast' if multicast else 'unicast'}): {result['delivered']}/{result['expected']} "
+                  f"deliveries  latency p50 {result['p50_latency_us']:.0f} us  p99 {result['p99_latency_us']:.0f} us  "
+                  f"fan-out p50 {result['p50_fanout_us']:.0f} us  p99 {result['p99_fanout_us']:.0f} us  "
+                  f"hub CPU {_format(result['hub_cpu_us_per_message'], '.0f')} us/msg"
+                  f"{'' if result['completed'] else '  INCOMPLETE'}")
+    return results
+
+
+def bench_resume(resume, rounds, rtt, window, base_port):
+    """
+    Reconnect latency after a daemon restart. Alice's daemon is restarted every round and alice
+    starts the chat with bob again, her first message along. Cold: she ended the chat before, bob
+    has to accept a new one. Resumed: her daemon keeps its tickets in a file, so the chat is
+    resumed with the SYN and the message comes with it. A proxy in front of bob's daemon adds rtt.
+    """
+    from simp_resume import TICKET_SYNC_INTERVAL
+    ticket_dir = tempfile.mkdtemp(prefix="simp-tickets-")
+    ticket_file = os.path.join(ticket_dir, "alice.json") if resume else None
+    processes = [start_daemon("threaded", base_port + 2, base_port + 3, window=window),
+                 start_proxy(base_port + 4, base_port + 2, delay=rtt / 2)]
+    bob = BenchClient(base_port + 3, "bob")
+    setup = []
+    first_message = []
+    resumed = 0
+    try:
+        bob.connect()
+        for i in range(rounds + 1):             # Round 0 opens the chat the others reconnect to
+            daemon = start_daemon("threaded", base_port, base_port + 1, window=window, ticket_file=ticket_file)
+            alice = BenchClient(base_port + 1, "alice")
+            try:
+                alice.connect()
+                started = []                    # Alice's chat_started and when it came, bob may get his message first
+                waiter = threading.Thread(target=lambda: started.extend((alice.expect('chat_started'),
+                                                                         time.perf_counter())))
+                waiter.start()
+                start = time.perf_counter()
+                alice.send({'type': 'start_chat', 'target_port': base_port + 4, 'target_username': "bob",
+                            'message': f"round {i}"})
+                msg = bob.recv()
+                while msg['type'] != 'chat_message':
+                    if msg['type'] == 'chat_request':
+                        bob.send({'type': 'chat_response', 'accept': True})
+                    msg = bob.recv()
+                delivered_at = time.perf_counter()
+                waiter.join()
+                if i > 0:
+                    setup.append(started[1] - start)
+                    first_message.append(delivered_at - start)
+                    resumed += bool(started[0].get('resumed'))
+                alice.expect('message_ack')
+                if resume:
+                    time.sleep(2 * TICKET_SYNC_INTERVAL)    # The new ticket is in the file
+                else:
+                    alice.send({'type': 'quit'})
+                    bob.expect('chat_ended')
+            finally:
+                alice.close()
+                daemon.terminate()
+                daemon.join()
+    finally:
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(ticket_dir, ignore_errors=True)
+    return {
+        'resume': resume,
+        'rounds': rounds,
+        'rtt_ms': rtt * 1000,
+        'window': window,
+        'resumed': resumed,
+        'p50_setup_ms': percentile(setup, 50) * 1000,
+        'p99_setup_ms': percentile(setup, 99) * 1000,
+        'p50_first_message_ms': percentile(first_message, 50) * 1000,
+        'p99_first_message_ms': percentile(first_message, 99) * 1000,
+    }
+
+
+def cmd_resume(args):
+    results = []
+    for index, resume in enumerate((False, True)):
+        result = bench_resume(resume, args.rounds, args.rtt / 1000, args.window, args.base_port + 10 * index)
+        results.append(result)
+        print(f"{'resumed' if resume else 'cold':>8}: chat_started p50 {result['p50_setup_ms']:6.1f} ms  "
+              f"p99 {result['p99_setup_ms']:6.1f} ms  first message p50 {result['p50_first_message_ms']:6.1f} ms  "
+              f"p99 {result['p99_first_message_ms']:6.1f} ms  ({result['resumed']}/{args.rounds} resumed, "
+              f"RTT {args.rtt:g} ms)")
+    return results
+
+
+def peak_rss(pid):
+    """
+    Peak resident memory of a process in MB (VmHWM, Linux only), 0 if it can't be read.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def bench_flow(credit, messages, read_delay, window, base_port, max_unacked=256):
+    """
+    Alice floods bob, who takes read_delay per message. She sends as fast as her message_acks
+    allow (at most max_unacked ahead). Without credit bob's daemon acknowledges what it forwards
+    and his socket buffer overflows, with credit his daemon only takes what he has room for and
+    alice is slowed down instead. Counts the messages lost and the peak memory of bob's daemon.
+    """
+    processes = [start_daemon("threaded", base_port, base_port + 1, window=window),
+                 start_daemon("threaded", base_port + 2, base_port + 3, window=window)]
+    alice = BenchClient(base_port + 1, "alice", timeout=30)
+    bob = BenchClient(base_port + 3, "bob", batch=True, credit=credit)
+    received = []
+    try:
+        alice.connect()
+        bob.connect()
+        open_chat(alice, bob, base_port + 2)
+
+        def read():
+            handled = 0
+            bob.socket.settimeout(1.0)
+            try:
+                while len(received) < messages:
+                    msg = bob.recv()
+                    if msg['type'] != 'chat_message':
+                        continue
+                    received.append(msg['message'])
+                    time.sleep(read_delay)
+                    handled += 1
+                    if credit and handled >= credit // 4:
+                        bob.send({'type': 'credit', 'credit': handled})
+                        handled = 0
+            except socket.timeout:
+                pass                            # Nothing more is coming
+        reader = threading.Thread(target=read)
+        reader.start()
+        start = time.perf_counter()
+        sent = acked = 0
+        while acked < messages:
+            while sent < messages and sent - acked < max_unacked:
+                alice.send({'type': 'chat_message', 'message': f"message {sent} " + "x" * 100})
+                sent += 1
+            msg = alice.recv()
+            if msg['type'] == 'message_ack':
+                acked += msg.get('count', 1)
+            acked += drain_acks(alice)
+        reader.join()
+        seconds = time.perf_counter() - start
+        in_order = received == [f"message {i} " + "x" * 100 for i in range(len(received))]
+        memory = peak_rss(processes[1].pid)
+    finally:
+        alice.close()
+        bob.close()
+        for process in processes:
+            process.terminate()
+            process.join()
+    return {
+        'credit': credit,
+        'messages': messages,
+        'read_delay_ms': read_delay * 1000,
+        'window': window,
+        'delivered': len(received),
+        'lost': messages - len(received),
+        'in_order': in_order,
+        'seconds': seconds,
+        'peak_rss_mb': memory,
+    }
+
+
+def cmd_flow(args):
+    results = []
+    for index, credit in enumerate((0, args.credit)):
+        result = bench_flow(credit, args.messages, args.read_delay / 1000, args.window, args.base_port + 10 * index)
+        results.append(result)
+        print(f"{'credit ' + str(credit) if credit else 'no credit':>12}: delivered {result['delivered']:6d}  "
+              f"lost {result['lost']:6d}  {result['seconds']:5.1f} s  "
+              f"receiving daemon peak RSS {result['peak_rss_mb']:5.1f} MB  (read delay {args.read_delay:g} ms, "
+              f"window {args.window})")
+    return results
+
+
+class ReferenceDatagram:
+    """
+    The byte-by-byte codec simp_protocol used before the struct based one, kept as the baseline.
+    """
+    def create_datagram(self, msg_type, operation, seq_num, username, message):
+        type_byte = msg_type.to_bytes(1, byteorder='big')
+        op_byte = operation.to_bytes(1, byteorder='big')
+        seq_byte = seq_num.to_bytes(1, byteorder='big')
+        username = username[:32]
+        username_bytes = username.encode('ascii')
+        username_field = username_bytes + bytes(32 - len(username_bytes))
+        payload_bytes = message.encode('ascii')
+        payload_len = len(payload_bytes).to_bytes(4, byteorder='big')
+        return type_byte + op_byte + seq_byte + username_field + payload_len + payload_bytes
+
+    def parse_datagram(self, datagram):
+        username = ""
+        for byte in datagram[3:35]:
+            if byte == 0:
+                break
+            username += bytes([byte]).decode('ascii')
+        payload_len = int.from_bytes(datagram[35:39], byteorder='big')
+        payload = datagram[39:39 + payload_len].decode('ascii')
+        return (datagram[0], datagram[1], datagram[2], username, payload_len, payload)
+
+
+def ops_per_sec(function, seconds):
+    """
+    Calls function repeatedly for about the given time and returns calls per second.
+    """
+    calls = 0
+    batch = 1000
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            function()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def cmd_codec(args):
+    """
+    Encode and parse operations per second of the old and the current datagram codec.
+    """
+    from simp_protocol import Datagram
+
+    reference = ReferenceDatagram()
+    current = Datagram()
+    message = "x" * args.payload
+    chat = current.create_datagram(0x02, 0x01, 1, "alice", message)
+    ack = current.create_datagram(0x01, 0x04, 1, "alice", "")
+
+    cases = [
+        ("encode chat", lambda: reference.create_datagram(0x02, 0x01, 1, "alice", message),
+                        lambda: current.create_datagram(0x02, 0x01, 1, "alice", message)),
+        ("encode ACK", lambda: reference.create_datagram(0x01, 0x04, 1, "alice", ""),
+                       lambda: current.control_frame(0x04, 1, "alice")),
+        ("parse chat", lambda: reference.parse_datagram(chat), lambda: current.parse_datagram(chat)),
+        ("parse ACK (lazy view)", lambda: reference.parse_datagram(ack),
+                                  lambda: current.view(ack).seq_num),
+    ]
+    results = []
+    for name, before, after in cases:
+        before_ops = ops_per_sec(before, args.seconds)
+        after_ops = ops_per_sec(after, args.seconds)
+        results.append({'case': name, 'before_ops_per_sec': before_ops, 'after_ops_per_sec': after_ops})
+        print(f"{name:>24}: {before_ops:>11.0f} -> {after_ops:>11.0f} ops/s  ({after_ops / before_ops:.1f}x)")
+    return results
+
+WIRE_CORPORA = ("chat", "prose", "multilingual")
+CHAT_LINES = [
+    "hey {name}, are you around?", "yes", "ok", "lol", "sure, give me {n} minutes", "on my way",
+    "did you see the mail from {name} about the release?", "can we move the call to {time}?",
+    "sounds good to me", "thanks!", "no worries", "I'll send you the logs in a sec",
+    "the build on main is red again, looks like the flaky test in the store", "where are we meeting tomorrow?",
+    "running {n} min late, sorry", "ping me when you're back", "just pushed the fix, can you review it?",
+    "haha that's great", "what time works for you on {day}?", "I think {name} has the keys",
+    "let's do {time} then", "see you later!", "good morning :)", "can you call me when you have a minute",
+    "the link is https://example.com/docs/{n}", "have a nice weekend", "brb", "are we still on for lunch?",
+]
+MULTILINGUAL_LINES = [
+    "Hallo {name}, bist du morgen um {time} im Büro?", "Ja, klar! Bis später.", "Schöne Grüße aus München",
+    "Salut {name}, ça va ? On se voit à {time} ?", "Désolé, je suis en retard de {n} minutes.",
+    "Привет, {name}! Как дела?", "Увидимся завтра в {time}.", "Спасибо, всё получилось!",
+    "你好，{name}！明天{time}见面吗？", "好的，没问题。", "谢谢你的帮助！",
+    "こんにちは、{name}さん。今日は何時に来ますか？", "了解です！", "ありがとうございます 🙏",
+    "¿Dónde estás? Te espero en la estación.", "¡Feliz cumpleaños, {name}! 🎉🎂", "Olá! Tudo bem?",
+]
+WIRE_NAMES = ["alice", "bob", "Carol", "dave", "Eve", "Frank"]
+WIRE_DAYS = ["Monday", "Tuesday", "Thursday", "Friday", "Saturday"]
+
+
+def wire_corpus(name, messages, seed=1):
+    """
+    messages chat messages of a corpus: short chat lines, sentences of the README (prose), or
+    chat lines in other languages and scripts.
+    """
+    rng = random.Random(seed)
+    if name == "prose":
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "README.md"), encoding="utf-8") as f:
+            text = f.read().replace("\n", " ")
+        sentences = [line.strip() + "." for line in text.split(". ") if 20 <= len(line.strip()) <= 600]
+        return [sentences[i % len(sentences)] for i in range(messages)]
+    lines = CHAT_LINES if name == "chat" else MULTILINGUAL_LINES
+    return [rng.choice(lines).format(name=rng.choice(WIRE_NAMES), n=rng.randint(2, 45),
+                                     time=f"{rng.randint(8, 18)}:{rng.choice(['00', '15', '30', '45'])}",
+                                     day=rng.choice(WIRE_DAYS))
+            for _ in range(messages)]
+
+
+def wire_bytes(messages, version, compress):
+    """
+    Bytes on the wire (IP and UDP headers included) to send messages one datagram each (turn-taking,
+    every datagram with its ACK) and batched (windowed mode with batching, an ACK per datagram),
+    built with the same codec as the daemon. Version 1 only takes ASCII, its numbers for other text
+    are what it would take if it could.
+    """
+    from simp_compress import compress_payload
+    from simp_protocol import BATCH_ITEM, COMPRESSED, PLAIN, UDP_OVERHEAD, Datagram, encode_batch, max_payload
+
+    datagram = Datagram()
+
+    def build(msg_type, payload, count=1):
+        operation = PLAIN
+        compressed = compress_payload(payload) if compress and msg_type != 0x01 else None
+        if compressed is not None and msg_type == 0x03:
+            compressed = BATCH_ITEM.pack(count) + compressed
+        if compressed is not None and len(compressed) < len(payload):   # Same rule as Daemon.chat_datagram()
+            operation = COMPRESSED
+            payload = compressed
+        if version == 1:
+            return len(datagram.create_datagram(msg_type, operation, 1, "alice", payload)) + UDP_OVERHEAD
+        return len(datagram.create_compact(msg_type, operation, 1, 1, payload)) + UDP_OVERHEAD
+
+    ack = build(0x01, b"")
+    encoded = [message.encode('utf-8') for message in messages]
+    single = sum(build(0x02, data) + ack for data in encoded)
+    batched = 0
+    batch = []
+    size = 0
+    for data in encoded + [None]:
+        if batch and (data is None or size + BATCH_ITEM.size + len(data) > max_payload(DEFAULT_MTU)):
+            batched += (build(0x03, encode_batch(batch), len(batch)) if len(batch) > 1 else build(0x02, batch[0])) + ack
+            batch = []
+            size = 0
+        if data is not None:
+            batch.append(data)
+            size += BATCH_ITEM.size + len(data)
+    return single, batched
+
+
+def cmd_wire(args):
+    """
+    Bytes on the wire per chat message with the version 1 header, the compact header, and the
+    compact header with compression, on realistic chat corpora; and the CPU compression costs.
+    """
+    from simp_compress import compress_payload, decompress_payload
+    from simp_protocol import MAX_MESSAGE_SIZE
+
+    results = []
+    for name in args.corpus:
+        messages = wire_corpus(name, args.messages)
+        encoded = [message.encode('utf-8') for message in messages]
+        v1_single, v1_batched = wire_bytes(messages, 1, False)
+        compact_single, compact_batched = wire_bytes(messages, 2, False)
+        compressed_single, compressed_batched = wire_bytes(messages, 2, True)
+
+        start = time.process_time()
+        compressed = [compress_payload(data) for data in encoded]
+        compress_time = time.process_time() - start
+        taken = [data for data in compressed if data is not None]
+        start = time.process_time()
+        for data in taken:
+            decompress_payload(data, MAX_MESSAGE_SIZE)
+        decompress_time = time.process_time() - start
+
+        count = len(messages)
+        result = {
+            'corpus': name,
+            'messages': count,
+            'average_message_bytes': sum(map(len, encoded)) / count,
+            'compressed_messages': len(taken),
+            'v1_bytes_per_message': v1_single / count,
+            'compact_bytes_per_message': compact_single / count,
+            'compressed_bytes_per_message': compressed_single / count,
+            'v1_batched_bytes_per_message': v1_batched / count,
+            'compact_batched_bytes_per_message': compact_batched / count,
+            'compressed_batched_bytes_per_message': compressed_batched / count,
+            'compress_us_per_message': compress_time / count * 1e6,
+            'decompress_us_per_compressed_message': decompress_time / max(len(taken), 1) * 1e6,
+        }
+        results.append(result)
+        print(f"{name:>12}: {count} messages of {result['average_message_bytes']:.0f} bytes on average, "
+              f"{len(taken)} compressed")
+        for label, before, compact, after in (
+                ("one per datagram", v1_single, compact_single, compressed_single),
+                ("batched", v1_batched, compact_batched, compressed_batched)):
+            print(f"{label:>30}: v1 {before / count:6.1f}  compact {compact / count:6.1f}  "
+                  f"compressed {after / count:6.1f} bytes/message  ({(after - before) / before:+.0%})")
+        print(f"{'CPU':>30}: compress {result['compress_us_per_message']:5.1f} us/message  "
+              f"decompress {result['decompress_us_per_compressed_message']:5.1f} us/compressed message")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SIMP benchmarks")
+    parser.add_argument("--json", metavar="FILE", help="also write the results as JSON to FILE")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    daemon = commands.add_parser("daemon", help="threaded vs asyncio daemon, ping-pong chat over loopback")
+    daemon.add_argument("--mode", choices=["threaded", "asyncio", "both"], default="both")
+    daemon.add_argument("--messages", type=int, default=2000)
+    daemon.add_argument("--base-port", type=int, default=47000)
+    daemon.set_defaults(func=cmd_daemon)
+
+    sessions = commands.add_parser("sessions", help="memory per idle session and lookup cost of the session table")
+    sessions.add_argument("--sessions", type=int, default=65535, help="at most 65535, the number of session ids")
+    sessions.set_defaults(func=cmd_sessions)
+
+    window = commands.add_parser("window", help="bulk throughput of turn-taking vs sliding windows over a lossy link")
+    window.add_argument("--windows", type=int, nargs="+", default=[0, 4, 16, 64],
+                        help="window sizes to compare, 0 is the turn-taking mode")
+    window.add_argument("--messages", type=int, default=1000)
+    window.add_argument("--loss", type=float, default=0.02, help="loss probability per datagram and direction")
+    window.add_argument("--rtt", type=float, default=10, help="round-trip time added by the proxy in ms")
+    window.add_argument("--base-port", type=int, default=47100)
+    window.set_defaults(func=cmd_window)
+
+    batch = commands.add_parser("batch", help="datagrams per message and added latency with and without batching")
+    batch.add_argument("--delays", type=float, nargs="+", default=[0, 2, 5],
+                       help="batch delays in ms to compare, 0 turns batching off")
+    batch.add_argument("--messages", type=int, default=2000)
+    batch.add_argument("--burst", type=int, default=20, help="messages sent back to back")
+    batch.add_argument("--pause", type=float, default=5, help="pause between bursts in ms")
+    batch.add_argument("--rtt", type=float, default=2, help="round-trip time added by the proxy in ms")
+    batch.add_argument("--base-port", type=int, default=47200)
+    batch.set_defaults(func=cmd_batch)
+
+    encoding = commands.add_parser("encoding", help="JSON vs binary client messages: latency and CPU per message")
+    encoding.add_argument("--messages", type=int, default=5000)
+    encoding.add_argument("--payload", type=int, default=50, help="chat message size in bytes for the codec measurement")
+    encoding.add_argument("--seconds", type=float, default=0.5, help="time per codec measurement")
+    encoding.add_argument("--base-port", type=int, default=47300)
+    encoding.set_defaults(func=cmd_encoding)
+
+    transport = commands.add_parser("transport", help="UDP vs AF_UNIX vs shared memory between client and daemon")
+    transport.add_argument("--transports", choices=TRANSPORTS, nargs="+", default=list(TRANSPORTS))
+    transport.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    transport.add_argument("--messages", type=int, default=5000)
+    transport.add_argument("--base-port", type=int, default=47400)
+    transport.set_defaults(func=cmd_transport)
+
+    fragment = commands.add_parser("fragment", help="MB/s of a fragmented stream over a lossy link")
+    fragment.add_argument("--mtus", type=int, nargs="+", default=[DEFAULT_MTU, 9000],
+                          help="path MTUs to compare, datagrams between the daemons are at most this big")
+    fragment.add_argument("--megabytes", type=int, default=8)
+    fragment.add_argument("--chunk", type=int, default=16384, help="bytes per stream_chunk message")
+    fragment.add_argument("--loss", type=float, default=0.01, help="loss probability per datagram and direction")
+    fragment.add_argument("--rtt", type=float, default=2, help="round-trip time added by the proxy in ms")
+    fragment.add_argument("--base-port", type=int, default=47500)
+    fragment.set_defaults(func=cmd_fragment)
+
+    load = commands.add_parser("load", help="many chats between daemons over impaired links: setup rate, "
+                                             "msg/s, latency percentiles, retransmissions, CPU per message")
+    load.add_argument("--daemons", type=int, default=2, help="daemons in the ring, at least 2")
+    load.add_argument("--pairs", type=int, default=10, help="chats (pairs of headless clients)")
+    load.add_argument("--messages", type=int, default=200, help="messages per chat, each one is echoed")
+    load.add_argument("--unacked", type=int, default=1, help="messages an initiator sends ahead of their message_ack")
+    load.add_argument("--rate", type=float, default=0.0, help="messages per second per initiator, 0 for no limit")
+    load.add_argument("--window", type=int, default=0, help="sliding window of the daemons, 0 is turn-taking")
+    load.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    load.add_argument("--processes", action="store_true", help="run every daemon in its own process")
+    load.add_argument("--binary", action="store_true", help="binary client messages instead of JSON")
+    load.add_argument("--loss", type=float, default=0.01, help="loss probability per datagram and direction")
+    load.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is overtaken")
+    load.add_argument("--duplicate", type=float, default=0.0, help="probability a datagram is duplicated")
+    load.add_argument("--rtt", type=float, default=2, help="round-trip time added by the proxies in ms")
+    load.add_argument("--jitter", type=float, default=0, help="random delay +- this many ms per datagram")
+    load.add_argument("--seed", type=int, default=1, help="seed of the impairments")
+    load.add_argument("--timeout", type=float, default=120, help="give up after this many seconds")
+    load.add_argument("--base-port", type=int, default=47600)
+    load.set_defaults(func=cmd_load)
+
+    workers = commands.add_parser("workers", help="msg/s of one daemon with 1, 2, 4 worker processes "
+                                                   "(SO_REUSEPORT, Linux) serving many peer daemons")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                         help="worker counts to compare, 1 is a plain daemon process")
+    workers.add_argument("--peers", type=int, default=8, help="peer daemons chatting with the hub")
+    workers.add_argument("--pairs", type=int, default=32, help="chats (pairs of headless clients)")
+    workers.add_argument("--messages", type=int, default=200, help="messages per chat, each one is echoed")
+    workers.add_argument("--unacked", type=int, default=8,
+                         help="messages an initiator sends ahead of their message_ack")
+    workers.add_argument("--window", type=int, default=32, help="sliding window of the daemons, 0 is turn-taking")
+    workers.add_argument("--binary", action="store_true", help="binary client messages instead of JSON")
+    workers.add_argument("--timeout", type=float, default=120, help="give up after this many seconds")
+    workers.add_argument("--base-port", type=int, default=47700)
+    workers.set_defaults(func=cmd_workers)
+
+    group = commands.add_parser("group", help="delivery latency, fan-out time and hub CPU per message as a room grows")
+    group.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="room sizes (members) to compare")
+    group.add_argument("--daemons", type=int, default=16, help="member daemons the members are spread over")
+    group.add_argument("--messages", type=int, default=200, help="messages the first member sends to the room")
+    group.add_argument("--unacked", type=int, default=8, help="messages sent ahead of their message_ack")
+    group.add_argument("--rate", type=float, default=200, help="messages per second the sender sends, 0 for no limit")
+    group.add_argument("--multicast", metavar="GROUP:PORT",
+                       help="also run every size with the daemons sending to this multicast group")
+    group.add_argument("--timeout", type=float, default=120, help="give up after this many seconds")
+    group.add_argument("--base-port", type=int, default=47800)
+    group.set_defaults(func=cmd_group)
+
+    resume = commands.add_parser("resume", help="reconnect latency after a daemon restart: cold handshake vs "
+                                                "resumed with a ticket (and the first message in the SYN)")
+    resume.add_argument("--rounds", type=int, default=20, help="restarts (reconnects) to measure")
+    resume.add_argument("--rtt", type=float, default=20.0, help="round-trip time added by the proxy in ms")
+    resume.add_argument("--window", type=int, default=0, help="window of both daemons, 0 for turn-taking")
+    resume.add_argument("--base-port", type=int, default=47900)
+    resume.set_defaults(func=cmd_resume)
+
+    flow = commands.add_parser("flow", help="a slow reader flooded by its chat partner: messages lost and memory "
+                                            "of its daemon without and with credit")
+    flow.add_argument("--messages", type=int, default=20000)
+    flow.add_argument("--read-delay", type=float, default=0.1, help="time the reader takes per message in ms")
+    flow.add_argument("--credit", type=int, default=CLIENT_CREDIT, help="credit the reader gives its daemon")
+    flow.add_argument("--window", type=int, default=32, help="window of both daemons")
+    flow.add_argument("--base-port", type=int, default=48000)
+    flow.set_defaults(func=cmd_flow)
+
+    codec = commands.add_parser("codec", help="encode/parse ops/sec of the datagram codec, before and after")
+    codec.add_argument("--payload", type=int, default=100, help="chat payload size in bytes")
+    codec.add_argument("--seconds", type=float, default=0.5, help="time per measurement")
+    codec.set_defaults(func=cmd_codec)
+
+    wire = commands.add_parser("wire", help="bytes on the wire per chat message with the version 1 header, the "
+                                            "compact header and compression, and the CPU compression takes")
+    wire.add_argument("--corpus", choices=WIRE_CORPORA, nargs="+", default=list(WIRE_CORPORA))
+    wire.add_argument("--messages", type=int, default=5000, help="messages per corpus")
+    wire.set_defaults(func=cmd_wire)
+
+    args = parser.parse_args(argv)
+    results = args.func(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'benchmark': args.command, 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,174 +1,782 @@
-import socket
+import argparse
+import heapq
+import itertools
 import json
-import threading
+import os
+import selectors
+import socket
 import sys
+import time
+from collections import deque
+from simp_protocol import (MAX_CREDIT, decode_client_message, decode_json_message, encode_client_message,
+                           encode_json_message, is_json_message)
+from simp_retransmit import ScheduledCall
+from simp_transport import RING_POLL_INTERVAL, TRANSPORTS, open_client_socket
+
+RECEIVE_BUFFER_SIZE = 65536  # Batches from the daemon are bigger than single messages
+STREAM_CHUNK_SIZE = 16384  # Bytes per stream_chunk message
+STREAM_WINDOW = 8  # Stream chunks sent ahead of their message_ack (more overflow the socket buffers)
+INPUT_READ_SIZE = 65536  # Bytes read from stdin or a script at once
+# Chat messages (and stream chunks) the daemon may send ahead of the client handling them, about what
+# a default UDP receive buffer holds as single datagrams
+CLIENT_CREDIT = 128
+# Errors after which the client isn't in its room anymore
+ROOM_ERRORS = ('No answer from room host', 'Room host unreachable', 'Removed from room', 'Room is full')
+
+
+class EventLoop:
+    """
+    Waits on the sockets and the input (stdin, a script or a pipe) of one or more clients with a
+    selector, so a client that has nothing to do doesn't use any CPU. Many headless clients can
+    share one loop, e.g. for load tests.
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.clients = set()
+        self.files = {}  # Regular files (epoll can't watch them, they never block) -> callback
+        self._timers = []
+        self._counter = itertools.count()  # Tie-breaker so the heap never compares ScheduledCalls
+
+    def add(self, client):
+        self.clients.add(client)
+        client.loop = self
+        self.watch(client.socket, client.receive)
+
+    def remove(self, client):
+        self.clients.discard(client)
+        self.unwatch(client.socket)
+        self.unwatch(client.input)
+
+    def watch(self, fileobj, callback):
+        """
+        Calls callback() whenever fileobj has something to read.
+        """
+        try:
+            self.selector.register(fileobj, selectors.EVENT_READ, callback)
+        except KeyError:  # Already watched
+            pass
+        except PermissionError:  # A regular file, always readable
+            self.files[fileobj] = callback
+
+    def unwatch(self, fileobj):
+        if fileobj is None:
+            return
+        if self.files.pop(fileobj, None) is not None:
+            return
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def call_later(self, delay, callback):
+        """
+        Runs callback() after delay seconds. Returns a handle with cancel().
+        """
+        call = ScheduledCall(time.monotonic() + delay, callback)
+        heapq.heappush(self._timers, (call.deadline, next(self._counter), call))
+        return call
+
+    def run(self):
+        """
+        Runs until every client has stopped.
+        """
+        while self.clients:
+            while self._timers and self._timers[0][2].done:
+                heapq.heappop(self._timers)
+            timeout = max(0.0, self._timers[0][0] - time.monotonic()) if self._timers else None
+
+            # Shared memory clients only get a doorbell on their socket while they are marked as sleeping
+            sleepers = [client.socket for client in self.clients if hasattr(client.socket, 'sleep')]
+            ready = [sock for sock in sleepers if not sock.sleep()]
+            if ready or self.files:
+                timeout = 0.0
+            elif sleepers:
+                timeout = RING_POLL_INTERVAL if timeout is None else min(timeout, RING_POLL_INTERVAL)
+            events = self.selector.select(timeout)
+            for sock in sleepers:
+                sock.wake()
+
+            callbacks = [key.data for key, _ in events]
+            callbacks += [self.selector.get_key(sock).data for sock in ready]
+            callbacks += list(self.files.values())
+            for callback in callbacks:
+                callback()
+
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, call = heapq.heappop(self._timers)
+                if not call.done:
+                    call.done = True
+                    call.callback()
+
 
 class Client:
     """
-    Class for creating a Client instance, with the attributes: IP, port, socket connection, username and in_chat as a boolean value. 
-    Also contains functions to handle messages, show menu, connect with daemon, chat with other client/the other user and run the threads.
+    Class for creating a Client instance, with the attributes: IP, port, socket connection, username and in_chat as a boolean value.
+    Also contains functions to handle messages, show menu, connect with daemon, chat with other client/the other user and run the event loop.
     """
-    def __init__(self, daemon_port):
+    def __init__(self, daemon_port, binary=True, transport="udp", daemon_ip="127.0.0.1", credit=CLIENT_CREDIT):
         """
         Here all values of the class initialize. IP, socket and port are set forever at initialization, while username and in_chat will change during execution.
         """
-        self.daemon_ip = "127.0.0.1"
+        self.daemon_ip = daemon_ip
         self.daemon_port = daemon_port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # UDP to the daemon's client port, or its AF_UNIX socket (optionally with shared memory rings)
+        self.socket, self.daemon_addr = open_client_socket(transport, daemon_ip, daemon_port)
+        self.binary = binary  # Binary messages to the daemon, or JSON (easier to read when debugging)
+        self.credit = min(credit, MAX_CREDIT)  # Flow control: messages the daemon may send ahead, 0 for none
+        self.handled = 0  # Chat messages handled since the credit for them was given back
         self.username = None
         self.in_chat = False
+        self.loop = None  # EventLoop the client runs in
+        self.input = None  # Where input lines come from (stdin for the interactive client)
+        self.input_buffer = b""  # Start of a line that isn't complete yet
+        self.state = None  # What the next input line answers: 'username', 'menu', 'target_port', 'accept', 'queue_port', 'queue_username', 'queue_message', 'room_name', 'room_port' or None
+        self.queued = {}  # The message being left for an offline user, filled in prompt by prompt
+        self.joining = None  # Room asked for, until the daemon answers
+        self.room = None  # Room the user's lines go to
+        self.buffer = bytearray(RECEIVE_BUFFER_SIZE)  # Reused for every message
+        self.stream = None  # File being streamed to the chat partner
+        self.next_chunk = b""
+        self.stream_unacked = 0  # Stream chunks waiting for their message_ack
+        self.stream_bytes = 0
+        self.streams = {}  # (sender, stream id) -> file a received stream is written to
+
+    def send(self, msg):
+        """
+        Function for sending one message to the daemon, in the binary format or as JSON.
+        """
+        data = encode_client_message(msg) if self.binary else encode_json_message(msg)
+        self.socket.sendto(data, self.daemon_addr)
 
-    def handle_messages(self):
+    def receive(self):
         """
-        Function for handling incoming messages.
+        Function for handling everything that has arrived from the daemon (called by the event loop).
         """
-        while True:
+        view = memoryview(self.buffer)
+        while self.loop is not None:
             try:
-                data, _ = self.socket.recvfrom(1024)
-                msg = json.loads(data.decode())
-
-                if self.in_chat == False:
-                    if msg['type'] == 'connected':
-                        print("\nConnected to daemon")
-                        self.show_menu()
-
-                    elif msg['type'] == 'chat_request':
-                        print(f"\nIncoming chat request from {msg['from']}")
-                        choice = input("Accept chat? (y/n): ")
-                        self.socket.sendto(json.dumps({
-                            'type': 'chat_response',
-                            'accept': choice.lower() == 'y'
-                        }).encode(), (self.daemon_ip, self.daemon_port))
-                        if choice.lower() == 'y':
-                            self.in_chat = True
-                            print("Chat started! Type 'quit' to end chat.")
-
-                    elif msg['type'] == 'chat_started':
-                        print(f"\nChat started with {msg['with']}!")
-                        print("Type 'quit' to end chat.")
-                        self.in_chat = True
-
-                    elif msg['type'] == 'chat_message':
-                        print(f"\n{msg['from']}: {msg['message']}")
-
-                    elif msg['type'] == 'error':
-                        if msg.get('message') == 'Not your turn':
-                            print('---\WAIT for your turn to send a message...\n---')
-
-                    elif msg['type'] == 'chat_ended':
-                        print("\nChat ended")
-                        self.in_chat = False
-                        self.show_menu()
-
-                    elif msg['type'] == 'message_ack':
-                        print("--- Message delivered ---")
-                    
-                else:
-                    if msg['type'] == 'chat_message':
-                        print(f"\n{msg['from']}: {msg['message']}")
-                    elif msg['type'] == 'chat_ended':
-                        print("\nChat ended")
-                        self.in_chat = False
-                        self.show_menu()
-                    elif msg['type'] == 'message_ack':
-                        print('--- Message delivered. ---')
-                    elif msg['type'] == 'error':
-                        if msg.get('message') == 'Not your turn':
-                            print('---\nWait for your turn to send a message...\n---')
-                    
-                # Handles chat requests while already in a chat
-                if self.in_chat and msg['type'] == 'chat_request':
-                    self.socket.sendto(json.dumps({
-                        'type': 'error',
-                        'message': 'User already in another chat'
-                    }).encode(), (self.daemon_ip, self.daemon_port))
-                    self.socket.sendto(json.dumps({
-                        'type': 'chat_ended'
-                    }).encode(), (self.daemon_ip, self.daemon_port)) 
-
-            except Exception as e:
+                # Only the receives don't block: sending to a full AF_UNIX queue waits for the daemon
+                size, _ = self.socket.recvfrom_into(self.buffer, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except OSError as e:
                 print(f"Error receiving message: {e}")
-                break
+                self.stop()
+                return
+            data = view[:size]
+            # The daemon answers in the format we connected with (errors may still come as JSON)
+            msg = decode_json_message(data) if is_json_message(data) else decode_client_message(data)
+            messages = msg['messages'] if msg['type'] == 'batch' else [msg]  # Several the daemon sent together
+            for message in messages:
+                self.handle_message(message)
+                if message['type'] == 'chat_message' or message['type'] == 'stream_chunk':
+                    self.handled += 1
+            if self.credit and self.handled >= max(self.credit // 4, 1):
+                # Give the credit back in steps, not per message
+                self.send({
+                    'type': 'credit',
+                    'credit': self.handled
+                })
+                self.handled = 0
+
+    def read_input(self):
+        """
+        Function for reading what is available from the input and handling every complete line.
+        """
+        if self.loop is None:
+            return
+        data = os.read(self.input.fileno(), INPUT_READ_SIZE)
+        if not data:
+            self.loop.unwatch(self.input)
+            if self.input_buffer:  # Last line without a newline
+                self.handle_line(self.input_buffer.decode('utf-8', 'replace').rstrip("\r"))
+                self.input_buffer = b""
+            self.input_closed()
+            return
+        lines = (self.input_buffer + data).split(b"\n")
+        self.input_buffer = lines.pop()
+        for line in lines:
+            self.handle_line(line.decode('utf-8', 'replace').rstrip("\r"))
+
+    def input_closed(self):
+        """
+        End of the input (Ctrl-D): leave like with 'q'.
+        """
+        self.send({
+            'type': 'quit'
+        })
+        print("\nGoodbye!")
+        self.stop()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.loop is not None:
+            self.loop.remove(self)
+            self.loop = None
+
+    def prompt(self, text, state):
+        """
+        Function for asking the user something, the next input line is the answer.
+        """
+        print(text, end="", flush=True)
+        self.state = state
+
+    def handle_line(self, line):
+        """
+        Function for handling one line the user typed, depending on what was asked.
+        """
+        state, self.state = self.state, None
+        if state == 'username':
+            self.connect(line)
+        elif state == 'menu':
+            self.menu_choice(line)
+        elif state == 'target_port':
+            if line.isdigit():
+                self.send({
+                    'type': 'start_chat',
+                    'target_port': line
+                })
+            else:  # A username, the daemon finds it in the directory
+                self.send({
+                    'type': 'start_chat',
+                    'target_username': line
+                })
+        elif state == 'queue_port':
+            self.queued = {'type': 'queue_message', 'target_port': line}
+            self.prompt("Enter target username: ", 'queue_username')
+        elif state == 'queue_username':
+            self.queued['target_username'] = line
+            self.prompt("Enter message: ", 'queue_message')
+        elif state == 'queue_message':
+            self.queued['message'] = line
+            self.send(self.queued)
+            self.queued = {}
+            print("Message queued, it is delivered when the user is reachable")
+            self.show_menu()
+        elif state == 'room_name':
+            self.joining = line
+            self.prompt("Enter port of the daemon hosting it (empty: this daemon): ", 'room_port')
+        elif state == 'room_port':
+            self.send({
+                'type': 'join_room',
+                'room': self.joining,
+                'target_port': line
+            })
+            print(f"Joining room {self.joining}...")
+        elif state == 'accept':
+            self.send({
+                'type': 'chat_response',
+                'accept': line.lower() == 'y'
+            })
+            if line.lower() == 'y':
+                self.in_chat = True
+                print("Chat started! Type 'quit' to end chat.")
+        elif self.room is not None:
+            self.room_chat(line)
+        elif self.in_chat:
+            self.chat(line)
+
+    def send_stream(self, stream):
+        """
+        Starts sending everything read from a binary file object to the chat partner as a stream of
+        chunks, so it never has to be in memory at once. More chunks go out as message_acks come
+        back, at most STREAM_WINDOW wait for theirs.
+        """
+        self.stream = stream
+        self.stream_bytes = 0
+        self.next_chunk = stream.read(STREAM_CHUNK_SIZE)
+        self.pump_stream()
+
+    def pump_stream(self):
+        while self.stream is not None and self.stream_unacked < STREAM_WINDOW:
+            chunk = self.next_chunk
+            self.next_chunk = self.stream.read(STREAM_CHUNK_SIZE)  # Read ahead to know which chunk is the last
+            self.send({
+                'type': 'stream_chunk',
+                'data': chunk,
+                'last': not self.next_chunk
+            })
+            self.stream_unacked += 1
+            self.stream_bytes += len(chunk)
+            if not self.next_chunk:
+                self.stream.close()
+                self.stream = None
+                self.stream_finished()
+
+    def stream_finished(self):
+        print(f"--- Sent {self.stream_bytes} bytes ---")
+
+    def send_file(self, path):
+        """
+        Announces a file with a chat message and streams it to the chat partner.
+        """
+        if self.stream is not None:
+            print("Already sending a file")
+            return
+        try:
+            file = open(path, 'rb')
+        except OSError as e:
+            print(f"Can't send file: {e}")
+            return
+        self.send({
+            'type': 'chat_message',
+            'message': f"Sending file {os.path.basename(path)} ({os.path.getsize(path)} bytes)"
+        })
+        self.stream_unacked += 1  # The announcement is confirmed together with the stream
+        self.send_stream(file)
+
+    def receive_stream_chunk(self, msg):
+        """
+        Appends a received stream chunk to its file (received-<sender>-<stream id>).
+        """
+        key = (msg['from'], msg.get('stream', 0))
+        file = self.streams.get(key)
+        if file is None:
+            sender = "".join(c if c.isalnum() else "_" for c in key[0])  # The name comes from another host
+            file = self.streams[key] = open(f"received-{sender}-{key[1]}", 'wb')
+            print(f"\nReceiving stream from {key[0]} into {file.name}")
+        file.write(msg.get('data', b""))
+        if msg['last']:
+            del self.streams[key]
+            file.close()
+            print(f"\nStream from {key[0]} saved to {file.name} ({os.path.getsize(file.name)} bytes)")
+
+    def handle_message(self, msg):
+        """
+        Function for handling one message from the daemon.
+        """
+        if msg['type'] == 'message_ack' and self.stream_unacked:
+            # One per chunk (or a count of them), not worth printing
+            self.stream_unacked = max(self.stream_unacked - msg.get('count', 1), 0)
+            self.pump_stream()
+            return
+        elif msg['type'] == 'stream_chunk':
+            self.receive_stream_chunk(msg)
+            return
+
+        if self.in_chat == False:
+            if msg['type'] == 'connected':
+                print("\nConnected to daemon")
+                self.show_menu()
+
+            elif msg['type'] == 'chat_request':
+                print(f"\nIncoming chat request from {msg['from']}")
+                self.prompt("Accept chat? (y/n): ", 'accept')
+
+            elif msg['type'] == 'chat_started':
+                print(f"\nChat {'resumed' if msg.get('resumed') else 'started'} with {msg['with']}!")
+                print("Type 'quit' to end chat.")
+                self.in_chat = True
+
+            elif msg['type'] == 'room_joined':
+                self.joining = None
+                self.room = msg['room']
+                print(f"\nJoined room {self.room}! Type 'q' to leave.")
+
+            elif msg['type'] == 'chat_message':
+                print(f"\n{msg['from']}: {msg['message']}")
+
+            elif msg['type'] == 'error':
+                if msg.get('message') == 'Not your turn':
+                    print('---\WAIT for your turn to send a message...\n---')
+                else:
+                    print(f"\n{msg.get('message')}")
+                if self.joining is not None or (self.room is not None and msg.get('message') in ROOM_ERRORS):
+                    self.joining = None  # Didn't get into the room, or not in it anymore
+                    self.room = None
+                    self.show_menu()
+
+            elif msg['type'] == 'chat_ended':
+                print("\nChat ended")
+                self.in_chat = False
+                self.show_menu()
+
+            elif msg['type'] == 'message_ack':
+                print("--- Message delivered ---")
+
+        else:
+            if msg['type'] == 'chat_message':
+                print(f"\n{msg['from']}: {msg['message']}")
+            elif msg['type'] == 'chat_ended':
+                print("\nChat ended")
+                self.in_chat = False
+                if self.stream is not None:  # Nobody to send it to anymore
+                    self.stream.close()
+                    self.stream = None
+                self.stream_unacked = 0
+                self.show_menu()
+            elif msg['type'] == 'message_ack':
+                print('--- Message delivered. ---')
+            elif msg['type'] == 'error':
+                if msg.get('message') == 'Not your turn':
+                    print('---\nWait for your turn to send a message...\n---')
+                else:
+                    print(f"\n{msg.get('message')}")
+
+        # Handles chat requests while already in a chat
+        if self.in_chat and msg['type'] == 'chat_request':
+            self.send({
+                'type': 'error',
+                'message': 'User already in another chat'
+            })
+            self.send({
+                'type': 'chat_ended'
+            })
 
     def show_menu(self):
         """
-        Function for showing the user the options. Also waits for input 
+        Function for showing the user the options. The answer is handled by menu_choice.
         """
         print("\nOptions:")
         print("1. Start new chat")
         print("2. Wait for chat requests")
+        print("3. Leave a message")
+        print("4. Join a room")
         print("q. Quit")
-        
-        choice = input("Choose an option: ")
-        
+        self.prompt("Choose an option: ", 'menu')
+
+    def menu_choice(self, choice):
         if choice == '1':
-            target_port = input("Enter target daemon port: ")
-            self.socket.sendto(json.dumps({
-                'type': 'start_chat',
-                'target_port': target_port
-            }).encode(), (self.daemon_ip, self.daemon_port))
-        
+            self.prompt("Enter target daemon port or username: ", 'target_port')
+
+        elif choice == '2':
+            print("Waiting for chat requests...")
+
+        elif choice == '3':
+            self.prompt("Enter target daemon port: ", 'queue_port')
+
+        elif choice == '4':
+            self.prompt("Enter room name: ", 'room_name')
+
         elif choice == 'q':
-            self.socket.sendto(json.dumps({
+            self.send({
                 'type': 'quit'
-            }).encode(), (self.daemon_ip, self.daemon_port))
+            })
             print("Goodbye!")
-            sys.exit(0)
-        
-        elif choice not in ['1', '2', 'q']: 
-            print("#####\nInvalid option\n#####\n---> Choose from options: 1, 2 or 'q' to quit!")
+            self.stop()
+
+        else:
+            print("#####\nInvalid option\n#####\n---> Choose from options: 1, 2, 3, 4 or 'q' to quit!")
             self.show_menu()
 
-    def connect(self):
+    def connect(self, username):
         """
         Function for creating a connection request to the daemon and sending the username.
         """
-        self.username = input("Enter your username: ")
-        self.socket.sendto(json.dumps({
+        self.username = username
+        msg = {
             'type': 'connect',
-            'username': self.username
-        }).encode(), (self.daemon_ip, self.daemon_port))
+            'username': self.username,
+            'batch': True  # We can handle several messages in one datagram
+        }
+        if self.credit:
+            msg['credit'] = self.credit
+            self.handled = 0
+        self.send(msg)
 
-    def chat(self):
+    def chat(self, message):
         """
-        Function where we send chat message to other client or quit the chat.
+        Function where we send one chat message to the other client or quit the chat.
         """
-        while True:
-            if self.in_chat:
-                message = input()
-                if message.lower() == 'q':
-                    self.socket.sendto(json.dumps({
-                        'type': 'quit'
-                    }).encode(), (self.daemon_ip, self.daemon_port))
-                    self.in_chat = False
-                    self.show_menu()
-                else:
-                    self.socket.sendto(json.dumps({
-                        'type': 'chat_message',
-                        'message': message
-                    }).encode(), (self.daemon_ip, self.daemon_port))
+        if message.lower() == 'q':
+            self.send({
+                'type': 'quit'
+            })
+            self.in_chat = False
+            self.show_menu()
+        elif message.startswith('/send '):  # Stream a file to the chat partner
+            self.send_file(message[len('/send '):].strip())
+        else:
+            self.send({
+                'type': 'chat_message',
+                'message': message
+            })
+
+    def room_chat(self, message):
+        """
+        Function where we send one message to everybody in the room or leave it.
+        """
+        if message.lower() == 'q':
+            self.send({
+                'type': 'leave_room',
+                'room': self.room
+            })
+            self.room = None
+            self.show_menu()
+        else:
+            self.send({
+                'type': 'room_message',
+                'room': self.room,
+                'message': message
+            })
 
     def run(self):
         """
-        Function for starting the thread for the receiving thread and the chat sending thread.
+        Function for running the client: one event loop waits for the user's input and the
+        daemon's messages at the same time.
+        """
+        loop = EventLoop()
+        loop.add(self)
+        self.input = sys.stdin
+        loop.watch(self.input, self.read_input)
+        self.prompt("Enter your username: ", 'username')
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            print("\nDisconnecting...")
+
+
+class HeadlessClient(Client):
+    """
+    Client without user interaction, for scripts and load tests. It connects as username, starts
+    a chat with the daemon on target_port (or with target_username wherever the daemon's directory
+    finds the user, or accepts the first chat request) and sends every line
+    of its input (a file or a pipe) as a chat message, at most max_unacked at a time and at most
+    rate per second (0 means no limit). A line "/send PATH" streams a file, "/sleep SECONDS" pauses
+    and "/quit" ends the input. Once the input is used up and everything is acknowledged it leaves
+    the chat, or with wait_end it waits until the other side does. With room it joins that room
+    instead (hosted by the daemon on target_port, or by its own daemon) and the lines go to
+    everybody in it. Received messages are written to output (if given), counters are kept in stats.
+    """
+    def __init__(self, daemon_port, username, target_port=None, target_username=None, rate=0.0, max_unacked=1,
+                 wait_end=False, output=None, room=None, **options):
+        super().__init__(daemon_port, **options)
+        self.username = username
+        self.target_port = target_port
+        self.target_username = target_username
+        self.joining = room
+        self.rate = rate
+        self.max_unacked = max_unacked
+        self.wait_end = wait_end
+        self.output = output
+        self.lines = deque()  # Input lines that aren't sent yet
+        self.in_flight = deque()  # Sent messages waiting for their message_ack
+        self.input_done = False
+        self.reading = False  # The input is watched by the loop
+        self.blocked = False  # Not our turn, wait for the other side's message
+        self.next_send = 0.0
+        self.timer = None
+        self.stats = {'sent': 0, 'acked': 0, 'received': 0, 'stream_bytes': 0, 'errors': 0}
+
+    def start(self, loop, input_file=None):
+        """
+        Adds the client to an event loop and connects. Without input_file it only receives.
         """
-        self.connect()
-        receive_thread = threading.Thread(target=self.handle_messages, daemon=True)
-        receive_thread.start()
-        
-        chat_thread = threading.Thread(target=self.chat, daemon=True)
-        chat_thread.start()
-        
-        while True:
+        loop.add(self)
+        self.input = input_file
+        self.input_done = input_file is None
+        self.connect(self.username)
+
+    def receive(self):
+        super().receive()
+        self.pump()
+
+    def read_input(self):
+        super().read_input()
+        self.pump()
+
+    def handle_line(self, line):
+        if line:
+            self.lines.append(line)
+
+    def input_closed(self):
+        self.input_done = True
+        self.reading = False
+
+    def stream_finished(self):
+        pass
+
+    def timer_fired(self):
+        self.timer = None
+        self.pump()
+
+    def pump(self):
+        """
+        Sends input lines as far as the turn, max_unacked and rate allow, reads more input if all
+        lines are sent, and leaves the chat when everything is done.
+        """
+        if self.loop is None:
+            return
+        now = time.monotonic()
+        while (self.in_chat and self.lines and not self.blocked and self.stream is None
+               and len(self.in_flight) < self.max_unacked):
+            if now < self.next_send:
+                if self.timer is None:
+                    self.timer = self.loop.call_later(self.next_send - now, self.timer_fired)
+                break
+            line = self.lines[0]
+            if line.startswith('/send ') and self.in_flight:
+                break  # Stream acks are counted separately, so wait for the messages before it
+            self.lines.popleft()
+            self.send_line(line, now)
+
+        reading = self.in_chat and not self.lines and not self.input_done
+        if reading != self.reading:
+            self.reading = reading
+            if reading:
+                self.loop.watch(self.input, self.read_input)
+            else:
+                self.loop.unwatch(self.input)
+
+        if (self.in_chat and self.input_done and not self.lines and not self.in_flight and self.stream is None
+                and not self.stream_unacked and not self.wait_end):
+            self.send({
+                'type': 'quit'
+            })
+            self.in_chat = False
+            self.stop()
+
+    def send_line(self, line, now):
+        if line.startswith('/sleep '):
+            self.next_send = now + float(line[len('/sleep '):])
+        elif line == '/quit':
+            self.lines.clear()
+            self.input_done = True
+        elif line.startswith('/send '):
             try:
-                pass
-            except KeyboardInterrupt:
-                print("\nDisconnecting...")
-                sys.exit(0)
+                self.send_stream(open(line[len('/send '):].strip(), 'rb'))
+            except OSError as e:
+                self.stats['errors'] += 1
+                print(f"Can't send file: {e}", file=sys.stderr)
+        elif self.room is not None:
+            self.send({
+                'type': 'room_message',
+                'room': self.room,
+                'message': line
+            })
+            self.in_flight.append(line)
+            self.stats['sent'] += 1
+            if self.rate > 0:
+                self.next_send = max(now, self.next_send) + 1 / self.rate
+        else:
+            self.send({
+                'type': 'chat_message',
+                'message': line
+            })
+            self.in_flight.append(line)
+            self.stats['sent'] += 1
+            if self.rate > 0:
+                self.next_send = max(now, self.next_send) + 1 / self.rate
+
+    def handle_message(self, msg):
+        msg_type = msg['type']
+        if msg_type == 'connected':
+            if self.joining is not None:
+                self.send({
+                    'type': 'join_room',
+                    'room': self.joining,
+                    'target_port': self.target_port
+                })
+            elif self.target_port is not None or self.target_username is not None:
+                self.send({
+                    'type': 'start_chat',
+                    'target_port': self.target_port,
+                    'target_username': self.target_username
+                })
+        elif msg_type == 'chat_request':
+            self.send({
+                'type': 'chat_response',
+                'accept': not self.in_chat
+            })
+            self.in_chat = True
+        elif msg_type == 'chat_started':
+            self.in_chat = True
+        elif msg_type == 'room_joined':
+            self.room = msg['room']
+            self.in_chat = True
+        elif msg_type == 'chat_message':
+            self.stats['received'] += 1
+            self.blocked = False  # The other side answered, it's our turn again
+            if self.output is not None:
+                self.output.write(f"{msg['from']}: {msg['message']}\n")
+        elif msg_type == 'stream_chunk':
+            self.stats['stream_bytes'] += len(msg.get('data', b""))
+        elif msg_type == 'message_ack':
+            for _ in range(msg.get('count', 1)):
+                if self.stream_unacked:
+                    self.stream_unacked -= 1
+                    self.pump_stream()
+                elif self.in_flight:
+                    self.in_flight.popleft()
+                    self.stats['acked'] += 1
+        elif msg_type == 'error':
+            if msg.get('message') == 'Not your turn' and self.in_flight:
+                self.lines.appendleft(self.in_flight.pop())  # Send it again after the other side's message
+                self.stats['sent'] -= 1
+                self.blocked = True
+            else:
+                self.stats['errors'] += 1
+                print(f"Error: {msg.get('message')}", file=sys.stderr)
+                if self.joining is not None and (self.room is None or msg.get('message') in ROOM_ERRORS):
+                    self.in_chat = False  # Not in the room (anymore)
+                    self.stop()
+        elif msg_type == 'chat_ended':
+            self.in_chat = False
+            self.stop()
+
 
 if __name__ == "__main__":
-    daemon_port = int(input("Enter client-daemon port: "))
-    client = Client(daemon_port)
-    if len(sys.argv) == 2:                     # default: 127.0.0.1
-        client.daemon_ip = sys.argv[1]         # take IP address as command line parameter
-    client.run()
+    parser = argparse.ArgumentParser(description="SIMP client")
+    parser.add_argument("ip", nargs="?", default="127.0.0.1",     # default: 127.0.0.1
+                        help="IP address of the daemon")
+    parser.add_argument("--json", action="store_true",
+                        help="talk JSON to the daemon instead of the binary format (for debugging)")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="udp",
+                        help="UDP, an AF_UNIX socket, or shared memory rings (the daemon has to run "
+                             "with --transport unix or shm)")
+    parser.add_argument("--port", type=int, help="client port of the daemon (asked for if not given)")
+    parser.add_argument("--credit", type=int, default=CLIENT_CREDIT,
+                        help="chat messages the daemon may send ahead of the client handling them, 0 for no "
+                             "flow control")
+    headless = parser.add_argument_group("headless mode")
+    headless.add_argument("--headless", action="store_true",
+                          help="no user interaction: send the lines of --script as chat messages")
+    headless.add_argument("--username", help="username to connect with")
+    headless.add_argument("--target-port", help="daemon port to start a chat with, without it (and without "
+                                                "--target-username) the client accepts the first chat request")
+    headless.add_argument("--target-username", help="user on that daemon to chat with, without --target-port "
+                                                    "the daemon finds the user in its directory")
+    headless.add_argument("--room", help="join this room instead of starting a chat, hosted by the daemon on "
+                                         "--target-port or by this client's daemon")
+    headless.add_argument("--script", help="file or pipe with one message per line, - for stdin "
+                                           "(without it the client only receives)")
+    headless.add_argument("--rate", type=float, default=0.0, help="messages per second at most, 0 for no limit")
+    headless.add_argument("--unacked", type=int, default=1, help="messages sent ahead of their delivery confirmation")
+    headless.add_argument("--wait-end", action="store_true",
+                          help="after the script, wait until the other side ends the chat")
+    headless.add_argument("--quiet", action="store_true", help="don't print received messages")
+    headless.add_argument("--stats", action="store_true", help="print counters as JSON to stderr at the end")
+    args = parser.parse_args()
+
+    daemon_port = args.port if args.port is not None else int(input("Enter client-daemon port: "))
+    if args.headless:
+        if not args.username:
+            parser.error("--headless needs --username")
+        script = None
+        if args.script == "-":
+            script = sys.stdin
+        elif args.script:
+            script = open(args.script, 'rb')
+        client = HeadlessClient(daemon_port, args.username, args.target_port, args.target_username, args.rate,
+                                args.unacked, args.wait_end, None if args.quiet else sys.stdout, args.room,
+                                binary=not args.json, transport=args.transport, daemon_ip=args.ip,
+                                credit=args.credit)
+        loop = EventLoop()
+        client.start(loop, script)
+        started = time.monotonic()
+        cpu_started = time.process_time()
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            pass
+        if args.stats:
+            client.stats['seconds'] = time.monotonic() - started
+            client.stats['cpu_seconds'] = time.process_time() - cpu_started
+            print(json.dumps(client.stats), file=sys.stderr)
+    else:
+        client = Client(daemon_port, binary=not args.json, transport=args.transport,
+                        daemon_ip=args.ip, credit=args.credit)         # take IP address as command line parameter
+        client.run()
@@ -0,0 +1,68 @@
+"""
+Payload compression of the wire format version 2. Every chat datagram, batch and fragmented
+message is compressed on its own (raw deflate primed with a dictionary of common chat words), so
+a datagram never needs the ones before it: datagrams are lost and retransmitted out of order, and
+the unacknowledged ones are stored and sent again in another session.
+"""
+import zlib
+
+COMPRESS_MIN = 32               # Shorter payloads save a few bytes at most, they are sent as they are
+COMPRESS_LEVEL = 6
+SMALL_WINDOW_BITS = 11          # Payloads up to 2 KB get a 2 KB window, far cheaper to set up than 32 KB
+SMALL_PAYLOAD = 1 << SMALL_WINDOW_BITS
+WINDOW_BITS = 15
+# Preset dictionary: strings a short message likely shares with it, the most common ones last (closest
+# to the data, so the cheapest to refer to). Under 2 KB, so the small window reaches all of it. Both
+# daemons must have the same one, a different dictionary needs a new wire format version.
+CHAT_DICTIONARY = (
+    b"https://www. .com/ .org/ .html?id= [image] [file] "
+    b"Monday Tuesday Wednesday Thursday Friday Saturday Sunday January February March April June July "
+    b"August September October November December o'clock morning afternoon evening weekend "
+    b"minutes hours yesterday tomorrow tonight today next week last week "
+    b"birthday dinner lunch coffee office home work school meeting call phone number address "
+    b"problem question answer information something anything everything nothing someone everyone "
+    b"because should would could might must maybe probably actually really already still never always "
+    b"again before after while until since though although through between without about above "
+    b"please sorry thank you thanks very much no problem of course you're welcome congratulations "
+    b"good morning good night see you later talk to you soon take care have a nice day "
+    b"what do you think how are you doing I'm fine how about you where are you when will you "
+    b"can you could you would you do you want to let me know I don't know I think that I will "
+    b"I have I'm not sure it's okay that's great that's right sounds good no worries "
+    b"hello hey hi yes yeah no okay ok sure lol haha :) :( :D ;) ... ?! "
+    b"the be to of and a in that have it for not on with he as you do at this but his by from they we "
+    b"say her she or an will my one all would there their what so up out if about who get which go me "
+    b"when make can like time no just him know take people into year your good some could them see "
+    b"other than then now look only come its over think also back after use two how our work first "
+    b"well way even new want because any these give day most us is are was were been has had did "
+)
+
+_small = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -SMALL_WINDOW_BITS, 4, zdict=CHAT_DICTIONARY)
+_large = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -WINDOW_BITS, 8, zdict=CHAT_DICTIONARY)
+_decompressor = zlib.decompressobj(-WINDOW_BITS, zdict=CHAT_DICTIONARY)
+
+
+def compress_payload(data):
+    """
+    Compresses a payload (bytes). Returns None if it is too short to be worth it or doesn't get
+    smaller. The compressors are copies of ones that already took the dictionary.
+    """
+    if len(data) < COMPRESS_MIN:
+        return None
+    compressor = (_small if len(data) <= SMALL_PAYLOAD else _large).copy()
+    compressed = compressor.compress(data) + compressor.flush()
+    return compressed if len(compressed) < len(data) else None
+
+
+def decompress_payload(data, limit):
+    """
+    Decompresses a payload. Raises ValueError if it is corrupt or would get longer than limit
+    bytes, so a few bytes from a peer can't make us allocate much more than a message.
+    """
+    decompressor = _decompressor.copy()
+    try:
+        plain = decompressor.decompress(data, limit)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed payload: {e}") from None
+    if not decompressor.eof:
+        raise ValueError("Compressed payload truncated or too long")
+    return plain
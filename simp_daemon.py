@@ -1,240 +1,2105 @@
-import socket
+import argparse
+import asyncio
 import threading
-import json
-import sys
 import time
-from simp_protocol import Datagram
+from simp_compress import compress_payload, decompress_payload
+from simp_protocol import (BATCH_ITEM, COMPACT, COMPRESSED, CREDIT, DEFAULT_MTU, FRAGMENT_COMPRESSED, FRAGMENT_END,
+                           FRAGMENT_LAST, FRAGMENT_STREAM, MAX_CLIENT_NUMBER, MAX_CREDIT, MAX_MESSAGE_SIZE,
+                           MAX_USERNAME_LENGTH, PLAIN, WIRE_VERSION, Datagram, decode_batch, decode_client_message, decode_json_message,
+                           encode_batch, encode_client_batch, encode_client_message, encode_json_message,
+                           encode_options, is_json_message, max_payload, parse_fragment, parse_options,
+                           split_fragments)
+from simp_directory import (DIRECTORY, DIRECTORY_REFRESH, DIRECTORY_RETRY, FOUND, LOOKUP, LOOKUP_RETRIES, NOT_FOUND,
+                            REFRESH, REGISTER, REGISTERED, UNKNOWN, Lookup, PeerCache, parse_directory_addr,
+                            parse_found)
+from simp_group import (GROUP, GROUP_ACK, GROUP_ACK_PAYLOAD, GROUP_RETRIES, GROUP_SEQ, JOIN, JOINED, LEAVE, LEFT,
+                        MAX_GROUP_BACKLOG, MAX_GROUP_MEMBERS, POST, POSTED, PUBLISH, Room, bits_of, decode_group_items,
+                        encode_group_items, parse_multicast_addr)
+from simp_metrics import DaemonMetrics, MetricsServer, SamplingProfiler, metric
+from simp_resume import TICKET_SYNC_INTERVAL, TicketCache, decode_early_data, encode_early_data
+from simp_retransmit import AsyncRetransmitQueue, RetransmitQueue
+from simp_transport import (TRANSPORTS, UnixServer, enable_multicast, open_daemon_socket, open_multicast_socket,
+                            open_udp_socket)
+from simp_session import (CLOSED, CLOSING, CONNECTING, ESTABLISHED, REQUESTED, LocalClient, ReassemblyBuffer, Session,
+                          SessionTable)
+from simp_store import (MessageStore, decode_stored_message, encode_stored_message, incoming_log_name,
+                        outgoing_log_name, parse_log_name)
+from simp_window import MAX_WINDOW
 
-TIMEOUT = 5  # Timeout is 5 seconds for retransmission
+SYN_RETRIES = 5  # Give up on a handshake after 5 retransmissions (about a minute with backoff)
+FIN_RETRIES = 3  # A FIN is retransmitted a few times, the peer may already be gone
+CHAT_RETRIES = 8  # A chat datagram is given up after 8 retransmissions (about two minutes with backoff)
+EVICTION_INTERVAL = 10  # Look for idle sessions every 10 seconds
+RECEIVE_BUFFER_SIZE = 65536  # Largest datagram accepted from another daemon or a client (the UDP maximum)
+MAX_SEND_QUEUE = 4096  # Chat messages (or fragments) a windowed session buffers while its window is full
+BATCH_SIZE = max_payload(DEFAULT_MTU)  # Largest payload of a batch datagram
+CLIENT_BATCH_SIZE = 8192  # Largest 'batch' datagram sent to a client
+STORE_SYNC_INTERVAL = 0.05  # Stored messages are flushed to disk together at most this often
+FORWARD_RETRY_INTERVAL = 1.0  # First retry of a peer stored messages couldn't be delivered to, then doubled
+FORWARD_RETRY_MAX = 60.0
+FORWARD_BURST = 1024  # Stored messages sent before the log is acknowledged up to them
+DRAIN_CHUNK = 256  # Stored messages given to a client per timer call
+MAX_CLIENT_QUEUE = 1024  # Messages held for a client that ran out of credit
+MAX_CLIENT_QUEUE_BYTES = 4 * 1024 * 1024
+CREDITED_MESSAGES = ('chat_message', 'stream_chunk')  # What a client's credit is used for
+STATE_NAMES = {CONNECTING: "connecting", REQUESTED: "requested", ESTABLISHED: "established", CLOSING: "closing",
+               CLOSED: "closed"}
+
+
+def queued_size(msg):
+    """
+    Bytes a message held for a client counts against MAX_CLIENT_QUEUE_BYTES.
+    """
+    return len(msg.get('message') or msg.get('data') or "") + 64
+
+
+def parse_port(value):
+    """
+    The port number in a client message, None if it isn't one.
+    """
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        return None
+    return port if 0 < port < 65536 else None
+
+
+def valid_username(value):
+    """
+    Whether a username in a client message fits the datagram header (and so the binary format).
+    """
+    return isinstance(value, str) and 0 < len(value.encode('utf-8')) <= MAX_USERNAME_LENGTH
 
 ##############
 # Main Program
 ##############
 
 class Daemon:
-    def __init__(self, daemon_port, client_port):
+    def __init__(self, daemon_port, client_port, window=0, batch_delay=0.0, batch_size=BATCH_SIZE,
+                 transport="udp", mtu=DEFAULT_MTU, metrics_port=None, profile_interval=0.0, store_dir=None,
+                 directory=None, multicast=None, ticket_file=None, compression=True):
         self.daemon_port = daemon_port
         self.client_port = client_port
         self.ip = "127.0.0.1"
-        
-        self.daemon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.daemon_socket.bind((self.ip, self.daemon_port))
-        
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client_socket.bind((self.ip, self.client_port))
-        
+        self.window = window  # Sliding window asked for in our SYNs, 0 means the default turn-taking
+        self.batch_delay = batch_delay  # Seconds a message may wait to be batched with others, 0 turns batching off
+        self.max_payload = max_payload(mtu)  # Bigger messages are fragmented so no datagram exceeds the path MTU
+        self.batch_size = min(batch_size, self.max_payload)  # Bytes that are sent right away without waiting
+        self.compression = compression  # Compress chat payloads to peers of the wire format version 2
+
+        self.transport = transport  # How clients reach us: UDP, or the AF_UNIX socket (with shared memory rings)
+        self.daemon_socket, self.client_socket = self.open_sockets()
+
         self.datagram = Datagram()
-        self.sequence_number = 0
-        self.client_address = None
-        self.client_username = None
-        self.current_chat_port = None
-        self.waiting_for_response = False
+        self.clients = {}  # username -> LocalClient
+        self.clients_by_addr = {}  # client address -> LocalClient
+        self.sessions = SessionTable()  # (peer address, peer username) -> Session
+        self.reassembly = ReassemblyBuffer()  # (session, message id) -> fragments received so far
+        self.retransmit = RetransmitQueue(self.send_to_daemon)
+        self.metrics = DaemonMetrics()  # Only updated in `if __debug__:` blocks, python -O leaves them out
+        if __debug__:
+            self.retransmit.observe_rtt = self.metrics.rtt.observe
+        self.retransmit.on_expired = self.send_expired
+        self.metrics_port = metrics_port  # Serves /metrics (and /profile) on this port if given
+        self.profiler = SamplingProfiler(profile_interval) if profile_interval > 0 else None
+        # Messages for peers and clients that can't be reached right now, kept on disk until delivered
+        self.store = MessageStore(store_dir) if store_dir else None
+        self.forwarding = {}  # Outgoing log name -> the session delivering it
+        self.forward_timers = {}  # Outgoing log name -> scheduled retry
+        self.forward_backoff = {}  # Outgoing log name -> delay of its next retry
+        self.store_sync_timer = None  # Pending flush of the store
+        # Chats that can be resumed without asking the client again, kept in ticket_file across restarts if given
+        self.tickets = TicketCache(ticket_file)
+        self.ticket_sync_timer = None
+        # Where users are found by name: the directory server, and the users it told us about
+        self.directory_addr = directory
+        self.peers = PeerCache()  # username -> address of its daemon, LRU with TTL
+        self.lookups = {}  # username -> Lookup the directory hasn't answered yet
+        self.unregistered = set()  # Local users whose registration the directory hasn't confirmed
+        self.register_timer = None
+        self.rooms = {}  # (hub address or None if hosted here, room name) -> Room
+        # Room messages go to this multicast group (group, port) once, for the member daemons listening to it
+        self.multicast = multicast
+        self.multicast_socket = None
+        if multicast is not None:
+            self.multicast_socket = open_multicast_socket(self.ip, *multicast)
+            enable_multicast(self.daemon_socket, self.ip)
+        self.unix_server = None  # Serves AF_UNIX clients and their shared memory rings
+        if transport != "udp":
+            self.unix_server = UnixServer(self.client_socket, self.retransmit.call_later)
+        # The client thread, the daemon thread and the timer thread all change sessions
+        self.lock = threading.RLock()
+
+    def open_sockets(self):
+        """
+        Opens the socket other daemons talk to and the one clients talk to.
+        """
+        return open_udp_socket(self.ip, self.daemon_port), open_daemon_socket(self.transport, self.ip, self.client_port)
+
+    def client_bound(self, client):
+        """
+        Called when a client gets a session (it starts a chat or is asked for one).
+        """
+
+    def client_released(self, client):
+        """
+        Called when a client leaves its session.
+        """
+
+    def initial_turn(self):
         # Initialize has_turn based on port number to prevent deadlock
-        self.has_turn = self.daemon_port < self.client_port  # One daemon starts with turn
-        self.last_received_seq = -1  # Track last received sequence number
+        return self.daemon_port < self.client_port  # One daemon starts with turn
 
-        self.is_busy = False
-    
-   
-    def send_with_stop_and_wait(self, datagram, target_addr):
-        while True:
-            self.daemon_socket.sendto(datagram, target_addr)
-            start_time = time.time()
-            while time.time() - start_time < TIMEOUT:
-                if self.waiting_for_response == False:  # Set when ACK is received
-                    return  # ACK received, exit
-            print("Timeout! Retransmitting...")
+    def control_datagram(self, operation, seq_num, username, payload=""):
+        if not payload:
+            return self.datagram.control_frame(operation, seq_num, username or "")  # Prebuilt, cached
+        return self.datagram.create_datagram(
+            0x01,  # Control datagram
+            operation,
+            seq_num,
+            username or "",
+            payload
+        )
+
+    def session_datagram(self, session, msg_type, operation, seq_num, payload=b""):
+        """
+        Builds a datagram of a session: with the compact header once both daemons agreed on the
+        wire format version 2 (the peer's id for the session instead of our username), with the
+        full header otherwise. Control frames without payload come from the cache.
+        """
+        if session.peer_id is None:
+            if msg_type == 0x01:
+                return self.control_datagram(operation, seq_num, session.client.username, payload)
+            return self.datagram.create_datagram(msg_type, operation, seq_num, session.client.username, payload)
+        if msg_type == 0x01 and not payload:
+            return self.datagram.compact_control_frame(operation, seq_num, session.peer_id)
+        return self.datagram.create_compact(msg_type, operation, seq_num, session.peer_id, payload)
+
+    def chat_datagram(self, session, msg_type, seq_num, payload, count=1):
+        """
+        Builds a chat, batch (of count messages) or fragment datagram. Chat and batch payloads are
+        compressed if the peer takes it and it pays off, a compressed batch starts with its number
+        of messages so its ACK can be counted without decompressing it. Fragments are compressed
+        as a whole message before they are cut (see fragment_message()).
+        """
+        operation = PLAIN
+        if session.compress and msg_type != 0x04:
+            compressed = compress_payload(payload)
+            if compressed is not None and msg_type == 0x03:
+                compressed = BATCH_ITEM.pack(count) + compressed
+            # Only if it is smaller with the count, so it fits wherever the plain payload fits
+            if compressed is not None and len(compressed) < len(payload):
+                if __debug__:
+                    self.metrics.compressed += 1
+                    self.metrics.compression_saved += len(payload) - len(compressed)
+                operation = COMPRESSED
+                payload = compressed
+        return self.session_datagram(session, msg_type, operation, seq_num, payload)
+
+    def plain_payload(self, view):
+        """
+        The payload of a received chat, batch or fragment datagram as the sending daemon packed it
+        (decompressed, without the message count of a compressed batch).
+        """
+        if view.operation != COMPRESSED:
+            return bytes(view.payload_bytes)  # A copy, the receive buffer is reused for the next datagram
+        payload = view.payload_bytes
+        if view.msg_type == 0x03:
+            payload = payload[BATCH_ITEM.size:]
+        return decompress_payload(payload, RECEIVE_BUFFER_SIZE)
+
+    def wire_options(self, session, options):
+        """
+        Adds our wire format version and our id for the session to the options of a SYN or SYN+ACK.
+        """
+        options['v'] = WIRE_VERSION
+        options['sid'] = session.local_id
+
+    def agree_version(self, session, options):
+        """
+        Takes the wire format version from the peer's SYN or SYN+ACK. Daemons that don't send one
+        talk version 1: full headers, ASCII and no compression.
+        """
+        if int(options.get('v', 1)) >= 2 and 'sid' in options:
+            session.version = WIRE_VERSION
+            session.peer_id = int(options['sid'])
+            session.compress = self.compression
+
+    def send_to_daemon(self, datagram, addr):
+        if __debug__:
+            self.metrics.datagram_sent(datagram)
+        self.daemon_socket.sendto(datagram, addr)
+
+    def send_to_client(self, msg, addr):
+        if addr is None:
+            return  # Store-and-forward session, there is no client
+        self.send_client_bytes(self.encode_for_client(self.clients_by_addr.get(addr), msg), addr)
+
+    def encode_for_client(self, client, msg):
+        """
+        Encodes a message in the format the client connected with: binary or JSON. Unknown
+        addresses get JSON, which every client understands.
+        """
+        if client is not None and client.binary:
+            return encode_client_message(msg)
+        return encode_json_message(msg)
+
+    def send_client_bytes(self, data, addr):
+        if self.unix_server is not None:
+            self.unix_server.sendto(data, addr)  # Through the client's ring if it has one
+        else:
+            self.client_socket.sendto(data, addr)
+
+    def deliver_to_client(self, client, msg, droppable=False):
+        """
+        Sends a chat message, message_ack or chat_ended to a client. A client that gave credit at
+        connect only gets chat messages and stream chunks while it has credit left, the rest waits
+        in its queue (in order, message_acks coalesced) until it gives more. A droppable message (of
+        a room) is dropped if the queue is full, the client is told how many were. For chats the
+        queue doesn't fill up, the peer is told to wait (see session_credit()).
+        """
+        if client.credit is not None:
+            if client.queue or (client.credit <= 0 and msg['type'] in CREDITED_MESSAGES):
+                self.hold_for_client(client, msg, droppable)
+                return
+            if msg['type'] in CREDITED_MESSAGES:
+                client.credit -= 1
+        self.transmit_to_client(client, msg)
+
+    def transmit_to_client(self, client, msg):
+        """
+        Sends a message to a client now. If batching is on and the client takes batches, messages
+        arriving within batch_delay of each other go out as one datagram.
+        """
+        if not client.batching or self.batch_delay <= 0:
+            self.send_to_client(msg, client.addr)
+            return
+        self.queue_for_client(client, self.encode_for_client(client, msg))
+        if client.flush_timer is None:
+            client.flush_timer = self.retransmit.call_later(self.batch_delay, lambda: self.client_timer_fired(client))
+
+    def hold_for_client(self, client, msg, droppable):
+        """
+        Adds a message to the queue of a client that has no credit left.
+        """
+        queue = client.queue
+        if msg['type'] == 'message_ack' and queue and queue[-1]['type'] == 'message_ack':
+            count = queue[-1].get('count', 1) + msg.get('count', 1)
+            if count <= MAX_CLIENT_NUMBER:  # Else a new message_ack, the count has to fit the binary format
+                queue[-1]['count'] = count
+                return
+        if droppable and self.client_room(client) <= 0:
+            client.dropped += 1
+            if __debug__:
+                self.metrics.dropped += 1
+            return
+        queue.append(msg)
+        client.queued_bytes += queued_size(msg)
+
+    def grant_credit(self, client, credit):
+        """
+        Adds the credit a client gave back (for messages it handled) and sends what waited for it.
+        A client without flow control (anymore) gets the whole queue.
+        """
+        if client.credit is not None:
+            client.credit = min(client.credit + credit, MAX_CREDIT)
+        queue = client.queue
+        while queue and (client.credit is None or client.credit > 0 or queue[0]['type'] not in CREDITED_MESSAGES):
+            msg = queue.popleft()
+            client.queued_bytes -= queued_size(msg)
+            if client.credit is not None and msg['type'] in CREDITED_MESSAGES:
+                client.credit -= 1
+            self.transmit_to_client(client, msg)
+        if queue:
+            return
+        if client.dropped:
+            self.send_to_client({
+                'type': 'error',
+                'message': f'{client.dropped} room messages dropped, the client was too slow'
+            }, client.addr)
+            client.dropped = 0
+        if self.store is not None:
+            self.drain_stored(client)
+        session = client.session
+        if (session is not None and session.state == ESTABLISHED and session.windowed
+                and session.peer_credit is not None and self.session_credit(session) > 2 * session.advertised_credit):
+            self.send_to_daemon(self.window_ack(session), session.peer_addr)  # Window update, the peer may go on
+
+    def client_room(self, client):
+        """
+        Chat messages a client can still be given: its credit plus the free places in its queue.
+        """
+        if client.credit is None:
+            return MAX_CREDIT
+        if client.queued_bytes >= MAX_CLIENT_QUEUE_BYTES:
+            return client.credit
+        return client.credit + MAX_CLIENT_QUEUE - len(client.queue)
+
+    def session_credit(self, session):
+        """
+        The credit sent to the peer of a windowed session: the room of the client less the
+        datagrams the receive window holds back (after a gap). Stored messages go to disk.
+        """
+        if session.log is not None:
+            return MAX_CREDIT
+        room = self.client_room(session.client)
+        if session.windowed:
+            room -= len(session.receive_window.buffered)
+        return max(0, min(room, MAX_CREDIT))
+
+    def window_ack(self, session):
+        """
+        The ACK of a windowed session: cumulative ACK in the seq field, then the credit (if both
+        daemons sent one in the handshake) and the SACK bitmap.
+        """
+        cumulative, sack = session.receive_window.ack()
+        if session.peer_credit is not None:
+            session.advertised_credit = self.session_credit(session)
+            sack = CREDIT.pack(session.advertised_credit) + sack
+        return self.session_datagram(session, 0x01, 0x04, cumulative, sack)
+
+    def acknowledge_to_client(self, client, count):
+        """
+        Tells a client that count of its messages were delivered, in one message_ack if it knows
+        the count field (it gave credit) and one message_ack per message otherwise.
+        """
+        if client.credit is None:
+            for _ in range(count):
+                self.deliver_to_client(client, {
+                    'type': 'message_ack'
+                })
+        while count:
+            msg = {'type': 'message_ack'}
+            if count > 1:
+                msg['count'] = min(count, MAX_CLIENT_NUMBER)
+            self.deliver_to_client(client, msg)
+            count -= msg.get('count', 1)
+
+    def queue_for_client(self, client, data):
+        """
+        Adds an encoded message to the client's outbox, sending the outbox first if it would get too big.
+        """
+        if client.outbox_bytes + len(data) + 64 > CLIENT_BATCH_SIZE:
+            self.flush_client(client)
+        client.outbox.append(data)
+        client.outbox_bytes += len(data) + 1
+
+    def flush_client(self, client):
+        """
+        Sends everything in the client's outbox: a single message as it is, more as one 'batch'.
+        """
+        if client.flush_timer is not None:
+            client.flush_timer.cancel()
+            client.flush_timer = None
+        outbox, client.outbox, client.outbox_bytes = client.outbox, [], 0
+        if len(outbox) == 1:
+            self.send_client_bytes(outbox[0], client.addr)
+        elif client.binary:
+            self.send_client_bytes(encode_client_batch(outbox), client.addr)
+        elif outbox:
+            self.send_client_bytes(b'{"type": "batch", "messages": [' + b", ".join(outbox) + b"]}", client.addr)
+
+    def client_timer_fired(self, client):
+        with self.lock:
+            client.flush_timer = None
+            self.flush_client(client)
+
+    def send_reliable(self, session, datagram, max_retries=None, key=None):
+        """
+        Sends a datagram of a session and leaves it with the retransmit queue until the peer ACKs it.
+        The key defaults to (session, sequence number). Returns the PendingSend handle.
+        """
+        if key is None:
+            key = (session, datagram[2])
+        return self.retransmit.submit(key, datagram, session.peer_addr, session.estimator, max_retries)
+
+    def send_with_stop_and_wait(self, session, datagram, max_retries=None):
+        """
+        Sends a datagram and blocks until the peer ACKs its sequence number. Retransmissions are
+        scheduled by the retransmit queue with an adaptive timeout, the caller just sleeps on an event.
+        Returns True if the datagram was acknowledged.
+        """
+        return self.send_reliable(session, datagram, max_retries).wait()
+
+    def find_client(self, username):
+        """
+        Finds the local client a chat request is meant for: the named one, or any client that isn't
+        in a chat if the request doesn't name one. Returns None if that client is busy.
+        """
+        if username:
+            client = self.clients.get(username)
+            return client if client is not None and client.session is None else None
+        for client in self.clients.values():
+            if client.session is None:
+                return client
+        return None
+
+    def handshake_timed_out(self, pending):
+        """
+        Callback for a SYN that was never answered.
+        """
+        session = pending.key[0]
+        with self.lock:
+            if not pending.acked and session.state == CONNECTING:
+                print(f"No answer from daemon on port {session.peer_addr[1]}")
+                self.peers.invalidate(session.peer_username, session.peer_addr)
+                self.end_session(session)
+
+    def cancel_chat_sends(self, session):
+        """
+        Stops retransmitting the outstanding chat datagrams of a session.
+        """
+        if session.flush_timer is not None:
+            session.flush_timer.cancel()
+            session.flush_timer = None
+        self.retransmit.cancel((session, session.sequence_number))
+        session.fragments.clear()
+        if session.windowed:
+            for seq in range(session.send_window.base, session.send_window.next_seq):
+                self.retransmit.cancel((session, seq))
+
+    def end_session(self, session, notify=True):
+        """
+        Forgets a session, stops its retransmissions and tells its client (if it is still in it).
+        """
+        record = self.tickets.get(session.ticket)
+        if record is not None and session.state == ESTABLISHED:
+            record.update(session, self.tickets.lifetime)  # Where a resumed chat carries on
+            self.tickets_changed()
+        self.sessions.remove(session)
+        session.state = CLOSED
+        self.retransmit.cancel((session, 'syn'))
+        self.retransmit.cancel((session, 'synack'))
+        self.retransmit.cancel((session, 'fin'))
+        self.cancel_chat_sends(session)
+        self.reassembly.discard_session(session)
+        if session.log is not None and self.forwarding.get(session.log.name) is session:
+            self.forwarding_ended(session)
+        if session.client.session is session:
+            session.client.session = None
+            self.client_released(session.client)
+            self.flush_client(session.client)  # Messages still waiting in the outbox come first
+            if notify:
+                self.deliver_to_client(session.client, {
+                    'type': 'chat_ended'  # Behind the messages waiting for credit
+                })
+
+    def close_session(self, session):
+        """
+        Sends FIN for a session. The client is free right away, the session stays in the table
+        (CLOSING) until the FIN is acknowledged so the ACK can still be matched. The chat ends for
+        good, its ticket is dropped here and (quit=1) on the peer's daemon.
+        """
+        self.discard_ticket(session.ticket)
+        if session.client.session is session:
+            session.client.session = None
+            self.client_released(session.client)
+        session.state = CLOSING
+        self.retransmit.cancel((session, 'syn'))
+        self.retransmit.cancel((session, 'synack'))
+        self.cancel_chat_sends(session)
+        datagram = self.session_datagram(
+            session,
+            0x01,
+            0x08,  # FIN
+            session.sequence_number,
+            encode_options({'quit': 1}) if session.ticket else ""
+        )
+        pending = self.send_reliable(session, datagram, FIN_RETRIES, key=(session, 'fin'))
+        pending.add_done_callback(lambda pending: self.fin_done(session))
+
+    def fin_done(self, session):
+        with self.lock:
+            self.sessions.remove(session)
+
+    def start_chat(self, client, target_addr, target_username, window, early_data=None):
+        """
+        Sends the SYN of a chat the client starts with target_username (or whoever accepts) on the
+        daemon at target_addr. If we have a ticket of an earlier chat with that user, the SYN
+        resumes it, with early_data (the client's first message) if it fits. Otherwise early_data
+        is sent once the chat is established.
+        """
+        if client.session is not None or self.sessions.get(target_addr, target_username) is not None:
+            self.send_to_client({
+                'type': 'error',
+                'message': 'Already in a chat'
+            }, client.addr)
+            return
+        if self.sessions.full:
+            self.send_to_client({
+                'type': 'error',
+                'message': 'Too many chats on this daemon'
+            }, client.addr)
+            return
+
+        session = Session(target_addr, target_username, client, CONNECTING, self.initial_turn(), time.monotonic())
+        self.sessions.add(session)
+        client.session = session
+        self.client_bound(client)
+        session.early_data = early_data
+        options = {}
+        if target_username:
+            options['to'] = target_username
+        if window > 1:
+            options['window'] = window  # Ask for the sliding window mode
+            options['batch'] = 1  # We understand batch datagrams
+        options['resume'] = 1  # Give us a ticket
+        self.wire_options(session, options)
+        # We do flow control: how much the peer may send before our ACKs say more
+        session.advertised_credit = options['credit'] = min(self.client_room(client), MAX_CREDIT)
+        record = self.tickets.find(target_addr, target_username, client.username) if target_username else None
+        if record is not None:
+            # Resume instead of asking the peer's client, the peer falls back to a normal SYN if it can't
+            session.resuming = record
+            options.update(ticket=record.ticket, seq=record.send_seq, turn=int(record.has_turn))
+            if early_data:
+                options['data'] = encode_early_data(early_data)
+        payload = encode_options(options)
+        if len(payload) > self.max_payload:  # The first message doesn't fit, it waits for the handshake
+            options.pop('data', None)
+            payload = encode_options(options)
+        # Send SYN to start three-way handshake, it's answered by SYN+ACK or FIN
+        datagram = self.control_datagram(
+            0x02,  # SYN
+            session.sequence_number,
+            client.username,
+            payload
+        )
+        pending = self.send_reliable(session, datagram, SYN_RETRIES, key=(session, 'syn'))
+        pending.add_done_callback(self.handshake_timed_out)
+
+    def accept_session(self, session, options=None):
+        """
+        Sends SYN+ACK for a requested (or resumed) session with the options both sides agreed on,
+        and a new ticket if the peer asked for one.
+        """
+        session.state = ESTABLISHED
+        options = options or {}
+        if session.windowed:
+            options['window'] = session.send_window.size
+        if session.batching:
+            options['batch'] = 1
+        if session.resumable:
+            session.ticket = options['ticket'] = self.tickets.issue(session).ticket
+            self.tickets_changed()
+        if session.peer_credit is not None:
+            session.advertised_credit = options['credit'] = self.session_credit(session)
+        if session.version >= 2:
+            self.wire_options(session, options)
+        datagram = self.control_datagram(
+            0x06,  # SYN+ACK because of bitwise or 0x02 │ 0x04 = 0x06
+            session.sequence_number,
+            session.client.username,
+            encode_options(options)
+        )
+        self.send_reliable(session, datagram, SYN_RETRIES, key=(session, 'synack'))
+
+    def send_expired(self, pending):
+        """
+        Called by the retransmit queue for a datagram it gave up on. A chat datagram (or SYN+ACK)
+        that is never acknowledged means the peer is gone, so the chat ends instead of retransmitting
+        forever.
+        """
+        session, seq = pending.key
+        if isinstance(seq, int) or seq == 'synack':
+            with self.lock:
+                if session.state == ESTABLISHED:
+                    self.peer_unreachable(session)
+
+    def peer_unreachable(self, session):
+        """
+        Ends a chat whose peer stopped answering. With a store, the messages the peer didn't
+        acknowledge are kept and delivered once it is back.
+        """
+        message = 'Peer unreachable'
+        if self.store is not None and session.log is None:
+            messages = self.unacked_messages(session)
+            if messages:
+                name = outgoing_log_name(session.peer_addr, session.peer_username, session.client.username)
+                log = self.store.log(name)
+                for data in messages:
+                    log.append(data)
+                self.store_changed()
+                self.schedule_forward(name)
+                message = f'Peer unreachable, {len(messages)} messages stored'
+        self.peers.invalidate(session.peer_username, session.peer_addr)
+        self.send_to_client({
+            'type': 'error',
+            'message': message
+        }, session.client.addr)
+        self.end_session(session)
+
+    def unacked_messages(self, session):
+        """
+        The chat messages of a session the peer didn't acknowledge, in order and encoded (UTF-8,
+        not compressed): the ones in datagrams waiting for their ACK, the rest of a message that is
+        being fragmented and the queued ones. Streams, and messages of which the peer already has
+        the first fragments, are left out.
+        """
+        if session.windowed:
+            keys = [(session, seq) for seq in range(session.send_window.base, session.send_window.next_seq)]
+        else:
+            keys = [(session, session.sequence_number)]
+        items = []
+        for key in keys:
+            pending = self.retransmit.pending.get(key)
+            if pending is not None:
+                view = self.datagram.view(pending.datagram)
+                items.append((view.msg_type, self.plain_payload(view)))
+        items.extend((0x04, fragment) for fragment in session.fragments)
+        messages = []
+        parts = {}  # Message id -> fragments, only for messages whose first fragment is here
+        for msg_type, payload in items:
+            if msg_type == 0x02:
+                messages.append(payload)
+            elif msg_type == 0x03:
+                messages.extend(message.encode('utf-8') for message in decode_batch(payload))
+            elif msg_type == 0x04:
+                message_id, offset, flags, data = parse_fragment(payload)
+                if flags & FRAGMENT_STREAM:
+                    continue
+                if offset == 0:
+                    parts[message_id] = [bytes(data)]
+                elif message_id in parts:
+                    parts[message_id].append(bytes(data))
+                if flags & FRAGMENT_END and message_id in parts:
+                    message = b"".join(parts.pop(message_id))
+                    if flags & FRAGMENT_COMPRESSED:
+                        message = decompress_payload(message, MAX_MESSAGE_SIZE)
+                    messages.append(message)
+        if session.windowed:
+            messages.extend(session.send_window.queue)
+        return messages
+
+    def schedule_forward(self, name, delay=None):
+        """
+        Tries to deliver the messages of an outgoing log after delay seconds, by default the log's
+        backoff (doubled after every try the peer didn't answer).
+        """
+        if name in self.forwarding or name in self.forward_timers:
+            return
+        if delay is None:
+            delay = self.forward_backoff.get(name, FORWARD_RETRY_INTERVAL)
+        self.forward_timers[name] = self.retransmit.call_later(delay, lambda: self.forward_timer_fired(name))
+
+    def forward_timer_fired(self, name):
+        with self.lock:
+            if self.forward_timers.pop(name, None) is not None:
+                self.start_forwarding(name)
+
+    def peer_seen(self, addr):
+        """
+        A daemon we have stored messages for sent a SYN, so it's back: deliver them right away
+        instead of at the next retry.
+        """
+        for name in list(self.forward_timers):
+            if parse_log_name(name)[1] == addr:
+                self.forward_timers.pop(name).cancel()
+                self.forward_backoff.pop(name, None)
+                self.schedule_forward(name, 0)  # After this datagram, which may open a session with the same key
+
+    def start_forwarding(self, name):
+        """
+        Opens a session that delivers the messages of an outgoing log: a windowed chat without a
+        client, whose SYN asks the peer daemon to store the messages for its user.
+        """
+        log = self.store.logs.get(name)
+        if log is None or not len(log) or name in self.forwarding:
+            return
+        _, peer_addr, peer_username, username = parse_log_name(name)
+        if self.sessions.get(peer_addr, peer_username) is not None or self.sessions.full:
+            self.schedule_forward(name)  # A chat with the same user is going on (or no room for one), try again later
+            return
+        session = Session(peer_addr, peer_username, LocalClient(username, None), CONNECTING, self.initial_turn(),
+                          time.monotonic())
+        session.log = log
+        session.log_next = log.cursor
+        self.sessions.add(session)
+        self.forwarding[name] = session
+        options = {'to': peer_username, 'window': MAX_WINDOW, 'batch': 1, 'store': 1}
+        self.wire_options(session, options)
+        datagram = self.control_datagram(
+            0x02,  # SYN
+            session.sequence_number,
+            username,
+            encode_options(options)
+        )
+        pending = self.send_reliable(session, datagram, SYN_RETRIES, key=(session, 'syn'))
+        pending.add_done_callback(self.handshake_timed_out)
+
+    def forwarding_ended(self, session):
+        """
+        A forwarding session broke off. The rest of its log is tried again later, each time the
+        peer doesn't answer twice as late.
+        """
+        name = session.log.name
+        del self.forwarding[name]
+        if len(session.log):
+            delay = self.forward_backoff.get(name, FORWARD_RETRY_INTERVAL)
+            self.forward_backoff[name] = min(delay * 2, FORWARD_RETRY_MAX)
+            self.schedule_forward(name, delay)
+
+    def pump_forward(self, session):
+        """
+        Sends the next burst of stored messages, or closes the session once the log is delivered.
+        A peer of the wire format version 1 only takes ASCII, other messages for it are dropped.
+        """
+        log = session.log
+        records = list(log.pending(session.log_next, FORWARD_BURST))
+        if not records:
+            del self.forwarding[log.name]
+            self.close_session(session)
+            return
+        sent = 0
+        for _, record in records:
+            record = bytes(record)
+            if session.version < 2 and not record.isascii():
+                print(f"Dropped a stored message for {session.peer_username}, its daemon only takes ASCII")
+                continue
+            self.send_windowed(session, record)
+            sent += 1
+        session.log_next = records[-1][0] + 1
+        session.log_unacked = sent
+        if not sent:
+            self.forward_acked(session, 0)
+
+    def forward_acked(self, session, delivered):
+        """
+        Counts stored messages the peer acknowledged. Once a whole burst is, the log is
+        acknowledged up to its end and the next burst goes out, so a session that breaks off
+        sends at most one burst again.
+        """
+        session.log_unacked -= delivered
+        if session.log_unacked <= 0 and session.state == ESTABLISHED:
+            session.log.ack(session.log_next - 1)
+            self.store_changed()
+            self.pump_forward(session)
+
+    def accept_stored(self, addr, username, options, now):
+        """
+        Accepts a store-and-forward session from another daemon without asking a client: the
+        messages for our user options['to'] are stored until that user is connected.
+        """
+        session = Session(addr, username, LocalClient(options['to'], None), REQUESTED, self.initial_turn(), now)
+        limit = self.window if self.window > 1 else MAX_WINDOW
+        session.use_window(min(int(options.get('window', 0)), limit))
+        session.batching = session.windowed and options.get('batch') == '1'
+        session.log = self.store.log(incoming_log_name(options['to']))
+        self.agree_version(session, options)
+        self.sessions.add(session)
+        self.accept_session(session)
+
+    def deliver_message(self, session, msg):
+        """
+        Gives a received chat message to the session's client. Messages of a store-and-forward
+        session go to the store, or straight to their user if it's connected and nothing older
+        is waiting for it (and it has room).
+        """
+        if session.log is None:
+            self.deliver_to_client(session.client, msg)
+            return
+        client = self.clients.get(session.client.username)
+        if client is not None and not len(session.log) and self.client_room(client) > 0:
+            self.deliver_to_client(client, msg)
+            return
+        session.log.append(encode_stored_message(msg['from'], msg['message'].encode('utf-8')))
+        self.store_changed()
+
+    def drain_stored(self, client):
+        """
+        Sends a client the messages stored for it, DRAIN_CHUNK at a time (in as few datagrams as
+        the client takes) so the daemon isn't held up, until none are left. A client with flow
+        control gets as many as its credit allows, the rest when it gives more.
+        """
+        log = self.store.logs.get(incoming_log_name(client.username))
+        limit = DRAIN_CHUNK if client.credit is None else min(DRAIN_CHUNK, client.credit)
+        if log is None or not len(log) or limit <= 0 or client.queue:
+            return
+        last = None
+        for record_id, record in log.pending(limit=limit):
+            sender, message = decode_stored_message(record)
+            msg = {
+                'type': 'chat_message',
+                'from': sender,
+                'message': str(message, 'utf-8')
+            }
+            if client.batching:
+                self.queue_for_client(client, self.encode_for_client(client, msg))
+            else:
+                self.send_to_client(msg, client.addr)
+            last = record_id
+            if client.credit is not None:
+                client.credit -= 1
+        self.flush_client(client)
+        log.ack(last)
+        self.store_changed()
+        if len(log) and client.credit != 0:
+            self.retransmit.call_later(0, lambda: self.drain_timer_fired(client))
+
+    def drain_timer_fired(self, client):
+        with self.lock:
+            if self.clients.get(client.username) is client:
+                self.drain_stored(client)
+
+    def start_store(self):
+        """
+        Starts delivering the stored messages left over from the last run.
+        """
+        if self.store is not None:
+            for name, _ in self.store.pending_logs("out"):
+                self.schedule_forward(name, 0)
+
+    def store_changed(self):
+        """
+        Schedules writing the store to disk, everything changed until then is flushed at once.
+        """
+        if self.store_sync_timer is None:
+            self.store_sync_timer = self.retransmit.call_later(STORE_SYNC_INTERVAL, self.store_timer_fired)
+
+    def store_timer_fired(self):
+        with self.lock:
+            self.store_sync_timer = None
+            self.store.sync()
+
+    def tickets_changed(self):
+        """
+        Schedules writing the tickets to the ticket file (if there is one), like store_changed().
+        """
+        if self.tickets.path is not None and self.ticket_sync_timer is None:
+            self.ticket_sync_timer = self.retransmit.call_later(TICKET_SYNC_INTERVAL, self.ticket_timer_fired)
+
+    def ticket_timer_fired(self):
+        with self.lock:
+            self.ticket_sync_timer = None
+            self.tickets.save()
+
+    def discard_ticket(self, ticket):
+        record = self.tickets.get(ticket)
+        if record is not None:
+            self.tickets.discard(record)
+            self.tickets_changed()
+
+    def resume_session(self, addr, username, options, now):
+        """
+        Resumes the chat of the ticket in a peer's SYN: the client isn't asked, the sequence numbers
+        carry on from where each side says it is, and the first message (options['data']) is
+        delivered right away. Returns False if the ticket can't be used, then the SYN is handled
+        as a new chat.
+        """
+        record = self.tickets.take(options['ticket'])  # Used once, whatever happens
+        client = self.find_client(options.get('to'))
+        if (record is None or record.key != (addr, username, options.get('to')) or client is None
+                or self.sessions.full):
+            if record is not None:
+                self.tickets_changed()
+            if __debug__:
+                self.metrics.resumptions['refused'] += 1
+            return False
+        if __debug__:
+            self.metrics.resumptions['resumed'] += 1
+        early_data = decode_early_data(options['data']) if 'data' in options else None
+        # The peer keeps its turn, unless it used it for the first message
+        has_turn = early_data is not None or options.get('turn') != '1'
+        session = Session(addr, username, client, REQUESTED, has_turn, now)
+        session.restore(record.window, record.batching, record.send_seq,
+                        int(options.get('seq', 0)) + (early_data is not None))
+        session.resumable = True
+        session.peer_credit = int(options['credit']) if 'credit' in options else None
+        self.agree_version(session, options)
+        self.sessions.add(session)
+        client.session = session
+        self.client_bound(client)
+        answer = {'resumed': 1, 'seq': record.send_seq}
+        if early_data is not None:
+            answer['early'] = 1
+        self.accept_session(session, answer)
+        self.send_to_client({
+            'type': 'chat_started',
+            'with': username,
+            'resumed': True
+        }, client.addr)
+        if early_data is not None:
+            self.deliver_message(session, {
+                'type': 'chat_message',
+                'from': username,
+                'message': early_data
+            })
+        return True
+
+    def send_to_directory(self, operation, username=""):
+        self.send_to_daemon(self.datagram.create_datagram(DIRECTORY, operation, 0, username, ""), self.directory_addr)
+
+    def register_user(self, username):
+        """
+        Tells the directory that a user is connected here, again every DIRECTORY_RETRY seconds
+        until the directory confirms it.
+        """
+        self.unregistered.add(username)
+        self.send_to_directory(REGISTER, username)
+        if self.register_timer is None:
+            self.register_timer = self.retransmit.call_later(DIRECTORY_RETRY, self.register_timer_fired)
+
+    def register_timer_fired(self):
+        with self.lock:
+            self.register_timer = None
+            for username in list(self.unregistered):
+                self.register_user(username)
+
+    def start_directory(self):
+        """
+        Starts refreshing the lease of our users at the directory, if there is one.
+        """
+        if self.directory_addr is not None:
+            self.retransmit.call_later(DIRECTORY_REFRESH, self.refresh_timer_fired)
+
+    def refresh_timer_fired(self):
+        with self.lock:
+            if self.clients:
+                self.send_to_directory(REFRESH)  # One datagram for all users, however many there are
+            self.retransmit.call_later(DIRECTORY_REFRESH, self.refresh_timer_fired)
+
+    def resolve_peer(self, client, username, window, early_data=None):
+        """
+        Starts a chat with a user on whatever daemon it is connected to, found in the peer cache
+        or asked from the directory. Clients that want the same user wait for the same lookup.
+        """
+        peer_addr = self.peers.get(username, time.monotonic())
+        if peer_addr is not None:
+            self.start_chat(client, peer_addr, username, window, early_data)
+            return
+        lookup = self.lookups.get(username)
+        if lookup is None:
+            lookup = self.lookups[username] = Lookup(username)
+            self.send_lookup(lookup)
+        lookup.waiting.append((client, window, early_data))
+
+    def send_lookup(self, lookup):
+        lookup.tries += 1
+        self.send_to_directory(LOOKUP, lookup.username)
+        lookup.timer = self.retransmit.call_later(DIRECTORY_RETRY, lambda: self.lookup_timed_out(lookup))
+
+    def lookup_timed_out(self, lookup):
+        with self.lock:
+            if self.lookups.get(lookup.username) is not lookup:
+                return
+            if lookup.tries < LOOKUP_RETRIES:
+                self.send_lookup(lookup)
+            else:
+                self.lookup_done(lookup.username, None, 'Directory unreachable')
+
+    def lookup_done(self, username, peer_addr, error=None):
+        """
+        Starts the chats that waited for a lookup, or tells their clients why there is none.
+        """
+        lookup = self.lookups.pop(username, None)
+        if lookup is None:
+            return  # Answer to a lookup that was retransmitted
+        lookup.timer.cancel()
+        for client, window, early_data in lookup.waiting:
+            if peer_addr is not None:
+                self.start_chat(client, peer_addr, username, window, early_data)
+            else:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': error
+                }, client.addr)
+
+    def directory_datagram(self, view, now):
+        """
+        Handles an answer of the directory.
+        """
+        operation, username = view.operation, view.username
+        if operation == REGISTERED:
+            self.unregistered.discard(username)
+        elif operation == FOUND:
+            peer_addr, ttl = parse_found(view.payload)
+            self.peers.put(username, peer_addr, now, ttl)
+            self.lookup_done(username, peer_addr)
+        elif operation == NOT_FOUND:
+            self.lookup_done(username, None, 'Unknown user')
+        elif operation == UNKNOWN:  # The directory lost our users (e.g. it was restarted)
+            for username in self.clients:
+                self.register_user(username)
+
+    def send_to_room(self, room, operation, payload=b"", addr=None):
+        self.send_to_daemon(self.datagram.create_datagram(GROUP, operation, 0, room.name, payload),
+                            addr or room.hub_addr)
+
+    def join_room(self, client, name, target_port):
+        """
+        Puts a client into a room: one hosted here (no target_port), or the room of the daemon on
+        target_port, which this daemon joins for all its clients in the room.
+        """
+        if not name or not name.isascii() or len(name) > MAX_USERNAME_LENGTH:
+            error = f'Room names are ASCII, at most {MAX_USERNAME_LENGTH} characters'
+        elif name in client.rooms:
+            error = 'Already in that room'
+        elif target_port and parse_port(target_port) is None:
+            error = 'Invalid target_port'
+        else:
+            error = None
+        if error is not None:
+            self.send_to_client({
+                'type': 'error',
+                'message': error
+            }, client.addr)
+            return
+        hub_addr = None
+        if target_port and parse_port(target_port) != self.daemon_port:
+            hub_addr = (self.ip, parse_port(target_port))
+        room = self.rooms.get((hub_addr, name))
+        if room is None:
+            room = self.rooms[(hub_addr, name)] = Room(name, hub_addr)
+            if hub_addr is not None:
+                options = {'mcast': f"{self.multicast[0]}:{self.multicast[1]}"} if self.multicast else {}
+                datagram = self.datagram.create_datagram(GROUP, JOIN, 0, name, encode_options(options))
+                pending = self.retransmit.submit((room, 'join'), datagram, hub_addr, room.estimator, SYN_RETRIES)
+                pending.add_done_callback(self.join_timed_out)
+        room.clients.append(client)
+        client.rooms[name] = room
+        if room.hosted or room.joined:
+            self.send_to_client({
+                'type': 'room_joined',
+                'room': name
+            }, client.addr)
+
+    def join_timed_out(self, pending):
+        room = pending.key[0]
+        with self.lock:
+            if not pending.acked and not room.joined and self.rooms.get(room.key) is room:
+                self.drop_room(room, 'No answer from room host')
+
+    def leave_room(self, client, name):
+        room = client.rooms.pop(name, None)
+        if room is None:
+            return
+        room.clients.remove(client)
+        if room.clients:
+            return
+        if not room.hosted:
+            self.drop_room(room)
+            self.send_to_room(room, LEAVE)  # Not retransmitted, the hub drops members that stop answering anyway
+        elif not room.members:
+            self.drop_room(room)
+
+    def drop_room(self, room, error=None):
+        """
+        Forgets a room and takes its clients out of it, telling them why if error is given.
+        """
+        del self.rooms[room.key]
+        if room.timer is not None:
+            room.timer.cancel()
+            room.timer = None
+        self.retransmit.cancel((room, 'join'))
+        self.retransmit.cancel((room, 'post'))
+        for client in room.clients:
+            client.rooms.pop(room.name, None)
+            if error is not None:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': error
+                }, client.addr)
+        room.clients = []
+
+    def room_message(self, client, name, message):
+        """
+        Sends a client's message to everybody in a room: published right away in a room hosted
+        here, posted to the hub otherwise.
+        """
+        room = client.rooms.get(name)
+        item = encode_group_items([(client.username, message)]) if room is not None else b""
+        if room is None:
+            error = 'Not in that room'
+        elif GROUP_SEQ.size + len(item) > self.max_payload:
+            error = 'Message too long'  # Room messages aren't fragmented
+        elif len(room.unacked) >= MAX_GROUP_BACKLOG or len(room.posts) >= MAX_SEND_QUEUE:
+            error = 'Room is busy'
+        else:
+            if room.hosted:
+                self.publish(room, item)
+                self.deliver_to_client(client, {
+                    'type': 'message_ack'
+                })
+            else:
+                room.posts.append((client, item))
+                self.flush_posts(room)
+            return
+        self.send_to_client({
+            'type': 'error',
+            'message': error
+        }, client.addr)
+
+    def flush_posts(self, room):
+        """
+        Posts the waiting messages of a room to its hub, as many as fit into one datagram. There is
+        one POST in flight per room, the next one goes out when the hub acknowledged it.
+        """
+        if room.posting or not room.posts or not room.joined:
+            return
+        items = []
+        size = GROUP_SEQ.size
+        while room.posts and (not items or size + len(room.posts[0][1]) <= self.max_payload):
+            client, item = room.posts.popleft()
+            room.posting.append(client)
+            items.append(item)
+            size += len(item)
+        room.post_id = (room.post_id + 1) & 0xFFFFFFFF
+        datagram = self.datagram.create_datagram(GROUP, POST, 0, room.name,
+                                                 GROUP_SEQ.pack(room.post_id) + b"".join(items))
+        pending = self.retransmit.submit((room, 'post'), datagram, room.hub_addr, room.estimator, CHAT_RETRIES)
+        pending.add_done_callback(self.post_timed_out)
+
+    def post_timed_out(self, pending):
+        room = pending.key[0]
+        with self.lock:
+            if not pending.acked and self.rooms.get(room.key) is room and room.posting:
+                self.drop_room(room, 'Room host unreachable')
+
+    def publish(self, room, items):
+        """
+        Sends items (encoded once) to every member daemon of a room hosted here and gives them to
+        the local clients in it.
+        """
+        datagram = self.datagram.create_datagram(GROUP, PUBLISH, 0, room.name,
+                                                 GROUP_SEQ.pack(room.next_seq & 0xFFFFFFFF) + items)
+        message = room.publish(datagram, time.monotonic())
+        if message is not None:
+            self.fan_out(room, datagram, message.pending)
+            self.schedule_room(room)
+        self.deliver_to_room(room, [items])
+
+    def fan_out(self, room, datagram, pending, retransmission=False):
+        """
+        Sends a datagram to the member daemons whose bit is set in pending: one copy to the multicast
+        group for all that listen to it (not for retransmissions, which only go to the laggards),
+        one each to the others.
+        """
+        if not retransmission and pending & ~room.unicast:
+            self.send_to_daemon(datagram, self.multicast)
+            pending &= room.unicast
+        for bit in bits_of(pending):
+            self.send_to_daemon(datagram, room.by_bit[bit].addr)
+
+    def deliver_to_room(self, room, batches):
+        """
+        Gives published items to the local clients of a room. A client doesn't get its own messages.
+        """
+        for items in batches:
+            for sender, message in decode_group_items(items):
+                msg = {
+                    'type': 'chat_message',
+                    'from': f"{sender}@{room.name}",
+                    'message': message
+                }
+                for client in room.clients:
+                    if client.username != sender:
+                        self.deliver_to_client(client, msg, droppable=True)
+
+    def schedule_room(self, room):
+        if room.timer is None and room.unacked:
+            delay = max(room.next_deadline() - time.monotonic(), 0)
+            room.timer = self.retransmit.call_later(delay, lambda: self.room_timer_fired(room))
+
+    def room_timer_fired(self, room):
+        """
+        Sends the messages of a room again to the members that didn't acknowledge them in time.
+        A member that misses GROUP_RETRIES retransmissions is dropped from the room.
+        """
+        with self.lock:
+            room.timer = None
+            if self.rooms.get(room.key) is not room:
+                return
+            for message in room.due(time.monotonic()):
+                if message.retries > GROUP_RETRIES:
+                    for bit in list(bits_of(message.pending)):
+                        self.drop_member(room, room.by_bit[bit].addr)
+                    if self.rooms.get(room.key) is not room:
+                        return
+                    continue
+                if __debug__:
+                    self.metrics.group_retransmissions += bin(message.pending).count("1")
+                self.fan_out(room, message.datagram, message.pending, True)
+            self.schedule_room(room)
+
+    def drop_member(self, room, addr, notify=True):
+        if room.remove_member(addr) is not None and notify:
+            self.send_to_room(room, LEFT, addr=addr)
+        if not room.members and not room.clients:
+            self.drop_room(room)
+
+    def group_datagram(self, view, addr, now):
+        """
+        Handles a datagram about a room: from a member daemon to us as hub, or from the hub of a
+        room we joined (directly or through the multicast group).
+        """
+        operation, name = view.operation, view.username
+        if operation in (JOIN, LEAVE, POST, GROUP_ACK):  # We are the hub
+            room = self.rooms.get((None, name))
+            member = room.members.get(addr) if room is not None else None
+            if operation == JOIN:
+                if room is None:
+                    room = self.rooms[(None, name)] = Room(name)
+                if member is None and len(room.members) >= MAX_GROUP_MEMBERS:
+                    self.send_to_room(room, LEFT, addr=addr)  # Full
+                    return
+                mcast = parse_options(view.payload).get('mcast')
+                multicast = mcast is not None and parse_multicast_addr(mcast) == self.multicast
+                member = room.add_member(addr, multicast)
+                self.send_to_room(room, JOINED, encode_options({'seq': member.first_seq}), addr)
+            elif member is None:
+                if operation != LEAVE and room is not None:
+                    self.send_to_room(room, LEFT, addr=addr)  # Not a member (anymore), e.g. dropped as a laggard
+            elif operation == LEAVE:
+                self.drop_member(room, addr, notify=False)
+            elif operation == POST:
+                payload = view.payload_bytes
+                (post_id,) = GROUP_SEQ.unpack_from(payload)
+                if post_id != member.last_post:
+                    if len(room.unacked) >= MAX_GROUP_BACKLOG:
+                        return  # Not acknowledged, so the member daemon sends it again later
+                    member.last_post = post_id
+                    self.publish(room, bytes(payload[GROUP_SEQ.size:]))
+                self.send_to_room(room, POSTED, GROUP_SEQ.pack(post_id), addr)
+            else:
+                next_seq, sack = GROUP_ACK_PAYLOAD.unpack_from(view.payload_bytes)
+                room.acknowledge(member, next_seq, sack, now)
+            return
+
+        room = self.rooms.get((addr, name))  # We are a member daemon, addr is the hub
+        if room is None:
+            return
+        if operation == PUBLISH:
+            if not room.joined:
+                return  # Sent again once we know where the room starts
+            payload = view.payload_bytes
+            (seq,) = GROUP_SEQ.unpack_from(payload)
+            self.deliver_to_room(room, room.receive(seq, bytes(payload[GROUP_SEQ.size:])))
+            self.send_to_room(room, GROUP_ACK, room.ack_payload())
+        elif operation == JOINED:
+            if room.joined:
+                return
+            self.retransmit.acknowledge((room, 'join'))
+            room.joined = True
+            room.expected = int(parse_options(view.payload).get('seq', 0))
+            for client in room.clients:
+                self.send_to_client({
+                    'type': 'room_joined',
+                    'room': name
+                }, client.addr)
+            self.flush_posts(room)
+        elif operation == POSTED:
+            (post_id,) = GROUP_SEQ.unpack_from(view.payload_bytes)
+            if room.posting and post_id == room.post_id:
+                self.retransmit.acknowledge((room, 'post'))
+                posting, room.posting = room.posting, []
+                for client in posting:
+                    self.deliver_to_client(client, {
+                        'type': 'message_ack'
+                    })
+                self.flush_posts(room)
+        elif operation == LEFT:
+            self.drop_room(room, 'Room is full' if not room.joined else 'Removed from room')
+
+    def send_windowed(self, session, message):
+        """
+        Sends a chat message (UTF-8 encoded) in the windowed mode, or queues it while the window is
+        full. With batching, a message is only sent right away if nothing is in flight or a full batch
+        is waiting (like Nagle's algorithm), otherwise it waits up to batch_delay for more.
+        """
+        window = session.send_window
+        if len(window.queue) >= MAX_SEND_QUEUE:
+            self.send_to_client({
+                'type': 'error',
+                'message': 'Send queue full'
+            }, session.client.addr)
+            return
+        window.queue.append(message)
+        window.queued_bytes += BATCH_ITEM.size + len(message)
+        if (not session.batching or self.batch_delay <= 0 or window.in_flight == 0
+                or window.queued_bytes >= self.batch_size):
+            self.flush_window(session)
+        elif session.flush_timer is None:
+            session.flush_timer = self.retransmit.call_later(self.batch_delay, lambda: self.window_timer_fired(session))
+
+    def send_stream_chunk(self, session, data, last):
+        """
+        Sends one chunk of a stream (windowed mode only). The chunks of a stream share a message id
+        and are cut into fragments right away, the receiving daemon forwards them chunk by chunk.
+        Every chunk is compressed on its own (if it gets smaller), so the offsets count the bytes
+        that were sent.
+        """
+        if session.stream_id is None:
+            session.stream_id = self.next_message_id(session)
+            session.stream_offset = 0
+        flags = FRAGMENT_STREAM | FRAGMENT_END | (FRAGMENT_LAST if last else 0)
+        data, compressed = self.compress_message(session, data)
+        if compressed:
+            flags |= FRAGMENT_COMPRESSED
+        session.fragments.extend(split_fragments(session.stream_id, data, session.stream_offset, self.max_payload,
+                                                 flags))
+        session.stream_offset += len(data)
+        if last:
+            session.stream_id = None
+        self.flush_window(session)
+
+    def next_message_id(self, session):
+        session.next_message_id = (session.next_message_id + 1) & 0xFFFFFFFF
+        return session.next_message_id
+
+    def fragment_message(self, session, message):
+        """
+        Cuts a chat message (UTF-8 encoded) that doesn't fit into one datagram into fragment
+        payloads, compressed first if the peer takes it.
+        """
+        flags = FRAGMENT_END | FRAGMENT_LAST
+        message, compressed = self.compress_message(session, message)
+        if compressed:
+            flags |= FRAGMENT_COMPRESSED
+        return split_fragments(self.next_message_id(session), message, 0, self.max_payload, flags)
+
+    def compress_message(self, session, data):
+        """
+        Compresses a message or stream chunk that is going to be fragmented, if the peer takes it.
+        Returns the data to send and whether it is compressed.
+        """
+        if not session.compress:
+            return data, False
+        compressed = compress_payload(data)
+        if compressed is None:
+            return data, False
+        if __debug__:
+            self.metrics.compressed += 1
+            self.metrics.compression_saved += len(data) - len(compressed)
+        return compressed, True
+
+    def flush_window(self, session):
+        """
+        Sends queued messages while the window has room. In a batching session the queued messages
+        are packed into as few datagrams as batch_size allows, messages bigger than a datagram are
+        sent as fragments. Once the peer's client has no credit left only one datagram is in flight,
+        its retransmissions ask for new credit.
+        """
+        if session.flush_timer is not None:
+            session.flush_timer.cancel()
+            session.flush_timer = None
+        window = session.send_window
+        while window.can_send() and (session.peer_credit is None or session.credit_in_flight < session.peer_credit
+                                     or window.in_flight == 0):
+            if session.fragments:  # Finish the message (or stream chunk) that is being fragmented first
+                self.transmit_windowed(session, 0x04, session.fragments.popleft())
+                continue
+            if not window.queue:
+                break
+            messages = [window.queue.popleft()]
+            size = BATCH_ITEM.size + len(messages[0])
+            if len(messages[0]) > self.max_payload:
+                window.queued_bytes -= size
+                session.fragments.extend(self.fragment_message(session, messages[0]))
+                continue
+            if session.batching:
+                while window.queue and size + BATCH_ITEM.size + len(window.queue[0]) <= self.batch_size:
+                    messages.append(window.queue.popleft())
+                    size += BATCH_ITEM.size + len(messages[-1])
+            window.queued_bytes -= size
+            if len(messages) == 1:
+                self.transmit_windowed(session, 0x02, messages[0])  # Chat datagram
+            else:
+                self.transmit_windowed(session, 0x03, encode_batch(messages), len(messages))  # Batch datagram
+
+    def window_timer_fired(self, session):
+        with self.lock:
+            session.flush_timer = None
+            if session.state == ESTABLISHED:
+                self.flush_window(session)
+
+    def transmit_windowed(self, session, msg_type, payload, count=1):
+        """
+        Sends one datagram of the windowed mode: a chat, batch (of count messages) or fragment datagram.
+        """
+        seq = session.send_window.take_seq()
+        datagram = self.chat_datagram(session, msg_type, seq % 256, payload, count)  # Only the low byte of seq
+        if __debug__:
+            session.datagrams_sent += 1
+            session.bytes_sent += len(datagram)
+        session.credit_in_flight += self.delivered_messages(datagram)
+        self.send_reliable(session, datagram, CHAT_RETRIES, key=(session, seq))
+
+    def transmit_turn(self, session, msg_type, payload):
+        """
+        Sends one datagram of the turn-taking mode with the next sequence number.
+        """
+        session.sequence_number = (session.sequence_number + 1) % 256  # 1-byte field
+        datagram = self.chat_datagram(session, msg_type, session.sequence_number, payload)
+        if __debug__:
+            session.datagrams_sent += 1
+            session.bytes_sent += len(datagram)
+        self.send_reliable(session, datagram, CHAT_RETRIES)
+
+    def delivered_messages(self, datagram):
+        """
+        Number of client messages that are delivered once the peer acknowledges this datagram:
+        one for a chat datagram, all of a batch, and one for the last fragment of a message or chunk.
+        """
+        msg_type = datagram[0] & ~COMPACT
+        if msg_type == 0x02:
+            return 1
+        if msg_type == 0x03:
+            view = self.datagram.view(datagram)
+            if view.operation == COMPRESSED:
+                return BATCH_ITEM.unpack_from(view.payload_bytes)[0]
+            return len(decode_batch(view.payload_bytes))
+        if msg_type == 0x04:
+            _, _, flags, _ = parse_fragment(self.datagram.view(datagram).payload_bytes)
+            return 1 if flags & FRAGMENT_END else 0
+        return 0
+
+    def deliver_chat(self, session, msg_type, payload, now):
+        """
+        Passes the content of a chat, batch or fragment datagram (in sequence order) to the client.
+        """
+        if msg_type == 0x04:
+            self.receive_fragment(session, payload, now)
+            return
+        messages = decode_batch(payload) if msg_type == 0x03 else [str(payload, 'utf-8')]
+        for message in messages:
+            self.deliver_message(session, {
+                'type': 'chat_message',
+                'from': session.peer_username,
+                'message': message
+            })
+
+    def receive_fragment(self, session, payload, now):
+        """
+        Adds a fragment to its message. A message is delivered once it is complete, a stream is
+        forwarded chunk by chunk as the sending client wrote it. Returns the fragment's flags.
+        """
+        message_id, offset, flags, data = parse_fragment(payload)
+        if self.reassembly.add(session, message_id, offset, data, now) is None:
+            return flags  # The start of the message was dropped (timeout or buffer limit), so is the rest
+        if not flags & FRAGMENT_END:
+            return flags
+        data = self.reassembly.take(session, message_id, flags & FRAGMENT_LAST)
+        if flags & FRAGMENT_COMPRESSED:
+            data = decompress_payload(data, MAX_MESSAGE_SIZE)
+        if flags & FRAGMENT_STREAM:
+            self.deliver_to_client(session.client, {
+                'type': 'stream_chunk',
+                'from': session.peer_username,
+                'stream': message_id % (MAX_CLIENT_NUMBER + 1),  # Only tells apart the open streams of the peer
+                'data': data,
+                'last': bool(flags & FRAGMENT_LAST)
+            })
+        else:
+            self.deliver_message(session, {
+                'type': 'chat_message',
+                'from': session.peer_username,
+                'message': str(data, 'utf-8')
+            })
+        return flags
+
+    def send_chat_message(self, client, message):
+        """
+        Sends a chat message of the client in its session, if it may send now. It is encoded once
+        here, the length limit is in bytes.
+        """
+        session = client.session
+        data = message.encode('utf-8')
+        if len(data) > MAX_MESSAGE_SIZE:
+            error = 'Message too long'
+        elif session is not None and session.version < 2 and len(data) != len(message):
+            error = 'The peer only takes ASCII'  # Its daemon talks the wire format version 1
+        else:
+            error = None
+        if error is not None:
+            self.send_to_client({
+                'type': 'error',
+                'message': error
+            }, client.addr)
+            return
+        if session is not None and session.state == ESTABLISHED and session.windowed:
+            self.send_windowed(session, data)  # No turns in the windowed mode
+        # Check if it's the current daemon's turn
+        elif session is not None and session.state == ESTABLISHED and session.has_turn:
+            # Give up the turn before sending, the peer may answer before the ACK arrives
+            session.has_turn = False
+            self.sessions.touch(session, time.monotonic())
+            if len(data) > self.max_payload:
+                # One fragment at a time, the next one goes out when the previous is acknowledged
+                session.fragments.extend(self.fragment_message(session, data))
+                self.transmit_turn(session, 0x04, session.fragments.popleft())
+            else:
+                self.transmit_turn(session, 0x02, data)
+        else:
+            # Notify the client it's not their turn
+            self.send_to_client({
+                'type': 'error',
+                'message': 'Not your turn'
+            }, client.addr)
+
+    def start_eviction(self):
+        """
+        Looks for idle sessions and incomplete messages every EVICTION_INTERVAL seconds, so they are
+        evicted even if no datagram arrives.
+        """
+        self.retransmit.call_later(EVICTION_INTERVAL, self.eviction_timer_fired)
+
+    def eviction_timer_fired(self):
+        with self.lock:
+            self.evict_idle_sessions(time.monotonic())
+            self.retransmit.call_later(EVICTION_INTERVAL, self.eviction_timer_fired)
+
+    def evict_idle_sessions(self, now):
+        if self.reassembly.evict_idle(now):
+            print("Dropped incomplete messages")
+        for session in self.sessions.evict_idle(now):
+            if session.state != CLOSING:
+                self.send_to_daemon(self.session_datagram(
+                    session,
+                    0x01,
+                    0x08,  # FIN
+                    session.sequence_number
+                ), session.peer_addr)
+            self.end_session(session)
+
+    def process_client_message(self, data, addr):
+        """
+        Handles one message from a client along with fulfilling the 3-way handshake method.
+        Clients send either JSON or the binary format, the first byte tells which.
+        """
+        binary = not is_json_message(data)
+        msg = decode_client_message(data) if binary else decode_json_message(data)
+        client = self.clients_by_addr.get(addr)
+        if __debug__:
+            self.metrics.client_message(msg['type'])
+
+        if msg['type'] == 'connect':
+            if not valid_username(msg.get('username')):
+                self.send_to_client({
+                    'type': 'error',
+                    'message': f'Usernames are 1 to {MAX_USERNAME_LENGTH} bytes'
+                }, addr)
+                return
+            client = self.clients.get(msg['username'])
+            if client is None:
+                client = LocalClient(msg['username'], addr)
+                self.clients[client.username] = client
+            else:  # Same user again, e.g. after restarting the client
+                self.clients_by_addr.pop(client.addr, None)
+                client.addr = addr
+            client.batching = bool(msg.get('batch'))
+            client.binary = binary  # Answer in the format the client connected with
+            client.credit = min(int(msg['credit']), MAX_CREDIT) if msg.get('credit') else None
+            self.clients_by_addr[addr] = client
+            self.send_to_client({
+                'type': 'connected',
+                'message': 'Connected to daemon'
+            }, addr)
+            # What waited for credit, then the messages that arrived while the client was away
+            self.grant_credit(client, 0)
+            if self.directory_addr is not None:
+                self.register_user(client.username)
+            return
+
+        if client is None:
+            self.send_to_client({
+                'type': 'error',
+                'message': 'Not connected'
+            }, addr)
+            return
+        session = client.session
+
+        if msg['type'] == 'start_chat':
+            target_username = msg.get('target_username') or None
+            window = min(int(msg.get('window', self.window)), MAX_WINDOW)
+            early_data = msg.get('message') or None  # First message, sent along if the chat is resumed
+            if early_data is not None and len(early_data.encode('utf-8')) > MAX_MESSAGE_SIZE:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': 'Message too long'
+                }, addr)
+            elif target_username is not None and not valid_username(target_username):
+                self.send_to_client({
+                    'type': 'error',
+                    'message': f'Usernames are 1 to {MAX_USERNAME_LENGTH} bytes'
+                }, addr)
+            elif msg.get('target_port') and parse_port(msg['target_port']) is None:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': 'Invalid target_port'
+                }, addr)
+            elif msg.get('target_port'):
+                self.start_chat(client, (self.ip, parse_port(msg['target_port'])), target_username, window, early_data)
+            elif target_username and self.directory_addr is not None:
+                if session is not None:
+                    self.send_to_client({
+                        'type': 'error',
+                        'message': 'Already in a chat'
+                    }, addr)
+                else:
+                    self.resolve_peer(client, target_username, window, early_data)
+            else:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': 'No directory to find the user' if target_username else 'No target_port'
+                }, addr)
+
+        elif msg['type'] == 'chat_response':
+            if session is None or session.state != REQUESTED:
+                return
+            if msg['accept']:
+                self.accept_session(session)
+            else:
+                self.close_session(session)  # Send FIN
+
+        elif msg['type'] == 'chat_message':
+            self.send_chat_message(client, msg['message'])
+
+        elif msg['type'] == 'stream_chunk':
+            data = msg.get('data') or b""
+            if isinstance(data, str):  # JSON clients may send text
+                data = data.encode('utf-8')
+            if session is None or session.state != ESTABLISHED or not session.windowed:
+                error = 'Streams need a chat in the windowed mode'
+            elif len(data) > MAX_MESSAGE_SIZE:
+                error = 'Chunk too long'
+            elif len(session.fragments) >= MAX_SEND_QUEUE:
+                error = 'Send queue full'
+            else:
+                self.send_stream_chunk(session, data, bool(msg.get('last')))
+                return
+            self.send_to_client({
+                'type': 'error',
+                'message': error
+            }, addr)
+
+        elif msg['type'] == 'queue_message':
+            message = msg.get('message', "").encode('utf-8')
+            if self.store is None:
+                error = 'No message store'
+            elif not msg.get('target_username'):
+                error = 'Queued messages need a target_username'
+            elif not valid_username(msg['target_username']):
+                error = f'Usernames are 1 to {MAX_USERNAME_LENGTH} bytes'
+            elif parse_port(msg.get('target_port')) is None:
+                error = 'Queued messages need a valid target_port'
+            elif len(message) > MAX_MESSAGE_SIZE:
+                error = 'Message too long'
+            else:
+                target_addr = (self.ip, parse_port(msg['target_port']))
+                name = outgoing_log_name(target_addr, msg['target_username'], client.username)
+                self.store.log(name).append(message)
+                self.store_changed()
+                self.schedule_forward(name, 0)
+                return
+            self.send_to_client({
+                'type': 'error',
+                'message': error
+            }, addr)
+
+        elif msg['type'] == 'join_room':
+            self.join_room(client, msg.get('room', ""), msg.get('target_port'))
+
+        elif msg['type'] == 'room_message':
+            self.room_message(client, msg.get('room', ""), msg.get('message') or "")
+
+        elif msg['type'] == 'leave_room':
+            self.leave_room(client, msg.get('room', ""))
+
+        elif msg['type'] == 'credit':
+            self.grant_credit(client, int(msg.get('credit', 0)))
+
+        elif msg['type'] == 'quit':
+            if session is not None:
+                self.close_session(session)
+            for name in list(client.rooms):
+                self.leave_room(client, name)
+
+    def process_daemon_datagram(self, data, addr):
+        """
+        Handles one datagram from another daemon. The session is found by the sender's address
+        and username, or by our session id in a datagram with the compact header.
+        """
+        view = self.datagram.view(data)  # The payload is only decoded if it's used
+        msg_type, operation, seq_num, username = view.msg_type, view.operation, view.seq_num, view.username
+        if __debug__:
+            self.metrics.datagram_received(data)
+        now = time.monotonic()
+        if view.session_id is not None:
+            session = self.sessions.by_id(view.session_id)
+            if session is None or session.peer_addr != addr:
+                if msg_type != 0x01:  # The peer thinks it's in a chat we don't know (anymore)
+                    self.send_to_daemon(self.control_datagram(0x08, seq_num, "",
+                                                              encode_options({'sid': view.session_id})), addr)  # FIN
+                return
+            username = session.peer_username
+
+        if msg_type == 0x01:  # Control datagram
+            if operation == 0x02:  # SYN
+                options = parse_options(view.payload)
+                session = self.sessions.get(addr, username)
+                if session is not None:
+                    if not options.get('ticket') or options['ticket'] != session.ticket:
+                        return  # Retransmitted SYN, the client was already asked
+                    self.end_session(session, notify=False)  # The peer lost the chat (restarted) and resumes it
+
+                if self.forward_timers:
+                    self.peer_seen(addr)
+                if options.get('ticket') and self.resume_session(addr, username, options, now):
+                    return
+                if (options.get('store') == '1' and options.get('to') and self.store is not None
+                        and not self.sessions.full):
+                    self.accept_stored(addr, username, options, now)
+                    return
+                client = self.find_client(options.get('to'))
+                if client is None or self.sessions.full:
+                    # Busy (or no such client): reject the chat
+                    datagram = self.control_datagram(
+                        0x08,  # FIN
+                        seq_num,
+                        options.get('to')
+                    )
+                    self.send_to_daemon(datagram, addr)
+                    return
+
+                # ONLY notify client of chat request if it is not busy
+                session = Session(addr, username, client, REQUESTED, self.initial_turn(), now)
+                # Agree to the sliding window if asked for, at most our own window (if we have one)
+                limit = self.window if self.window > 1 else MAX_WINDOW
+                session.use_window(min(int(options.get('window', 0)), limit))
+                session.batching = session.windowed and options.get('batch') == '1'
+                session.resumable = options.get('resume') == '1'
+                session.peer_credit = int(options['credit']) if 'credit' in options else None
+                self.agree_version(session, options)
+                self.sessions.add(session)
+                client.session = session
+                self.client_bound(client)
+                self.send_to_client({
+                    'type': 'chat_request',
+                    'from': username,
+                    'port': addr[1]
+                }, client.addr)
+
+            elif operation == 0x06:  # SYN+ACK
+                session = self.sessions.get_handshake(addr, username)
+                if session is None or session.state not in (CONNECTING, ESTABLISHED):
+                    return
+                self.sessions.touch(session, now)
+                # Send final ACK (again if the SYN+ACK was retransmitted because our ACK got lost)
+                datagram = self.control_datagram(
+                    0x04,  # ACK
+                    seq_num,
+                    session.client.username
+                )
+                self.send_to_daemon(datagram, addr)
+                if session.state == CONNECTING:
+                    pending = self.retransmit.acknowledge((session, 'syn'))
+                    options = parse_options(view.payload)  # What the peer agreed to
+                    record = session.resuming
+                    resumed = record is not None and options.get('resumed') == '1'
+                    if __debug__:
+                        if not resumed:
+                            self.metrics.handshakes += 1
+                        if pending is not None:  # From the first SYN, retransmissions included
+                            histogram = self.metrics.resume_duration if resumed else self.metrics.handshake_duration
+                            histogram.observe(now - pending.sent_at)
+                    if session.peer_username != username:
+                        self.sessions.rename(session, username)
+                    session.state = ESTABLISHED
+                    if resumed:
+                        early = options.get('early') == '1'  # The peer delivered our first message
+                        session.has_turn = record.has_turn and not early
+                        session.restore(int(options.get('window', 0)), options.get('batch') == '1',
+                                        record.send_seq + early, int(options.get('seq', 0)))
+                    else:
+                        session.use_window(int(options.get('window', 0)))
+                        session.batching = session.windowed and options.get('batch') == '1'
+                    if 'credit' in options:  # Only answered to our credit, so both do flow control
+                        session.peer_credit = int(options['credit'])
+                    self.agree_version(session, options)
+                    self.tickets.discard(record)  # Used, the peer sent a new one (or none)
+                    if options.get('ticket'):
+                        session.ticket = self.tickets.issue(session, options['ticket']).ticket
+                    if record is not None or session.ticket:
+                        self.tickets_changed()
+                    if session.log is not None:
+                        self.forward_backoff.pop(session.log.name, None)  # The peer is back
+                        self.pump_forward(session)
+                        return
+                    self.send_to_client({
+                        'type': 'chat_started',
+                        'with': username,
+                        'resumed': resumed
+                    }, session.client.addr)
+                    early_data, session.early_data = session.early_data, None
+                    if early_data is not None and resumed and options.get('early') == '1':
+                        self.send_to_client({
+                            'type': 'message_ack'  # Delivered along with the handshake
+                        }, session.client.addr)
+                    elif early_data is not None:
+                        self.send_chat_message(session.client, early_data)
+
+            elif operation == 0x04:  # ACK
+                session = self.sessions.get(addr, username)
+                if session is None:
+                    return
+                self.sessions.touch(session, now)
+                if (session, 'synack') in self.retransmit.pending:
+                    # The handshake's ACK, or a later one: either way the peer has our SYN+ACK
+                    self.retransmit.acknowledge((session, 'synack'))
+                if session.state == CLOSING:
+                    self.retransmit.acknowledge((session, 'fin'))
+                elif session.windowed and session.state == ESTABLISHED:
+                    # Cumulative ACK in the seq field, the peer's credit and selective ACKs as bitmap in the payload
+                    sack = view.payload_bytes
+                    stalled = session.peer_credit == 0
+                    if session.peer_credit is not None and len(sack) >= CREDIT.size:  # Not the handshake's ACK
+                        (session.peer_credit,) = CREDIT.unpack_from(sack)
+                        sack = sack[CREDIT.size:]
+                    acked = 0
+                    for seq in session.send_window.on_ack(seq_num, sack):
+                        pending = self.retransmit.acknowledge((session, seq))
+                        if pending is None:
+                            continue
+                        delivered = self.delivered_messages(pending.datagram)
+                        session.credit_in_flight -= delivered
+                        if session.log is not None:
+                            self.forward_acked(session, delivered)
+                            continue
+                        acked += delivered
+                    self.acknowledge_to_client(session.client, acked)
+                    window = session.send_window
+                    for seq in window.lost():
+                        self.retransmit.retransmit_now((session, seq))
+                    if stalled and session.peer_credit and window.in_flight:
+                        # Window update: the datagram the peer refused goes again without waiting for its timeout
+                        self.retransmit.retransmit_now((session, window.base))
+                    self.flush_window(session)  # Whatever was queued meanwhile goes out now
+                else:
+                    pending = self.retransmit.acknowledge((session, seq_num))
+                    if pending is None:
+                        return
+                    if pending.datagram[0] & ~COMPACT == 0x04 and session.fragments:
+                        self.transmit_turn(session, 0x04, session.fragments.popleft())  # Next fragment
+                    if self.delivered_messages(pending.datagram):  # A chat message was delivered
+                        self.send_to_client({
+                            'type': 'message_ack'
+                        }, session.client.addr)
+
+            elif operation == 0x08:  # FIN
+                session = self.sessions.get_handshake(addr, username)
+                options = parse_options(view.payload)
+                if session is None and options.get('to') in self.clients:
+                    # The peer doesn't know the chat of our user 'to' (anymore), e.g. it was restarted
+                    session = self.clients[options['to']].session
+                    if session is not None and session.peer_addr != addr:
+                        session = None
+                elif session is None and 'sid' in options:
+                    # Same, for a chat whose datagrams had the compact header: sid is the peer's id for it
+                    session = self.sessions.find_peer_id(addr, int(options['sid']))
+                # Send ACK for FIN
+                if session is not None:
+                    datagram = self.session_datagram(session, 0x01, 0x04, seq_num)  # ACK
+                else:
+                    datagram = self.control_datagram(0x04, seq_num, "")  # ACK
+                self.send_to_daemon(datagram, addr)
+                if session is not None:
+                    self.peers.invalidate(session.peer_username, session.peer_addr)  # Maybe the user moved
+                    if session.state == CONNECTING and session.resuming is not None:
+                        self.discard_ticket(session.resuming.ticket)  # The peer refused it
+                    if options.get('quit') == '1':
+                        self.discard_ticket(session.ticket)  # Ended for good, not to be resumed
+                    self.end_session(session)
+
+        elif msg_type == GROUP:
+            self.group_datagram(view, addr, now)
+
+        elif msg_type == DIRECTORY:
+            if addr == self.directory_addr:
+                self.directory_datagram(view, now)
+
+        elif msg_type == 0x02 or msg_type == 0x03 or msg_type == 0x04:  # Chat, batch or fragment datagram
+            session = self.sessions.get(addr, username)
+            if session is None or session.state != ESTABLISHED:
+                if session is None:  # The peer thinks it's in a chat we don't know (anymore)
+                    self.send_to_daemon(self.control_datagram(0x08, seq_num, "", encode_options({'to': username})),
+                                        addr)  # FIN
+                return
+            self.sessions.touch(session, now)
+            if __debug__:
+                session.datagrams_received += 1
+                session.bytes_received += len(data)
+
+            if session.windowed:
+                duplicate = session.receive_window.is_duplicate(seq_num)
+                if __debug__:
+                    if duplicate:
+                        self.metrics.duplicates += 1
+                if not duplicate and self.session_credit(session) <= 0:
+                    # No room at the client: not taken, the ACK tells the peer to wait and it sends it again
+                    if __debug__:
+                        self.metrics.refused += 1
+                    self.send_to_daemon(self.window_ack(session), addr)
+                    return
+                # Copied (and decompressed) only if it's new, the receive buffer is reused for the next datagram
+                payload = None if duplicate else self.plain_payload(view)
+                delivered = session.receive_window.receive(seq_num, (msg_type, payload))
+                self.send_to_daemon(self.window_ack(session), addr)
+                for item_type, payload in delivered:  # In order, possibly several after a gap was filled
+                    self.deliver_chat(session, item_type, payload, now)
+                return
+            if msg_type == 0x03:
+                return  # Batches are only agreed on for the windowed mode
+            if seq_num == (session.last_received_seq + 1) % 256 and self.session_credit(session) <= 0:
+                if __debug__:
+                    self.metrics.refused += 1
+                return  # No room at the client: not acknowledged, the peer sends it again
+
+            # Send ACK
+            datagram = self.session_datagram(
+                session,
+                0x01,
+                0x04,  # ACK
+                seq_num
+            )
+            self.send_to_daemon(datagram, addr)
+
+            # Process message only if it's coming with the next sequence number, anything else is a
+            # retransmission of a message we already have
+            if seq_num == (session.last_received_seq + 1) % 256:
+                session.last_received_seq = seq_num
+                # The peer only answers after getting our message, so this also acknowledges it
+                pending = self.retransmit.acknowledge((session, session.sequence_number))
+                if pending is not None and self.delivered_messages(pending.datagram):
+                    self.send_to_client({
+                        'type': 'message_ack'
+                    }, session.client.addr)
+
+                if msg_type == 0x04:
+                    # The turn only passes with the last fragment of the peer's message
+                    if self.receive_fragment(session, view.payload_bytes, now) & FRAGMENT_LAST:
+                        session.has_turn = True
+                    return
+                session.has_turn = True  # Set turn to the sender
+                # Forward the message to client
+                self.deliver_message(session, {
+                    'type': 'chat_message',
+                    'from': username,
+                    'message': str(self.plain_payload(view), 'utf-8')
+                })
+            elif __debug__:
+                self.metrics.duplicates += 1
+
+    def render_metrics(self):
+        """
+        Returns the metrics in the Prometheus text format: the counters, plus queue depths and
+        per-session counters read from the daemon's state right now.
+        """
+        with self.lock:
+            lines = list(self.metrics.lines())
+            states = {}
+            send_queue = 0
+            session_samples = []
+            for session in self.sessions:
+                states[STATE_NAMES[session.state]] = states.get(STATE_NAMES[session.state], 0) + 1
+                send_queue += len(session.fragments) + (len(session.send_window.queue) if session.windowed else 0)
+                labels = {'peer': f"{session.peer_addr[0]}:{session.peer_addr[1]}",
+                          'user': session.peer_username or "", 'client': session.client.username}
+                session_samples.append((labels, session))
+            backlog = 0
+            if self.unix_server is not None:
+                backlog = sum(len(messages) for messages in list(self.unix_server.backlog.values()))
+            lines += metric("simp_retransmissions_total", "counter", "Datagrams sent again (timeouts and fast retransmits)",
+                            [({}, self.retransmit.retransmissions)])
+            lines += metric("simp_sessions", "gauge", "Sessions by state",
+                            [({'state': state}, count) for state, count in sorted(states.items())])
+            lines += metric("simp_clients", "gauge", "Connected local clients", [({}, len(self.clients))])
+            lines += metric("simp_resume_tickets", "gauge", "Chats that can be resumed without a full handshake",
+                            [({}, len(self.tickets))])
+            lines += metric("simp_retransmit_queue_datagrams", "gauge", "Datagrams waiting for their ACK",
+                            [({}, len(self.retransmit.pending))])
+            lines += metric("simp_send_queue_datagrams", "gauge",
+                            "Messages and fragments waiting for room in the send window", [({}, send_queue)])
+            lines += metric("simp_client_outbox_messages", "gauge", "Messages waiting to be batched to clients",
+                            [({}, sum(len(client.outbox) for client in self.clients.values()))])
+            lines += metric("simp_client_queue_messages", "gauge", "Messages waiting for clients to give credit",
+                            [({}, sum(len(client.queue) for client in self.clients.values()))])
+            lines += metric("simp_client_backlog_messages", "gauge", "Messages waiting for a full AF_UNIX client queue",
+                            [({}, backlog)])
+            lines += metric("simp_reassembly_bytes", "gauge", "Bytes of incomplete fragmented messages",
+                            [({}, self.reassembly.size)])
+            if self.directory_addr is not None:
+                lines += metric("simp_peer_cache_entries", "gauge", "Users whose daemon is cached",
+                                [({}, len(self.peers))])
+                lines += metric("simp_peer_cache_lookups_total", "counter", "Usernames resolved with the peer cache",
+                                [({'result': 'hit'}, self.peers.hits), ({'result': 'miss'}, self.peers.misses)])
+                lines += metric("simp_directory_lookups", "gauge", "Lookups the directory hasn't answered yet",
+                                [({}, len(self.lookups))])
+            if self.rooms:
+                rooms = list(self.rooms.values())
+                lines += metric("simp_rooms", "gauge", "Rooms by role of this daemon",
+                                [({'role': 'hub'}, sum(room.hosted for room in rooms)),
+                                 ({'role': 'member'}, sum(not room.hosted for room in rooms))])
+                lines += metric("simp_room_members", "gauge", "Member daemons of the rooms hosted here",
+                                [({}, sum(len(room.members) for room in rooms))])
+                lines += metric("simp_room_unacked_messages", "gauge",
+                                "Room messages some member daemon hasn't acknowledged yet",
+                                [({}, sum(len(room.unacked) for room in rooms))])
+            if self.store is not None:
+                lines += metric("simp_stored_messages", "gauge", "Messages in the store waiting for a peer or a client",
+                                [({'direction': kind}, sum(len(log) for _, log in self.store.pending_logs(kind)))
+                                 for kind in ("out", "in")])
+            for name, attribute, help_text in (
+                    ("simp_session_datagrams_sent_total", 'datagrams_sent', "Chat datagrams sent in the session"),
+                    ("simp_session_datagrams_received_total", 'datagrams_received',
+                     "Chat datagrams received in the session"),
+                    ("simp_session_sent_bytes_total", 'bytes_sent',
+                 "Bytes of the chat datagrams sent in the session (headers included)"),
+                    ("simp_session_received_bytes_total", 'bytes_received',
+                     "Bytes of the chat datagrams received in the session (headers included)")):
+                lines += metric(name, "counter", help_text,
+                                [(labels, getattr(session, attribute)) for labels, session in session_samples])
+        return "\n".join(lines) + "\n"
+
+    def start_metrics(self):
+        """
+        Starts the HTTP endpoint of the metrics if a port was given.
+        """
+        if self.metrics_port is not None:
+            MetricsServer(self.metrics_port, self.render_metrics, self.profiler, self.ip).start()
 
     def handle_client_messages(self):
         """
-        Function where we handle client messages along with fulfilling the 3-way handshake method.
+        Function where we receive client messages (in its own thread).
         """
+        if self.profiler is not None:
+            self.profiler.add_thread('client')
+        buffer = bytearray(RECEIVE_BUFFER_SIZE)  # Reused for every message, like the daemon socket
+        data = memoryview(buffer)
+        receiver = self.unix_server if self.unix_server is not None else self.client_socket
         while True:
             try:
-                data, addr = self.client_socket.recvfrom(1024)
-                msg = json.loads(data.decode())
-                
-                if data:
-                    if msg['type'] == 'connect':
-                        self.client_address = addr
-                        self.client_username = msg['username']
-                        self.client_socket.sendto(json.dumps({
-                            'type': 'connected',
-                            'message': 'Connected to daemon'
-                        }).encode(), addr)
-                    
-                    elif msg['type'] == 'start_chat':
-                        target_port = int(msg['target_port'])
-
-                        # Send SYN to start three-way handshake
-                        datagram = self.datagram.create_datagram(
-                            0x01,  # Control datagram
-                            0x02,  # SYN
-                            self.sequence_number,
-                            self.client_username,
-                            ""
-                        )
-                        self.send_with_stop_and_wait(datagram, (self.ip, target_port))
-                        self.waiting_for_response = True
-                        self.current_chat_port = target_port
-                    
-                    elif msg['type'] == 'chat_response':
-                        if msg['accept']:
-                            # Send SYN+ACK
-                            datagram = self.datagram.create_datagram(
-                                0x01,  # Control datagram
-                                0x06,  # SYN+ACK because of bitwise or 0x02 │ 0x04 = 0x06
-                                self.sequence_number,
-                                self.client_username,
-                                ""
-                            )
-                            self.send_with_stop_and_wait(datagram, (self.ip, self.current_chat_port))
-                        else:
-                            # Send FIN
-                            datagram = self.datagram.create_datagram(
-                                0x01,  # Control datagram
-                                0x08,  # FIN
-                                self.sequence_number,
-                                self.client_username,
-                                ""
-                            )
-                            self.send_with_stop_and_wait(datagram, (self.ip, self.current_chat_port))
-                            self.current_chat_port = None
-                    
-                    elif msg['type'] == 'chat_message':
-                        # Check if it's the current daemon's turn
-                        if self.has_turn and self.current_chat_port:
-                            self.sequence_number += 1
-                            datagram = self.datagram.create_datagram(
-                                0x02,  # Chat datagram
-                                0x01,  # Fixed for chat
-                                self.sequence_number,
-                                self.client_username,
-                                msg['message']
-                            )
-                            self.send_with_stop_and_wait(datagram, (self.ip, self.current_chat_port))
-                            self.has_turn = False  # Reset turn until ACK is received
-                        else:
-                            # Notify the client it's not their turn
-                            self.client_socket.sendto(json.dumps({
-                                'type': 'error',
-                                'message': 'Not your turn'
-                            }).encode(), self.client_address)
-                            
-                    elif msg['type'] == 'quit':
-                        if self.current_chat_port:
-                            datagram = self.datagram.create_datagram(
-                                0x01,  # Control datagram
-                                0x08,  # FIN
-                                self.sequence_number,
-                                self.client_username,
-                                ""
-                            )
-                            self.send_with_stop_and_wait(datagram, (self.ip, self.current_chat_port))
-                            self.current_chat_port = None
-
+                size, addr = receiver.recvfrom_into(buffer)
+                if size:
+                    with self.lock:
+                        self.process_client_message(data[:size], addr)
             except Exception as e:
-                print(f"Error message from client: {e}")
-                break
+                print(f"Error message from client: {e}")  # Only this message is lost, the other clients go on
 
-    def handle_daemon_messages(self):
+    def handle_daemon_messages(self, sock=None):
+        """
+        Function where we receive datagrams from other daemons (in its own thread), on the daemon
+        socket or the multicast socket.
+        """
+        if self.profiler is not None:
+            self.profiler.add_thread('daemon' if sock is None else 'multicast')
+        sock = sock or self.daemon_socket
+        buffer = bytearray(RECEIVE_BUFFER_SIZE)  # Reused for every datagram, nothing keeps a reference to it
+        data = memoryview(buffer)
         while True:
             try:
-                data, addr = self.daemon_socket.recvfrom(1024)
-                header_info = self.datagram.parse_datagram(data)
-                msg_type, operation, seq_num, username, _, payload = header_info
-
-                if msg_type == 0x01:  # Control datagram
-                    if operation == 0x02:  # SYN
-                        if self.is_busy or self.current_chat_port:
-                            datagram = self.datagram.create_datagram(
-                                0x01, #Control Datagram
-                                0x08, # FIN
-                                seq_num,
-                                self.client_username,
-                                ""
-                                )
-                            self.daemon_socket.sendto(datagram, addr) 
-
-                        else:
-                            # ONLY notify client of chat request if daemon is not busy
-                            self.current_chat_port = addr[1]
-                            if self.client_address:
-                                self.client_socket.sendto(json.dumps({
-                                    'type': 'chat_request',
-                                    'from': username,
-                                    'port': addr[1]
-                                }).encode(), self.client_address)
-                    
-                    elif operation == 0x06:  # SYN+ACK
-                        self.is_busy = True
-                        # Send final ACK
-                        datagram = self.datagram.create_datagram(
-                            0x01,  # Control datagram
-                            0x04,  # ACK
-                            seq_num,
-                            self.client_username,
-                            ""
-                        )
-                        self.daemon_socket.sendto(datagram, addr)
-                        if self.client_address:
-                            self.client_socket.sendto(json.dumps({
-                                'type': 'chat_started',
-                                'with': username
-                            }).encode(), self.client_address)
-                            
-                    
-                    elif operation == 0x04:  # ACK
-                        if seq_num == self.sequence_number:
-                            self.waiting_for_response = False
-                            if self.client_address:
-                                self.client_socket.sendto(json.dumps({
-                                    'type': 'message_ack'
-                                }).encode(), self.client_address)
-                                
-                    
-                    elif operation == 0x08:  # FIN
-                        # Send ACK for FIN
-                        self.is_busy = False
-                        datagram = self.datagram.create_datagram(
-                            0x01,  # Control datagram
-                            0x04,  # ACK
-                            seq_num,
-                            self.client_username,
-                            ""
-                        )
-                        
-                        self.daemon_socket.sendto(datagram, addr)
-                        self.current_chat_port = None
-                        if self.client_address:
-                            self.client_socket.sendto(json.dumps({
-                                'type': 'chat_ended'
-                            }).encode(), self.client_address)
-
-                elif msg_type == 0x02:  # Chat datagram
-                    # Send ACK
-                    datagram = self.datagram.create_datagram(
-                        0x01,  # Control datagram
-                        0x04,  # ACK
-                        seq_num,
-                        self.client_username,
-                        ""
-                    )
-                    self.daemon_socket.sendto(datagram, addr)
-
-                    # Process message only if it's coming with  a new sequence number
-                    if seq_num != self.last_received_seq:
-                        self.last_received_seq = seq_num
-                        self.has_turn = True  # Set turn to the sender
-                        
-                        # Forward the message to client
-                        if self.client_address:
-                            self.client_socket.sendto(json.dumps({
-                                'type': 'chat_message',
-                                'from': username,
-                                'message': payload
-                            }).encode(), self.client_address)
-
+                size, addr = sock.recvfrom_into(buffer)
+                with self.lock:
+                    self.process_daemon_datagram(data[:size], addr)
             except Exception as e:
                 print(f"Error message from daemon: {e}")
 
@@ -244,25 +2109,209 @@ class Daemon:
         """
         print(f"Daemon running on {self.ip}")
         print(f"Listening to daemons on port {self.daemon_port}")
-        print(f"Listening to clients on port {self.client_port}")
-        
-        daemon_thread = threading.Thread(target=self.handle_daemon_messages) 
-        client_thread = threading.Thread(target=self.handle_client_messages) 
-        
+        print(f"Listening to clients on port {self.client_port} ({self.transport})")
+
+        self.retransmit.start()
+        self.start_metrics()
+        self.start_store()
+        self.start_directory()
+        self.start_eviction()
+        daemon_thread = threading.Thread(target=self.handle_daemon_messages)
+        client_thread = threading.Thread(target=self.handle_client_messages)
+
         daemon_thread.start()
         client_thread.start()
-        
+        if self.multicast_socket is not None:
+            threading.Thread(target=self.handle_daemon_messages, args=(self.multicast_socket,), daemon=True).start()
+
         try:
             daemon_thread.join()
             client_thread.join()
-        finally:   
+        finally:
+            pass
+
+
+class DatagramHandler(asyncio.DatagramProtocol):
+    """
+    asyncio protocol that passes every received datagram to a handler function.
+    """
+    def __init__(self, handler, name):
+        self.handler = handler
+        self.name = name
+
+    def datagram_received(self, data, addr):
+        try:
+            self.handler(data, addr)
+        except Exception as e:
+            print(f"Error message from {self.name}: {e}")
+
+    def error_received(self, exc):
+        print(f"Error message from {self.name}: {exc}")
+
+
+class AsyncDaemon(Daemon):
+    """
+    Daemon that serves the daemon socket and the client socket from one asyncio event loop instead
+    of two threads. Message handling is the same as in Daemon, only sending differs.
+    """
+    def __init__(self, daemon_port, client_port, window=0, batch_delay=0.0, batch_size=BATCH_SIZE,
+                 transport="udp", mtu=DEFAULT_MTU, metrics_port=None, profile_interval=0.0, store_dir=None,
+                 directory=None, multicast=None, ticket_file=None, compression=True):
+        super().__init__(daemon_port, client_port, window, batch_delay, batch_size, transport, mtu, metrics_port,
+                         profile_interval, store_dir, directory, multicast, ticket_file, compression)
+        self.loop = None
+        self.daemon_transport = None
+        self.client_transport = None
+        self.multicast_transport = None
+
+    def send_to_daemon(self, datagram, addr):
+        if __debug__:
+            self.metrics.datagram_sent(datagram)
+        self.daemon_transport.sendto(datagram, addr)
+
+    def send_client_bytes(self, data, addr):
+        if self.unix_server is not None:
+            self.unix_server.sendto(data, addr)
+        else:
+            self.client_transport.sendto(data, addr)
+
+    def send_with_stop_and_wait(self, session, datagram, max_retries=None):
+        self.send_reliable(session, datagram, max_retries)  # Waiting would block the loop
+        return True
+
+    async def start(self):
+        """
+        Attaches both sockets to the running event loop.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.retransmit = AsyncRetransmitQueue(self.send_to_daemon, self.loop, self.retransmit.estimator)
+        self.retransmit.observe_rtt = self.metrics.rtt.observe if __debug__ else None
+        self.retransmit.on_expired = self.send_expired
+        self.daemon_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramHandler(self.process_daemon_datagram, 'daemon'), sock=self.daemon_socket)
+        handler = self.process_client_message
+        if self.unix_server is not None:
+            # Doorbells and plain AF_UNIX messages come through the socket, the rest from the rings
+            handler = lambda data, addr: self.unix_server.datagram_received(data, addr, self.process_client_message)
+        self.client_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramHandler(handler, 'client'), sock=self.client_socket)
+        if self.unix_server is not None:
+            self.unix_server.send = self.client_transport.sendto
+            self.unix_server.call_later = self.retransmit.call_later  # Retries for full rings run on the loop
+        if self.multicast_socket is not None:
+            self.multicast_transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: DatagramHandler(self.process_daemon_datagram, 'multicast'), sock=self.multicast_socket)
+
+    def close(self):
+        self.retransmit.stop()
+        for transport in (self.daemon_transport, self.client_transport, self.multicast_transport):
+            if transport is not None:
+                transport.close()
+        if self.unix_server is not None:
+            self.unix_server.close()
+        if self.store is not None:
+            self.store.close()
+
+    def render_metrics(self):
+        # The HTTP server has its own thread, the state belongs to the event loop
+        async def render():
+            return Daemon.render_metrics(self)
+        return asyncio.run_coroutine_threadsafe(render(), self.loop).result()
+
+    async def serve(self):
+        await self.start()
+        if self.profiler is not None:
+            self.profiler.add_thread('loop')
+        self.start_metrics()
+        self.start_store()
+        self.start_directory()
+        self.start_eviction()
+        try:
+            await asyncio.Future()  # Serve until cancelled
+        finally:
+            self.close()
+
+    def run(self):
+        print(f"Daemon running on {self.ip} (asyncio)")
+        print(f"Listening to daemons on port {self.daemon_port}")
+        print(f"Listening to clients on port {self.client_port} ({self.transport})")
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
             pass
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP daemon")
+    parser.add_argument("ip", nargs="?", default="127.0.0.1",     # default: 127.0.0.1
+                        help="IP address of the daemon")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="serve both sockets from one asyncio event loop instead of two threads")
+    parser.add_argument("--window", type=int, default=0,
+                        help=f"ask for the sliding window mode with this many unacknowledged messages "
+                             f"(2-{MAX_WINDOW}) instead of turn-taking")
+    parser.add_argument("--batch-delay", type=float, default=0.0,
+                        help="milliseconds a message may wait to be sent together with others "
+                             "(windowed mode and batching clients), 0 turns batching off")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="udp",
+                        help="how clients reach the daemon: UDP on the client port, or an AF_UNIX socket "
+                             "named after it (unix and shm are the same for the daemon)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="bytes of messages that are sent right away without waiting "
+                             "(at most what fits into one datagram of the MTU)")
+    parser.add_argument("--mtu", type=int, default=DEFAULT_MTU,
+                        help="path MTU to other daemons, longer messages are sent as fragments")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve metrics in the Prometheus text format on http://IP:PORT/metrics "
+                             "(python -O leaves the counters out)")
+    parser.add_argument("--profile", type=float, default=0.0, metavar="MS",
+                        help="sample the stacks of the receiving threads every MS milliseconds, "
+                             "the counts are served on /profile of the metrics port")
+    parser.add_argument("--store", metavar="DIR",
+                        help="keep messages for unreachable peers and absent clients in DIR until they can be "
+                             "delivered (store-and-forward)")
+    parser.add_argument("--directory", metavar="HOST:PORT",
+                        help="register the users at this peer directory (simp_directory.py), so chats can be "
+                             "started by username")
+    parser.add_argument("--multicast", metavar="GROUP:PORT",
+                        help="send room messages once to this IP multicast group (e.g. 239.1.2.3:7100) for the "
+                             "member daemons that listen to it too, instead of once per member daemon")
+    parser.add_argument("--tickets", metavar="FILE",
+                        help="keep the resume tickets of chats in FILE, so they can be resumed after a restart "
+                             "(without it tickets only live as long as the daemon)")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="don't compress chat messages to other daemons (they are still decompressed)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the daemon port (Linux), each serves the peer "
+                             "daemons the kernel hands it; worker i serves metrics on METRICS_PORT+i")
+    args = parser.parse_args()
+    if args.profile > 0 and args.metrics_port is None:
+        parser.error("--profile needs --metrics-port")
+    if args.workers > 1 and (args.asyncio or args.transport != "udp"):
+        parser.error("--workers needs the threaded daemon and the udp transport")
+    if args.workers > 1 and args.store:
+        parser.error("--store can't be shared by workers")
+    if args.workers > 1 and args.directory:
+        parser.error("--directory needs a single worker")
+    if args.workers > 1 and args.multicast:
+        parser.error("--multicast needs a single worker")
+    if args.workers > 1 and args.tickets:
+        parser.error("--tickets can't be shared by workers")
+
     daemon_port = int(input("Enter port for deamon-to-deamon: "))
     client_port = int(input("Enter port for client-to-daemon: "))
-    daemon = Daemon(daemon_port, client_port)
-    if len(sys.argv) == 2:                   #  default: 127.0.0.1
-        daemon.ip = sys.argv[1]              # take IP address of deamon as command line parameter
+    if args.workers > 1:
+        from simp_shard import ShardedDaemon
+        daemon = ShardedDaemon(daemon_port, client_port, args.workers, window=args.window,
+                               batch_delay=args.batch_delay / 1000, batch_size=args.batch_size, mtu=args.mtu,
+                               metrics_port=args.metrics_port, profile_interval=args.profile / 1000,
+                               compression=not args.no_compression)
+    else:
+        daemon_class = AsyncDaemon if args.asyncio else Daemon
+        daemon = daemon_class(daemon_port, client_port, args.window, args.batch_delay / 1000, args.batch_size,
+                              args.transport, args.mtu, args.metrics_port, args.profile / 1000, args.store,
+                              parse_directory_addr(args.directory) if args.directory else None,
+                              parse_multicast_addr(args.multicast) if args.multicast else None, args.tickets,
+                              not args.no_compression)
+    daemon.ip = args.ip                      # take IP address of deamon as command line parameter
     daemon.run()
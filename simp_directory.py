@@ -0,0 +1,209 @@
+"""
+Peer directory: maps usernames to the daemon they are connected to, so a chat can be started by
+username. Daemons register their users with a directory server and hold the entries by a lease
+they refresh with one datagram for all their users; lookups are answered from an LRU/TTL cache in
+the daemon and only go to the directory on a miss.
+"""
+import argparse
+import socket
+import time
+from collections import OrderedDict
+from simp_protocol import Datagram, encode_options, parse_options
+from simp_transport import open_udp_socket
+
+DIRECTORY_LEASE = 30.0          # Entries of a daemon that doesn't refresh them for 30 seconds are dropped
+DIRECTORY_REFRESH = 10.0        # A daemon refreshes its lease every 10 seconds
+DIRECTORY_RETRY = 1.0           # Registrations and lookups without answer are sent again after a second
+LOOKUP_RETRIES = 3              # Then a lookup gives up
+PEER_CACHE_SIZE = 4096          # Resolved peers a daemon keeps
+PEER_CACHE_TTL = 30.0           # Longest time a resolved peer is used without asking again
+
+# Directory datagrams (type 0x05), the username field holds the user the datagram is about
+DIRECTORY = 0x05
+REGISTER = 0x01                 # Daemon -> directory: the user is connected to me
+REFRESH = 0x02                  # Daemon -> directory: renew the lease of all my users (no username)
+LOOKUP = 0x03                   # Daemon -> directory: where is the user?
+REGISTERED = 0x04               # Directory -> daemon: answer to REGISTER
+FOUND = 0x05                    # Directory -> daemon: answer to LOOKUP, payload "ip=...;port=...;ttl=..."
+NOT_FOUND = 0x06
+UNKNOWN = 0x07                  # Directory -> daemon: answer to REFRESH, the directory lost the daemon's users
+
+
+class PeerCache:
+    """
+    Usernames resolved by the directory -> daemon address. At most size entries in least recently
+    used order, each one valid until its expiry.
+    """
+    def __init__(self, size=PEER_CACHE_SIZE, ttl=PEER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()            # username -> (address, expiry)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, username, now):
+        """
+        Returns the address of the user's daemon, or None if it isn't cached (or expired).
+        """
+        entry = self.entries.get(username)
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self.entries[username]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(username)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, username, addr, now, ttl=None):
+        self.entries[username] = (addr, now + min(self.ttl, ttl if ttl is not None else self.ttl))
+        self.entries.move_to_end(username)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, username, addr):
+        """
+        Forgets a user, if it is still cached at addr (the peer ended the chat or stopped answering).
+        """
+        entry = self.entries.get(username)
+        if entry is not None and entry[0] == addr:
+            del self.entries[username]
+
+
+class Lookup:
+    """
+    A username the daemon asked the directory for, with the clients waiting to chat with that user.
+    """
+    __slots__ = ('username', 'waiting', 'tries', 'timer')
+
+    def __init__(self, username):
+        self.username = username
+        self.waiting = []                       # (client, window, first message) of the start_chats waiting
+        self.tries = 0
+        self.timer = None
+
+
+def parse_directory_addr(text):
+    """
+    "host:port" (or just a port) -> (host, port).
+    """
+    host, _, port = text.rpartition(":")
+    return (socket.gethostbyname(host or "127.0.0.1"), int(port))  # As it is the source of the answers
+
+
+def parse_found(payload):
+    """
+    Address and TTL of the payload of a FOUND datagram.
+    """
+    options = parse_options(payload)
+    return (options['ip'], int(options['port'])), float(options.get('ttl', PEER_CACHE_TTL))
+
+
+class DirectoryServer:
+    """
+    The directory. Users are kept by the daemon that registered them, and a daemon's users all
+    expire together when it stops refreshing its lease. The daemons are kept in order of their
+    last refresh, so the expired ones are found at the front without scanning all of them.
+    """
+    def __init__(self, port, lease=DIRECTORY_LEASE):
+        self.ip = "127.0.0.1"
+        self.port = port
+        self.lease = lease
+        self.socket = None
+        self.datagram = Datagram()
+        self.users = {}                         # username -> daemon address
+        self.daemons = OrderedDict()            # daemon address -> (lease expiry, set of usernames)
+
+    def register(self, username, addr, now):
+        previous = self.users.get(username)
+        if previous is not None and previous != addr and previous in self.daemons:
+            self.daemons[previous][1].discard(username)     # The user moved to another daemon
+        self.users[username] = addr
+        entry = self.daemons.pop(addr, None)
+        users = entry[1] if entry is not None else set()
+        users.add(username)
+        self.daemons[addr] = (now + self.lease, users)
+
+    def refresh(self, addr, now):
+        """
+        Renews the lease of a daemon. Returns False if the daemon has no users here.
+        """
+        entry = self.daemons.pop(addr, None)
+        if entry is None:
+            return False
+        self.daemons[addr] = (now + self.lease, entry[1])
+        return True
+
+    def expire(self, now):
+        """
+        Drops the users of the daemons whose lease ran out.
+        """
+        while self.daemons:
+            addr, (expiry, users) = next(iter(self.daemons.items()))
+            if expiry > now:
+                break
+            del self.daemons[addr]
+            for username in users:
+                if self.users.get(username) == addr:
+                    del self.users[username]
+
+    def process_datagram(self, data, addr, now):
+        """
+        Handles one datagram from a daemon, returns the answer (or None).
+        """
+        view = self.datagram.view(data)
+        if view.msg_type != DIRECTORY:
+            return None
+        self.expire(now)
+        operation, username = view.operation, view.username
+        if operation == REGISTER and username:
+            self.register(username, addr, now)
+            return self.datagram.create_datagram(DIRECTORY, REGISTERED, view.seq_num, username, "")
+        if operation == REFRESH:
+            if self.refresh(addr, now):
+                return None                     # Nothing to say, a lost refresh is covered by the next one
+            return self.datagram.create_datagram(DIRECTORY, UNKNOWN, view.seq_num, "", "")
+        if operation == LOOKUP:
+            daemon = self.users.get(username)
+            if daemon is None:
+                return self.datagram.create_datagram(DIRECTORY, NOT_FOUND, view.seq_num, username, "")
+            ttl = self.daemons[daemon][0] - now
+            return self.datagram.create_datagram(DIRECTORY, FOUND, view.seq_num, username, encode_options(
+                {'ip': daemon[0], 'port': daemon[1], 'ttl': f"{ttl:.1f}"}))
+        return None
+
+    def run(self):
+        print(f"Directory running on {self.ip}, port {self.port}")
+        self.socket = open_udp_socket(self.ip, self.port)
+        self.socket.settimeout(self.lease)      # Expire leases even when nobody asks
+        buffer = bytearray(65536)
+        data = memoryview(buffer)
+        while True:
+            try:
+                size, addr = self.socket.recvfrom_into(buffer)
+            except socket.timeout:
+                self.expire(time.monotonic())
+                continue
+            except KeyboardInterrupt:
+                break
+            try:
+                answer = self.process_datagram(data[:size], addr, time.monotonic())
+                if answer is not None:
+                    self.socket.sendto(answer, addr)
+            except Exception as e:
+                print(f"Error message from daemon: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SIMP peer directory")
+    parser.add_argument("ip", nargs="?", default="127.0.0.1", help="IP address of the directory")
+    parser.add_argument("--port", type=int, default=7000, help="UDP port daemons reach the directory on")
+    parser.add_argument("--lease", type=float, default=DIRECTORY_LEASE,
+                        help="seconds the users of a daemon are kept without a refresh")
+    args = parser.parse_args()
+    server = DirectoryServer(args.port, args.lease)
+    server.ip = args.ip
+    server.run()
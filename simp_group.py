@@ -0,0 +1,251 @@
+"""
+Group chat: rooms with many members. A room is hosted by one daemon (the hub); the daemons of
+the other members join it. A message is encoded into one datagram that goes to every member
+daemon (or once to an IP multicast group), and the hub keeps a bitmap of the members that haven't
+acknowledged it yet, so only those get it again.
+"""
+import struct
+from collections import OrderedDict, deque
+from simp_retransmit import MAX_RTO, RTOEstimator
+
+# Group datagrams (type 0x06), the username field holds the room name
+GROUP = 0x06
+JOIN = 0x01                     # Member daemon -> hub, payload options (mcast=GROUP:PORT it listens to)
+JOINED = 0x02                   # Hub -> member daemon, payload options (seq=first message, mcast=...)
+LEAVE = 0x03                    # Member daemon -> hub
+LEFT = 0x04                     # Hub -> member daemon: answer to LEAVE, or the daemon isn't (anymore) a member
+POST = 0x05                     # Member daemon -> hub: post id, then items
+POSTED = 0x06                   # Hub -> member daemon: post id
+PUBLISH = 0x07                  # Hub -> member daemons: sequence number, then items
+GROUP_ACK = 0x08                # Member daemon -> hub: next sequence number expected, then a SACK bitmap
+
+GROUP_SEQ = struct.Struct('!I')             # Sequence number of a PUBLISH, id of a POST
+GROUP_ACK_PAYLOAD = struct.Struct('!IQ')    # Next expected, bit i: sequence number next + 1 + i arrived
+GROUP_ITEM = struct.Struct('!BH')           # Length of the sender's name and of the message, then both (UTF-8)
+GROUP_RETRIES = 8               # A member that doesn't acknowledge a message after 8 retransmissions is dropped
+MAX_GROUP_MEMBERS = 4096        # Member daemons per room
+MAX_GROUP_BACKLOG = 4096        # Messages of a room that aren't acknowledged by all members yet
+REORDER_LIMIT = 64              # Messages a member daemon keeps that arrived after a gap (the SACK bitmap)
+
+
+def encode_group_items(items):
+    """
+    Packs (sender, message) pairs into the item part of a POST or PUBLISH payload.
+    """
+    parts = []
+    for sender, message in items:
+        name = sender.encode('utf-8')
+        text = message.encode('utf-8')
+        parts.append(GROUP_ITEM.pack(len(name), len(text)))
+        parts.append(name)
+        parts.append(text)
+    return b"".join(parts)
+
+
+def decode_group_items(payload):
+    """
+    Unpacks the items of a POST or PUBLISH payload into (sender, message) pairs.
+    """
+    payload = memoryview(payload)
+    items = []
+    offset = 0
+    while offset < len(payload):
+        name_length, text_length = GROUP_ITEM.unpack_from(payload, offset)
+        offset += GROUP_ITEM.size
+        sender = str(payload[offset:offset + name_length], 'utf-8')
+        offset += name_length
+        items.append((sender, str(payload[offset:offset + text_length], 'utf-8')))
+        offset += text_length
+    return items
+
+
+class GroupMember:
+    """
+    A member daemon of a room hosted here. bit is its bit in the pending bitmaps of the messages.
+    """
+    __slots__ = ('addr', 'bit', 'first_seq', 'next_seq', 'last_post', 'multicast')
+
+    def __init__(self, addr, bit, first_seq, multicast):
+        self.addr = addr
+        self.bit = bit
+        self.first_seq = first_seq              # First message it gets, told in JOINED
+        self.next_seq = first_seq               # Everything before it is acknowledged
+        self.last_post = None                   # Id of its last POST, a retransmission of it is only acknowledged
+        self.multicast = multicast              # Listens to our multicast group
+
+
+class GroupMessage:
+    """
+    A published message that not every member acknowledged yet. pending has the bits of those
+    that didn't.
+    """
+    __slots__ = ('seq', 'datagram', 'pending', 'sent_at', 'timeout', 'deadline', 'retries')
+
+    def __init__(self, seq, datagram, pending, now, timeout):
+        self.seq = seq
+        self.datagram = datagram
+        self.pending = pending
+        self.sent_at = now
+        self.timeout = timeout
+        self.deadline = now + timeout
+        self.retries = 0
+
+
+def parse_multicast_addr(text):
+    """
+    "group:port" -> (group, port).
+    """
+    group, _, port = text.rpartition(":")
+    return (group, int(port))
+
+
+def bits_of(bitmap):
+    """
+    Yields the numbers of the bits that are set, lowest first.
+    """
+    while bitmap:
+        low = bitmap & -bitmap
+        yield low.bit_length() - 1
+        bitmap ^= low
+
+
+class Room:
+    """
+    State of a room on one daemon, either the hub (hub_addr is None) or a member daemon that
+    joined the room at hub_addr. Both know their local clients in the room. Like the windows,
+    this is only bookkeeping, the daemon does the sending.
+    """
+    def __init__(self, name, hub_addr=None):
+        self.name = name
+        self.hub_addr = hub_addr
+        self.clients = []                       # Local clients in the room
+        self.estimator = RTOEstimator()
+        self.timer = None
+        # Hub
+        self.members = {}                       # Daemon address -> GroupMember
+        self.by_bit = {}                        # Bit -> GroupMember
+        self.free_bits = []                     # Bits of members that left, used again first
+        self.everyone = 0                       # Bits of all members
+        self.unicast = 0                        # Bits of the members that don't listen to the multicast group
+        self.next_seq = 0
+        self.unacked = OrderedDict()            # Sequence number -> GroupMessage
+        # Member daemon
+        self.joined = False
+        self.expected = 0                       # Next sequence number to give to the clients
+        self.reordered = {}                     # Sequence number -> items that arrived after a gap
+        self.posts = deque()                    # (client, item) waiting to be posted
+        self.post_id = 0
+        self.posting = []                       # Clients of the POST in flight, one per item
+
+    @property
+    def key(self):
+        return (self.hub_addr, self.name)
+
+    @property
+    def hosted(self):
+        return self.hub_addr is None
+
+    # Hub
+
+    def add_member(self, addr, multicast):
+        member = self.members.get(addr)
+        if member is None:
+            bit = self.free_bits.pop() if self.free_bits else len(self.by_bit)
+            member = self.members[addr] = self.by_bit[bit] = GroupMember(addr, bit, self.next_seq, multicast)
+            self.everyone |= 1 << bit
+            if not multicast:
+                self.unicast |= 1 << bit
+        return member
+
+    def remove_member(self, addr):
+        """
+        Forgets a member daemon and its bit in the pending messages. Returns the member or None.
+        """
+        member = self.members.pop(addr, None)
+        if member is None:
+            return None
+        del self.by_bit[member.bit]
+        self.free_bits.append(member.bit)
+        mask = ~(1 << member.bit)
+        self.everyone &= mask
+        self.unicast &= mask
+        for seq in list(self.unacked):
+            message = self.unacked[seq]
+            message.pending &= mask
+            if not message.pending:
+                del self.unacked[seq]
+        return member
+
+    def publish(self, datagram, now):
+        """
+        Records a message that is sent to all members now. Returns its GroupMessage, or None if
+        there are no members to wait for.
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        if not self.everyone:
+            return None
+        message = self.unacked[seq] = GroupMessage(seq, datagram, self.everyone, now, self.estimator.rto)
+        return message
+
+    def acknowledge(self, member, next_seq, sack, now):
+        """
+        Clears the member's bit in the messages it acknowledged: everything before next_seq and
+        the ones in the SACK bitmap.
+        """
+        mask = ~(1 << member.bit)
+        for seq in range(member.next_seq, next_seq):
+            self.clear(seq, mask, now)
+        member.next_seq = max(member.next_seq, next_seq)
+        for i in bits_of(sack):
+            self.clear(next_seq + 1 + i, mask, now)
+
+    def clear(self, seq, mask, now):
+        message = self.unacked.get(seq)
+        if message is None or not message.pending & ~mask:
+            return
+        message.pending &= mask
+        if message.retries == 0:                # Karn's algorithm, as in the retransmit queue
+            self.estimator.update(now - message.sent_at)
+        if not message.pending:
+            del self.unacked[seq]
+
+    def due(self, now):
+        """
+        Messages whose timeout is over, with their retry count raised and the timeout doubled.
+        """
+        due = []
+        for message in self.unacked.values():
+            if message.deadline <= now:
+                message.retries += 1
+                message.timeout = min(message.timeout * 2, MAX_RTO)
+                message.deadline = now + message.timeout
+                due.append(message)
+        return due
+
+    def next_deadline(self):
+        return min((message.deadline for message in self.unacked.values()), default=None)
+
+    # Member daemon
+
+    def receive(self, seq, items):
+        """
+        Takes a published message, returns the items that can be given to the clients now (in order).
+        """
+        if seq < self.expected or seq - self.expected > REORDER_LIMIT:
+            return []
+        if seq > self.expected:
+            self.reordered[seq] = items
+            return []
+        delivered = [items]
+        self.expected += 1
+        while self.expected in self.reordered:
+            delivered.append(self.reordered.pop(self.expected))
+            self.expected += 1
+        return delivered
+
+    def ack_payload(self):
+        sack = 0
+        for seq in self.reordered:
+            sack |= 1 << (seq - self.expected - 1)
+        return GROUP_ACK_PAYLOAD.pack(self.expected & 0xFFFFFFFF, sack)
@@ -0,0 +1,244 @@
+"""
+Counters, histograms and a sampling profiler for the daemon, exported in the Prometheus text format.
+The daemon only updates them inside `if __debug__:` blocks, so `python -O simp_daemon.py` compiles
+the instrumentation out.
+"""
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from simp_protocol import COMPACT
+
+# Bucket upper bounds in seconds
+RTT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+HANDSHAKE_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+PROFILE_INTERVAL = 0.01         # Default time between two profiler samples
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DATAGRAM_TYPES = {0x01: "control", 0x02: "chat", 0x03: "batch", 0x04: "fragment", 0x05: "directory", 0x06: "group"}
+CONTROL_OPERATIONS = {0x01: "error", 0x02: "syn", 0x04: "ack", 0x06: "syn_ack", 0x08: "fin"}
+DIRECTORY_OPERATIONS = {0x01: "register", 0x02: "refresh", 0x03: "lookup", 0x04: "registered", 0x05: "found",
+                        0x06: "not_found", 0x07: "unknown"}
+GROUP_OPERATIONS = {0x01: "join", 0x02: "joined", 0x03: "leave", 0x04: "left", 0x05: "post", 0x06: "posted",
+                    0x07: "publish", 0x08: "ack"}
+DATA_OPERATIONS = {0x01: "data", 0x02: "compressed"}
+OPERATIONS = {0x01: CONTROL_OPERATIONS, 0x02: DATA_OPERATIONS, 0x03: DATA_OPERATIONS, 0x05: DIRECTORY_OPERATIONS,
+              0x06: GROUP_OPERATIONS}  # Others are "data"
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets. Only the bucket of a value is counted, the cumulative counts
+    Prometheus wants are computed when it is rendered.
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # The last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=""):
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {total}'
+        braces = f"{{{labels}}}" if labels else ""
+        yield f"{name}_sum{braces} {self.sum!r}"
+        yield f"{name}_count{braces} {total}"
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def metric(name, kind, help_text, samples):
+    """
+    Lines of one metric. samples is a list of (labels, value), labels a dict (or empty).
+    """
+    yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} {kind}"
+    for labels, value in samples:
+        if labels:
+            label_text = ",".join(f'{key}="{label_value(item)}"' for key, item in labels.items())
+            yield f"{name}{{{label_text}}} {value}"
+        else:
+            yield f"{name} {value}"
+
+
+def datagram_labels(key):
+    msg_type, operation = key >> 8 & ~COMPACT, key & 0xFF
+    if msg_type in OPERATIONS:
+        op = OPERATIONS[msg_type].get(operation, str(operation))
+    else:
+        op = "data"
+    return {'type': DATAGRAM_TYPES.get(msg_type, str(msg_type)), 'op': op,
+            'header': "compact" if key >> 8 & COMPACT else "full"}
+
+
+class DaemonMetrics:
+    """
+    Counters and histograms of one daemon. Datagrams are counted by (type << 8) | operation, the
+    labels are only made when the metrics are rendered. Counters are updated under the daemon's
+    lock, except for retransmissions sent by the timer thread: a rare lost increment is cheaper
+    than a lock per datagram.
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.datagrams_received = {}
+        self.datagrams_sent = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.client_messages = {}               # Message type -> count
+        self.duplicates = 0                     # Chat datagrams we already had (their ACK was lost)
+        self.refused = 0                        # Chat datagrams not taken because the client had no room
+        self.dropped = 0                        # Room messages a client had no room for
+        self.compressed = 0                     # Chat payloads sent compressed
+        self.compression_saved = 0              # Payload bytes compression saved
+        self.handshakes = 0
+        self.resumptions = {'resumed': 0, 'refused': 0}    # Tickets peers sent us, by outcome
+        self.group_retransmissions = 0          # Room messages sent again to members that didn't acknowledge them
+        self.rtt = Histogram(RTT_BUCKETS)
+        self.handshake_duration = Histogram(HANDSHAKE_BUCKETS)
+        self.resume_duration = Histogram(HANDSHAKE_BUCKETS)
+
+    def datagram_received(self, datagram):
+        key = datagram[0] << 8 | datagram[1]
+        self.datagrams_received[key] = self.datagrams_received.get(key, 0) + 1
+        self.bytes_received += len(datagram)
+
+    def datagram_sent(self, datagram):
+        key = datagram[0] << 8 | datagram[1]
+        self.datagrams_sent[key] = self.datagrams_sent.get(key, 0) + 1
+        self.bytes_sent += len(datagram)
+
+    def client_message(self, msg_type):
+        self.client_messages[msg_type] = self.client_messages.get(msg_type, 0) + 1
+
+    def lines(self):
+        yield from metric("simp_start_time_seconds", "gauge", "Start time of the daemon (Unix time)",
+                          [({}, self.started_at)])
+        yield from metric("simp_datagrams_received_total", "counter", "Datagrams received from other daemons",
+                          [(datagram_labels(key), count) for key, count in sorted(self.datagrams_received.items())])
+        yield from metric("simp_datagrams_sent_total", "counter",
+                          "Datagrams sent to other daemons, retransmissions included",
+                          [(datagram_labels(key), count) for key, count in sorted(self.datagrams_sent.items())])
+        yield from metric("simp_received_bytes_total", "counter", "Bytes received from other daemons",
+                          [({}, self.bytes_received)])
+        yield from metric("simp_sent_bytes_total", "counter", "Bytes sent to other daemons",
+                          [({}, self.bytes_sent)])
+        yield from metric("simp_client_messages_total", "counter", "Messages received from local clients",
+                          [({'type': msg_type}, count) for msg_type, count in sorted(self.client_messages.items())])
+        yield from metric("simp_duplicate_datagrams_total", "counter",
+                          "Chat datagrams received again and dropped", [({}, self.duplicates)])
+        yield from metric("simp_refused_datagrams_total", "counter",
+                          "Chat datagrams not taken because the client had no room (the peer sends them again)",
+                          [({}, self.refused)])
+        yield from metric("simp_dropped_room_messages_total", "counter",
+                          "Room messages dropped because the client had no room", [({}, self.dropped)])
+        yield from metric("simp_compressed_payloads_total", "counter", "Chat payloads sent compressed",
+                          [({}, self.compressed)])
+        yield from metric("simp_compression_saved_bytes_total", "counter", "Payload bytes compression saved",
+                          [({}, self.compression_saved)])
+        yield from metric("simp_handshakes_total", "counter", "Chats this daemon opened", [({}, self.handshakes)])
+        yield from metric("simp_resumptions_total", "counter", "Resume tickets other daemons sent us, by outcome",
+                          [({'result': result}, count) for result, count in sorted(self.resumptions.items())])
+        yield from metric("simp_group_retransmissions_total", "counter",
+                          "Room messages sent again to member daemons that didn't acknowledge them",
+                          [({}, self.group_retransmissions)])
+        yield "# HELP simp_rtt_seconds Round-trip times of acknowledged datagrams (no retransmissions)"
+        yield "# TYPE simp_rtt_seconds histogram"
+        yield from self.rtt.lines("simp_rtt_seconds")
+        yield "# HELP simp_handshake_duration_seconds Time from SYN to SYN+ACK of the chats this daemon opened"
+        yield "# TYPE simp_handshake_duration_seconds histogram"
+        yield from self.handshake_duration.lines("simp_handshake_duration_seconds")
+        yield "# HELP simp_resume_duration_seconds Time from SYN to SYN+ACK of the chats this daemon resumed"
+        yield "# TYPE simp_resume_duration_seconds histogram"
+        yield from self.resume_duration.lines("simp_resume_duration_seconds")
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the threads that registered with add_thread() every interval seconds
+    from a thread of its own, so the profiled threads don't do any extra work. The counts come out
+    in the collapsed format of flame graph tools ("thread;outer;inner count").
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.threads = {}                       # Thread ident -> name
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread = None
+
+    def add_thread(self, name):
+        """
+        Profiles the calling thread from now on.
+        """
+        self.threads[threading.get_ident()] = name
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for ident, name in list(self.threads.items()):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                if stack:
+                    stack.append(name)
+                    self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = self.server.render()
+        elif path == "/profile" and self.server.profiler is not None:
+            body = self.server.profiler.collapsed()
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass                                    # Scrapes every few seconds would flood the output
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    HTTP endpoint on the loopback interface: /metrics returns render() (Prometheus text format),
+    /profile the samples of the profiler (if there is one). Serves from its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, port, render, profiler=None, ip="127.0.0.1"):
+        super().__init__((ip, port), _Handler)
+        self.render = render
+        self.profiler = profiler
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
@@ -1,43 +1,360 @@
+import base64
+import json
+import struct
+
+MAX_USERNAME_LENGTH = 32                            # Maximum byte length for the username field
+# type (1 byte), operation (1 byte), sequence number (1 byte), username (32 bytes, null padded),
+# payload length (4 bytes), all big endian
+HEADER = struct.Struct('!BBB32sI')
+HEADER_SIZE = HEADER.size                           # 39 bytes
+# Wire format version 2 (agreed on in the handshake): after the handshake, datagrams of a session
+# have the compact header instead: type with the COMPACT bit set, operation, sequence number, the
+# receiver's id for the session (2 bytes, sent in the SYN or SYN+ACK) and payload length (2 bytes)
+COMPACT_HEADER = struct.Struct('!BBBHH')
+COMPACT_HEADER_SIZE = COMPACT_HEADER.size           # 7 bytes
+COMPACT = 0x80
+WIRE_VERSION = 2                                    # UTF-8 payloads, compact headers and compression
+MAX_SESSION_ID = 0xFFFF
+PLAIN = 0x01                                        # Operation of chat and batch datagrams
+COMPRESSED = 0x02                                   # Same, payload compressed (see simp_compress)
+CONTROL_CACHE_SIZE = 4096                           # Prebuilt control frames kept by Datagram.control_frame
+BATCH_ITEM = struct.Struct('!H')                    # Length in front of every message of a batch datagram
+# Room of the receiving client (chat messages it can still take) in front of the SACK bitmap of a
+# windowed ACK, if both daemons sent credit in the handshake
+CREDIT = struct.Struct('!H')
+MAX_CREDIT = 0xFFFF
+
+DEFAULT_MTU = 1500                                  # Ethernet
+UDP_OVERHEAD = 28                                   # IPv4 and UDP header
+MAX_MESSAGE_SIZE = 32768                            # Largest chat message (or stream chunk) a client may send
+# Fragment datagrams (type 0x04) start with: message id (4 bytes), offset in the message (4 bytes), flags
+FRAGMENT = struct.Struct('!IIB')
+FRAGMENT_END = 0x01                                 # Last fragment of what the client sent (a message or a stream chunk)
+FRAGMENT_LAST = 0x02                                # Last fragment of the message or stream
+FRAGMENT_STREAM = 0x04                              # Part of a stream, forwarded chunk by chunk instead of reassembled
+FRAGMENT_COMPRESSED = 0x08                          # The message or stream chunk was compressed before it was cut
+
+# Binary client messages: event (1 byte), flag (1 byte), number (2 bytes), name length (1 byte),
+# then the name and the text (the rest of the datagram, UTF-8)
+CLIENT_HEADER = struct.Struct('!BBHB')
+CLIENT_HEADER_SIZE = CLIENT_HEADER.size             # 5 bytes
+MAX_CLIENT_NUMBER = 0xFFFF                          # The number field of the header
+MAX_CLIENT_NAME = 0xFF                              # Byte length of the name
+# Which message field goes into flag, number, name and text, by event code. Booleans are always
+# decoded, numbers and strings only if they aren't 0 or empty.
+CLIENT_EVENTS = {
+    0x01: ('connect', ('batch', bool), 'credit', 'username', None),
+    0x02: ('connected', None, None, None, 'message'),
+    0x03: ('start_chat', ('window', int), 'target_port', 'target_username', 'message'),
+    0x04: ('chat_response', ('accept', bool), None, None, None),
+    0x05: ('chat_request', None, 'port', 'from', None),
+    0x06: ('chat_started', ('resumed', bool), None, 'with', None),
+    0x07: ('chat_message', None, None, 'from', 'message'),
+    0x08: ('message_ack', None, 'count', None, None),     # count is left out for a single message
+    0x09: ('chat_ended', None, None, None, None),
+    0x0A: ('error', None, None, None, 'message'),
+    0x0B: ('quit', None, None, None, None),
+    0x0C: ('batch', None, None, None, None),     # The text is a list of length-prefixed client messages
+    0x0D: ('stream_chunk', ('last', bool), 'stream', 'from', ('data', bytes)),
+    0x0E: ('queue_message', None, 'target_port', 'target_username', 'message'),
+    0x0F: ('join_room', None, 'target_port', 'room', None),
+    0x10: ('room_joined', None, None, 'room', None),
+    0x11: ('room_message', None, None, 'room', 'message'),
+    0x12: ('leave_room', None, None, 'room', None),
+    0x13: ('credit', None, 'credit', None, None),       # The client handled this many more messages
+}
+CLIENT_EVENT_CODES = {fields[0]: code for code, fields in CLIENT_EVENTS.items()}
+
+
+class DatagramView:
+    """
+    Parsed header of a received datagram, in either format. Only the fixed fields are unpacked, the
+    username and the payload are decoded the first time they are used (ACKs never need their
+    payload). A compact datagram has the session id instead of a username (username is None).
+    """
+    __slots__ = ('buffer', 'msg_type', 'operation', 'seq_num', 'session_id', 'header_size', 'payload_len',
+                 '_username', '_payload')
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        if buffer[0] & COMPACT:
+            msg_type, self.operation, self.seq_num, self.session_id, self.payload_len = \
+                COMPACT_HEADER.unpack_from(buffer)
+            self.msg_type = msg_type & ~COMPACT
+            self.header_size = COMPACT_HEADER_SIZE
+        else:
+            self.msg_type, self.operation, self.seq_num, _, self.payload_len = HEADER.unpack_from(buffer)
+            self.session_id = None
+            self.header_size = HEADER_SIZE
+        self._username = None
+        self._payload = None
+
+    @property
+    def username(self):
+        if self._username is None and self.session_id is None:
+            field = bytes(self.buffer[3:HEADER_SIZE])
+            # Up to the first null byte, a character cut off at 32 bytes is dropped
+            self._username = field.split(b'\0', 1)[0].decode('utf-8', 'ignore')
+        return self._username
+
+    @property
+    def payload_bytes(self):
+        """
+        The payload as a memoryview into the received buffer (no copy).
+        """
+        return memoryview(self.buffer)[self.header_size:self.header_size + self.payload_len]
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = str(self.payload_bytes, 'utf-8')
+        return self._payload
+
+
 class Datagram:
     def __init__(self):
-        self.MAX_USERNAME_LENGTH = 32               # Maximum byte length for the username field
-    
+        self.MAX_USERNAME_LENGTH = MAX_USERNAME_LENGTH
+        self._control_frames = {}                   # (operation, seq_num, username or session id) -> datagram
+
     def _int_to_bytes(self, number):                # Converts integer to 1-byte with big endian
         return number.to_bytes(1, byteorder='big')
-    
+
     def create_datagram(self, msg_type, operation, seq_num, username, message):
+        """
+        Builds a datagram: the 39-byte header (the username is null padded to 32 bytes by struct)
+        followed by the payload (a string, or bytes for binary payloads).
+        """
+        username_bytes = username.encode('utf-8')[:MAX_USERNAME_LENGTH]   # if username too long, take the first 32 bytes
+        if isinstance(message, str):
+            payload_bytes = message.encode('utf-8')                       # payload (actual message) encoded in UTF-8
+        else:
+            payload_bytes = bytes(message)                                # binary payload, e.g. a SACK bitmap
+        return HEADER.pack(msg_type, operation, seq_num, username_bytes, len(payload_bytes)) + payload_bytes
+
+    def create_compact(self, msg_type, operation, seq_num, session_id, message):
+        """
+        Builds a datagram with the compact header (wire format version 2): the receiver's session
+        id instead of the sender's username, 7 header bytes instead of 39.
+        """
+        if isinstance(message, str):
+            payload_bytes = message.encode('utf-8')
+        else:
+            payload_bytes = bytes(message)
+        header = COMPACT_HEADER.pack(msg_type | COMPACT, operation, seq_num, session_id, len(payload_bytes))
+        return header + payload_bytes
+
+    def control_frame(self, operation, seq_num, username):
+        """
+        Returns a control datagram without payload (ACK, FIN, SYN...). These are the same for every
+        message of a session, so they are built once and then taken from a cache.
+        """
+        key = (operation, seq_num, username)
+        frame = self._control_frames.get(key)
+        if frame is None:
+            if len(self._control_frames) >= CONTROL_CACHE_SIZE:
+                self._control_frames.clear()
+            frame = self._control_frames[key] = self.create_datagram(0x01, operation, seq_num, username, "")
+        return frame
+
+    def compact_control_frame(self, operation, seq_num, session_id):
+        """
+        Like control_frame(), with the compact header. Session ids are ints, so they don't collide
+        with usernames in the cache.
+        """
+        key = (operation, seq_num, session_id)
+        frame = self._control_frames.get(key)
+        if frame is None:
+            if len(self._control_frames) >= CONTROL_CACHE_SIZE:
+                self._control_frames.clear()
+            frame = self._control_frames[key] = self.create_compact(0x01, operation, seq_num, session_id, b"")
+        return frame
+
+    def view(self, datagram):
+        """
+        Returns a lazy DatagramView of a received datagram (bytes, bytearray or memoryview).
+        """
+        return DatagramView(datagram)
+
+    def parse_datagram(self, datagram):                # Extract individual fields from the byte array
+        view = DatagramView(datagram)
+        return (view.msg_type, view.operation, view.seq_num, view.username, view.payload_len, view.payload)   # return all fields in a tuple
+
+
+def encode_batch(messages):
+    """
+    Packs several chat messages (UTF-8 encoded) into the payload of one batch datagram (type 0x03),
+    every message prefixed with its 2-byte length.
+    """
+    parts = []
+    for message in messages:
+        parts.append(BATCH_ITEM.pack(len(message)))
+        parts.append(message)
+    return b"".join(parts)
+
+
+def decode_batch(payload):
+    """
+    Unpacks the payload of a batch datagram into the list of messages.
+    """
+    payload = memoryview(payload)
+    messages = []
+    offset = 0
+    while offset < len(payload):
+        (length,) = BATCH_ITEM.unpack_from(payload, offset)
+        offset += BATCH_ITEM.size
+        messages.append(str(payload[offset:offset + length], 'utf-8'))
+        offset += length
+    return messages
+
+
+def max_payload(mtu):
+    """
+    Largest payload of a datagram that still fits into one IP packet of the given MTU (with the
+    version 1 header, so it holds for both formats).
+    """
+    return mtu - UDP_OVERHEAD - HEADER_SIZE
+
+
+def split_fragments(message_id, data, offset, size, flags):
+    """
+    Cuts data (starting at offset within its message) into fragment payloads of at most size bytes.
+    Only the last one gets the flags, all of them get FRAGMENT_STREAM and FRAGMENT_COMPRESSED if
+    flags has them.
+    """
+    data = memoryview(data)
+    chunk = size - FRAGMENT.size
+    fragments = []
+    for start in range(0, max(len(data), 1), chunk):
+        part = data[start:start + chunk]
+        last = start + chunk >= len(data)
+        fragment_flags = flags if last else flags & (FRAGMENT_STREAM | FRAGMENT_COMPRESSED)
+        fragments.append(FRAGMENT.pack(message_id, (offset + start) & 0xFFFFFFFF, fragment_flags) + part)
+    return fragments
+
+
+def parse_fragment(payload):
+    """
+    Returns message id, offset, flags and the data (a memoryview) of a fragment payload.
+    """
+    message_id, offset, flags = FRAGMENT.unpack_from(payload)
+    return message_id, offset, flags, memoryview(payload)[FRAGMENT.size:]
+
+
+def encode_options(options):
+    """
+    Encodes handshake options (payload of SYN and SYN+ACK) as "key=value;key=value".
+    Daemons that don't know an option just ignore it.
+    """
+    return ";".join(f"{key}={value}" for key, value in options.items())
+
+
+def parse_options(payload):
+    """
+    Decodes handshake options, an empty payload gives no options.
+    """
+    options = {}
+    for item in payload.split(";"):
+        key, separator, value = item.partition("=")
+        if separator:
+            options[key] = value
+    return options
+
+
+def encode_client_message(msg):
+    """
+    Encodes a client message (the same dict that is sent as JSON otherwise) in the binary format.
+    """
+    code = CLIENT_EVENT_CODES[msg['type']]
+    if code == 0x0C:
+        return encode_client_batch([encode_client_message(message) for message in msg['messages']])
+    _, flag_field, number_field, name_field, text_field = CLIENT_EVENTS[code]
+    flag = int(msg.get(flag_field[0]) or 0) if flag_field else 0
+    number = int(msg.get(number_field) or 0) if number_field else 0
+    name = (msg.get(name_field) or "").encode('utf-8') if name_field else b""
+    if not 0 <= flag <= 0xFF:
+        raise ValueError(f"{flag_field[0]} {flag} doesn't fit the binary format")
+    if not 0 <= number <= MAX_CLIENT_NUMBER:
+        raise ValueError(f"{number_field} {number} doesn't fit the binary format")
+    if len(name) > MAX_CLIENT_NAME:
+        raise ValueError(f"{name_field} is longer than {MAX_CLIENT_NAME} bytes")
+    text = b""
+    if isinstance(text_field, tuple):       # Raw bytes
+        text = bytes(msg.get(text_field[0]) or b"")
+    elif text_field:
+        text = (msg.get(text_field) or "").encode('utf-8')
+    return CLIENT_HEADER.pack(code, flag, number, len(name)) + name + text
+
+
+def encode_client_batch(frames):
+    """
+    Packs already encoded binary client messages into one batch message.
+    """
+    parts = [CLIENT_HEADER.pack(0x0C, 0, 0, 0)]
+    for frame in frames:
+        parts.append(BATCH_ITEM.pack(len(frame)))
+        parts.append(frame)
+    return b"".join(parts)
+
+
+def decode_client_message(data):
+    """
+    Decodes a binary client message (bytes, bytearray or memoryview) into a dict.
+    """
+    code, flag, number, name_length = CLIENT_HEADER.unpack_from(data)
+    msg_type, flag_field, number_field, name_field, text_field = CLIENT_EVENTS[code]
+    msg = {'type': msg_type}
+    if code == 0x0C:
+        data = memoryview(data)
+        messages = msg['messages'] = []
+        offset = CLIENT_HEADER_SIZE
+        while offset < len(data):
+            (length,) = BATCH_ITEM.unpack_from(data, offset)
+            offset += BATCH_ITEM.size
+            messages.append(decode_client_message(data[offset:offset + length]))
+            offset += length
+        return msg
+    if flag_field:
+        name, kind = flag_field
+        if kind is bool:
+            msg[name] = bool(flag)
+        elif flag:
+            msg[name] = flag
+    if number_field and number:
+        msg[number_field] = number
+    if name_field and name_length:
+        msg[name_field] = str(data[CLIENT_HEADER_SIZE:CLIENT_HEADER_SIZE + name_length], 'utf-8')
+    if isinstance(text_field, tuple):
+        msg[text_field[0]] = bytes(data[CLIENT_HEADER_SIZE + name_length:])
+    elif text_field:
+        msg[text_field] = str(data[CLIENT_HEADER_SIZE + name_length:], 'utf-8')
+    return msg
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"{type(value).__name__} can't be sent as JSON")
+
+
+def _json_object(obj):
+    if len(obj) == 1 and '$bytes' in obj:
+        return base64.b64decode(obj['$bytes'])
+    return obj
+
+
+def encode_json_message(msg):
+    """
+    Encodes a client message as JSON. Bytes (stream data) are sent as {"$bytes": base64}.
+    """
+    return json.dumps(msg, default=_json_default).encode()
+
+
+def decode_json_message(data):
+    return json.loads(bytes(data), object_hook=_json_object)
+
 
-        type_byte = self._int_to_bytes(msg_type)    # 1-byte message type (control=0x01, chat=0x02)
-        op_byte = self._int_to_bytes(operation)     # 1-byte operation (i.e. SYN=0x02, ACK=0x04...)
-        seq_byte = self._int_to_bytes(seq_num)      # 1-byte sequence number (i.e. 0/1)
-        
-        if len(username) > self.MAX_USERNAME_LENGTH:    # if username too long, take the first 32 bytes
-            username = username[:self.MAX_USERNAME_LENGTH]
-
-        username_bytes = username.encode('ascii')       # Convert username to ASCII
-        padding = bytes(self.MAX_USERNAME_LENGTH - len(username_bytes))
-        username_field = username_bytes + padding       # Add padding to ensure fixed size of 32 bytes
-        
-      
-        payload_bytes = message.encode('ascii')                          # payload (actual message) encoded in ASCII
-        payload_len = len(payload_bytes).to_bytes(4, byteorder='big')    # length of the payload (4-byte)
-        
-       
-        return type_byte + op_byte + seq_byte + username_field + payload_len + payload_bytes   # combining all fields (into an bytearray)
-    
-    def parse_datagram(self, datagram):                # Extract individual fields from the byte array 
-        msg_type = datagram[0]
-        operation = datagram[1]
-        seq_num = datagram[2]
-        
-        user = datagram[3:35]                          # Extract and decode the username field (up to the first null byte)
-        username = ""
-        for byte in user:
-            if byte == 0:  # Stop at the null byte  
-                break
-            username += bytes([byte]).decode('ascii')  # Convert the byte to a string
-        
-        payload_len = int.from_bytes(datagram[35:39], byteorder='big')          # Extract and decode the payload length
-        payload = datagram[39:39+payload_len].decode('ascii')
-        
-        return (msg_type, operation, seq_num, username, payload_len, payload)   # return all fields in a tuple
+def is_json_message(data):
+    """
+    Tells JSON client messages (always an object, so they start with '{') from binary ones.
+    """
+    return data[0] == 0x7B
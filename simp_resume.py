@@ -0,0 +1,172 @@
+"""
+Session resumption. When a chat is established the accepting daemon issues a ticket, and both
+daemons keep what the chat agreed on (window, batching, turn and sequence numbers) under it. A
+later start_chat with the same user sends the ticket in the SYN instead of asking the client
+again, optionally with the first message (0-RTT). A ticket is used once, the resumed chat gets
+a new one.
+"""
+import base64
+import json
+import os
+import secrets
+import time
+from collections import OrderedDict
+
+RESUME_LIFETIME = 600.0         # A chat can be resumed for 10 minutes after it was established or last seen
+TICKET_CACHE_SIZE = 4096        # Tickets a daemon keeps, the least recently used are dropped
+TICKET_BYTES = 16
+TICKET_SYNC_INTERVAL = 0.1      # Changed tickets are written to the ticket file at most this often
+
+
+def encode_early_data(message):
+    """
+    A chat message as the value of the data option of a SYN (options are ASCII, split at ';').
+    """
+    return base64.b64encode(message.encode('utf-8')).decode('ascii')
+
+
+def decode_early_data(value):
+    return base64.b64decode(value).decode('utf-8')
+
+
+class ResumeRecord:
+    """
+    What a daemon needs to resume a chat: the ticket, who the chat was between and the state it
+    ended (or was last saved) with. The sequence numbers are the last one sent and the last one
+    received in order, full numbers in the windowed mode and the 1-byte field otherwise.
+    """
+    __slots__ = ('ticket', 'peer_addr', 'peer_username', 'username', 'window', 'batching', 'send_seq',
+                 'receive_seq', 'has_turn', 'expires')
+
+    def __init__(self, ticket, peer_addr, peer_username, username, window=0, batching=False, send_seq=0,
+                 receive_seq=0, has_turn=False, expires=0.0):
+        self.ticket = ticket
+        self.peer_addr = peer_addr
+        self.peer_username = peer_username
+        self.username = username                # The local user
+        self.window = window
+        self.batching = batching
+        self.send_seq = send_seq
+        self.receive_seq = receive_seq
+        self.has_turn = has_turn
+        self.expires = expires                  # Unix time, so it still means something after a restart
+
+    @property
+    def key(self):
+        return (self.peer_addr, self.peer_username, self.username)
+
+    def update(self, session, lifetime=RESUME_LIFETIME):
+        """
+        Takes over the current state of an established session.
+        """
+        if session.windowed:
+            self.window = session.send_window.size
+            self.send_seq = session.send_window.next_seq - 1
+            self.receive_seq = session.receive_window.expected - 1
+        else:
+            self.window = 0
+            self.send_seq = session.sequence_number
+            self.receive_seq = session.last_received_seq
+        self.batching = session.batching
+        self.has_turn = session.has_turn
+        self.expires = time.time() + lifetime
+
+    def to_json(self):
+        return {'ticket': self.ticket, 'peer': list(self.peer_addr), 'peer_username': self.peer_username,
+                'username': self.username, 'window': self.window, 'batching': self.batching,
+                'send_seq': self.send_seq, 'receive_seq': self.receive_seq, 'has_turn': self.has_turn,
+                'expires': self.expires}
+
+    @classmethod
+    def from_json(cls, item):
+        return cls(item['ticket'], tuple(item['peer']), item['peer_username'], item['username'], item['window'],
+                   item['batching'], item['send_seq'], item['receive_seq'], item['has_turn'], item['expires'])
+
+
+class TicketCache:
+    """
+    The tickets of a daemon, by ticket (for the daemon the SYN comes to) and by peer address, peer
+    user and local user (for the daemon starting the chat). At most size tickets in least recently
+    used order, optionally kept in a JSON file so chats survive a restart.
+    """
+    def __init__(self, path=None, size=TICKET_CACHE_SIZE, lifetime=RESUME_LIFETIME):
+        self.path = path
+        self.size = size
+        self.lifetime = lifetime
+        self.records = OrderedDict()            # ticket -> ResumeRecord
+        self.by_key = {}                        # (peer address, peer username, username) -> ResumeRecord
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.records)
+
+    def issue(self, session, ticket=None):
+        """
+        Keeps the state of an established session under a new ticket, or the one the peer issued
+        (replacing any older ticket of the same chat).
+        """
+        record = ResumeRecord(ticket or secrets.token_hex(TICKET_BYTES), session.peer_addr, session.peer_username,
+                              session.client.username)
+        record.update(session, self.lifetime)
+        self.add(record)
+        return record
+
+    def add(self, record):
+        self.discard(self.by_key.get(record.key))
+        self.records[record.ticket] = record
+        self.by_key[record.key] = record
+        if len(self.records) > self.size:
+            self.discard(next(iter(self.records.values())))
+
+    def find(self, peer_addr, peer_username, username):
+        """
+        The ticket to resume a chat with, or None.
+        """
+        record = self.by_key.get((peer_addr, peer_username, username))
+        if record is None or record.expires <= time.time():
+            self.discard(record)
+            return None
+        self.records.move_to_end(record.ticket)
+        return record
+
+    def take(self, ticket):
+        """
+        Removes and returns a ticket sent by a peer, or None if it is unknown or expired.
+        """
+        record = self.records.get(ticket)
+        self.discard(record)
+        if record is None or record.expires <= time.time():
+            return None
+        return record
+
+    def get(self, ticket):
+        return self.records.get(ticket)
+
+    def discard(self, record):
+        if record is None or self.records.get(record.ticket) is not record:
+            return
+        del self.records[record.ticket]
+        if self.by_key.get(record.key) is record:
+            del self.by_key[record.key]
+
+    def save(self):
+        """
+        Writes the tickets that haven't expired to the file (a new file renamed over the old one,
+        so a crash leaves either of them complete).
+        """
+        now = time.time()
+        items = [record.to_json() for record in self.records.values() if record.expires > now]
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(items, f)
+        os.replace(temporary, self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            items = json.load(f)
+        now = time.time()
+        for item in items:
+            record = ResumeRecord.from_json(item)
+            if record.expires > now:
+                self.add(record)
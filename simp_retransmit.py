@@ -0,0 +1,363 @@
+import heapq
+import itertools
+import threading
+import time
+
+INITIAL_RTO = 1.0       # RTO before the first RTT sample (RFC 6298)
+MIN_RTO = 0.2           # Lower bound so loopback RTTs don't cause spurious retransmits
+MAX_RTO = 60.0          # Upper bound for exponential backoff
+CLOCK_GRANULARITY = 0.001
+
+RTT_ALPHA = 1 / 8       # Gain for the smoothed RTT
+RTT_BETA = 1 / 4        # Gain for the RTT variation
+RTT_K = 4
+
+
+class RTOEstimator:
+    """
+    Adaptive retransmission timeout following RFC 6298: SRTT/RTTVAR smoothing of RTT samples
+    and doubling of the timeout on every retransmission.
+    """
+    __slots__ = ('srtt', 'rttvar', 'rto')
+
+    def __init__(self, initial=INITIAL_RTO):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+
+    def update(self, sample):
+        """
+        Feeds one RTT sample (in seconds) into the estimator and recomputes the RTO.
+        """
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+        rto = self.srtt + max(CLOCK_GRANULARITY, RTT_K * self.rttvar)
+        self.rto = min(max(rto, MIN_RTO), MAX_RTO)
+
+    def backoff(self, timeout=None):
+        """
+        Backs off the RTO after a timeout: doubles it, or raises it to the (already doubled) timeout
+        of the retransmitted datagram. The latter keeps several datagrams that time out together
+        from doubling the RTO once each.
+        """
+        if timeout is None:
+            timeout = self.rto * 2
+        self.rto = min(max(self.rto, timeout), MAX_RTO)
+
+
+class PendingSend:
+    """
+    One datagram that is waiting for its acknowledgement. Waiters block on an event instead of polling.
+    """
+    __slots__ = ('key', 'datagram', 'addr', 'estimator', 'sent_at', 'timeout', 'deadline',
+                 'retries', 'max_retries', 'acked', 'timer', '_event', '_callbacks')
+
+    def __init__(self, key, datagram, addr, estimator, max_retries):
+        self.key = key
+        self.datagram = datagram
+        self.addr = addr
+        self.estimator = estimator
+        self.sent_at = 0.0
+        self.timeout = estimator.rto
+        self.deadline = 0.0
+        self.retries = 0
+        self.max_retries = max_retries
+        self.acked = False
+        self.timer = None                           # Loop timer handle, only used by AsyncRetransmitQueue
+        self._event = threading.Event()
+        self._callbacks = None
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the datagram is acknowledged or given up. Returns True if it was acknowledged.
+        """
+        self._event.wait(timeout)
+        return self.acked
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback(pending) once the send is finished (immediately if it already is).
+        """
+        if self._event.is_set():
+            callback(self)
+            return
+        if self._callbacks is None:
+            self._callbacks = []
+        self._callbacks.append(callback)
+
+    def _finish(self, acked):
+        self.acked = acked
+        self._event.set()
+        callbacks, self._callbacks = self._callbacks, None
+        for callback in callbacks or ():
+            callback(self)
+
+
+class ScheduledCall:
+    """
+    A callback scheduled with RetransmitQueue.call_later.
+    """
+    __slots__ = ('deadline', 'callback', 'done')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.done = False
+
+    def cancel(self):
+        self.done = True
+
+
+class RetransmitQueue:
+    """
+    Retransmission engine: outstanding datagrams are kept in a dict by key (for O(1) acknowledgement)
+    and in a heap ordered by deadline. A single timer thread sleeps until the earliest deadline,
+    so an idle daemon doesn't use any CPU. The same thread also runs other timers of the daemon
+    (call_later), e.g. for flushing batches.
+    """
+    def __init__(self, send, estimator=None):
+        self.send = send                            # callable(datagram, addr)
+        self.estimator = estimator or RTOEstimator()
+        self.pending = {}
+        self.retransmissions = 0                    # Timeouts and fast retransmits, exported by the daemon's metrics
+        self.observe_rtt = None                     # Optional callable(seconds) that gets every RTT sample
+        self.on_expired = None                      # Optional callable(pending) for datagrams given up on, called
+                                                    # while they can still be looked up in pending
+        self._heap = []
+        self._counter = itertools.count()           # Tie-breaker so the heap never compares PendingSend objects
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, key, datagram, addr, estimator=None, max_retries=None):
+        """
+        Sends the datagram and schedules its retransmission until acknowledge(key) is called.
+        max_retries=None retransmits forever. Returns the PendingSend handle.
+        """
+        pending = PendingSend(key, datagram, addr, estimator or self.estimator, max_retries)
+        with self._cond:
+            previous = self.pending.pop(key, None)
+            self.pending[key] = pending
+            pending.sent_at = time.monotonic()
+            pending.deadline = pending.sent_at + pending.timeout
+            self._push(pending)
+        if previous is not None:
+            previous._finish(False)
+        self.send(datagram, addr)
+        return pending
+
+    def acknowledge(self, key):
+        """
+        Marks the datagram with the given key as acknowledged and wakes up its waiters.
+        Returns the PendingSend, or None if nothing was outstanding under that key.
+        """
+        pending = self._remove(key)
+        if pending is None:
+            return None
+        if pending.retries == 0:                    # Karn's algorithm: only sample unambiguous RTTs
+            sample = time.monotonic() - pending.sent_at
+            pending.estimator.update(sample)
+            if self.observe_rtt is not None:
+                self.observe_rtt(sample)
+        pending._finish(True)
+        return pending
+
+    def cancel(self, key):
+        """
+        Stops retransmitting the datagram with the given key without counting it as acknowledged.
+        """
+        pending = self._remove(key)
+        if pending is not None:
+            pending._finish(False)
+        return pending
+
+    def retransmit_now(self, key):
+        """
+        Retransmits an outstanding datagram right away (fast retransmit) and restarts its timer.
+        """
+        with self._cond:
+            pending = self.pending.get(key)
+            if pending is None:
+                return None
+            pending.retries += 1                    # Its ACK can't be used as RTT sample anymore
+            pending.deadline = time.monotonic() + pending.timeout
+            self._push(pending)
+        self.retransmissions += 1
+        self.send(pending.datagram, pending.addr)
+        return pending
+
+    def _remove(self, key):
+        with self._cond:
+            return self.pending.pop(key, None)
+
+    def _retry(self, pending, now):
+        """
+        Bookkeeping for one timeout. Returns False if the datagram has used up its retries.
+        """
+        if pending.max_retries is not None and pending.retries >= pending.max_retries:
+            return False
+        pending.retries += 1
+        pending.timeout = min(pending.timeout * 2, MAX_RTO)
+        pending.estimator.backoff(pending.timeout)
+        pending.deadline = now + pending.timeout
+        return True
+
+    def call_later(self, delay, callback):
+        """
+        Runs callback() on the timer thread after delay seconds. Returns a handle with cancel().
+        """
+        call = ScheduledCall(time.monotonic() + delay, callback)
+        with self._cond:
+            self._push(call)
+        return call
+
+    def _push(self, entry):
+        heapq.heappush(self._heap, (entry.deadline, next(self._counter), entry))
+        # Acknowledged entries are removed lazily, rebuild when they pile up
+        if len(self._heap) > 2 * len(self.pending) + 64:
+            self._heap = [item for item in self._heap if not item[2].done]
+            heapq.heapify(self._heap)
+        if self._heap[0][2] is entry:
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            due = []
+            expired = []
+            calls = []
+            with self._cond:
+                while self._running and not due and not expired and not calls:
+                    now = time.monotonic()
+                    while self._heap:
+                        deadline, _, pending = self._heap[0]
+                        if pending.done or deadline != pending.deadline:
+                            heapq.heappop(self._heap)
+                            continue
+                        if deadline > now:
+                            break
+                        heapq.heappop(self._heap)
+                        if isinstance(pending, ScheduledCall):
+                            pending.done = True
+                            calls.append(pending)
+                            continue
+                        if self.pending.get(pending.key) is not pending:
+                            continue
+                        if not self._retry(pending, now):
+                            if self.on_expired is None:
+                                del self.pending[pending.key]
+                            expired.append(pending)
+                            continue
+                        heapq.heappush(self._heap, (pending.deadline, next(self._counter), pending))
+                        due.append(pending)
+                    if due or expired or calls:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if not self._running:
+                    return
+
+            for pending in expired:
+                if self.on_expired is not None:
+                    try:
+                        self.on_expired(pending)
+                    except Exception as e:
+                        print(f"Error in timer: {e}")
+                    with self._cond:
+                        if self.pending.get(pending.key) is not pending:
+                            continue                # on_expired cancelled it, or it was acknowledged after all
+                        del self.pending[pending.key]
+                pending._finish(False)
+            for pending in due:
+                self.retransmissions += 1
+                self.send(pending.datagram, pending.addr)
+            for call in calls:
+                try:
+                    call.callback()
+                except Exception as e:
+                    print(f"Error in timer: {e}")
+
+
+class AsyncRetransmitQueue(RetransmitQueue):
+    """
+    The same engine for the asyncio daemon. Every outstanding datagram gets a loop timer
+    (the event loop keeps those in its own heap), so there is no extra thread and no locking.
+    """
+    def __init__(self, send, loop, estimator=None):
+        super().__init__(send, estimator)
+        self.loop = loop
+
+    def start(self):
+        pass
+
+    def stop(self):
+        for key in list(self.pending):
+            self.cancel(key)
+
+    def submit(self, key, datagram, addr, estimator=None, max_retries=None):
+        pending = PendingSend(key, datagram, addr, estimator or self.estimator, max_retries)
+        previous = self._remove(key)
+        self.pending[key] = pending
+        pending.sent_at = self.loop.time()
+        pending.timer = self.loop.call_later(pending.timeout, self._on_timeout, pending)
+        if previous is not None:
+            previous._finish(False)
+        self.send(datagram, addr)
+        return pending
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def retransmit_now(self, key):
+        pending = self.pending.get(key)
+        if pending is None:
+            return None
+        pending.retries += 1
+        pending.timer.cancel()
+        pending.timer = self.loop.call_later(pending.timeout, self._on_timeout, pending)
+        self.retransmissions += 1
+        self.send(pending.datagram, pending.addr)
+        return pending
+
+    def _remove(self, key):
+        pending = self.pending.pop(key, None)
+        if pending is not None and pending.timer is not None:
+            pending.timer.cancel()
+        return pending
+
+    def _on_timeout(self, pending):
+        if self.pending.get(pending.key) is not pending:
+            return
+        if not self._retry(pending, self.loop.time()):
+            if self.on_expired is not None:
+                self.on_expired(pending)
+                if self.pending.get(pending.key) is not pending:
+                    return                          # on_expired cancelled it
+            del self.pending[pending.key]
+            pending._finish(False)
+            return
+        pending.timer = self.loop.call_later(pending.timeout, self._on_timeout, pending)
+        self.retransmissions += 1
+        self.send(pending.datagram, pending.addr)
@@ -0,0 +1,339 @@
+import sys
+from collections import OrderedDict, deque
+from simp_protocol import MAX_MESSAGE_SIZE, MAX_SESSION_ID
+from simp_retransmit import RTOEstimator
+from simp_window import ReceiveWindow, SendWindow
+
+SESSION_IDLE_TIMEOUT = 600.0    # Sessions without any traffic for 10 minutes are evicted
+MAX_SESSIONS = 10000            # Upper bound for the session table, further SYNs are answered with FIN
+REASSEMBLY_TIMEOUT = 30.0       # Partial messages that get no fragment for 30 seconds are dropped
+REASSEMBLY_LIMIT = 16 << 20     # Bytes of partial messages a daemon buffers at most
+
+# Session states
+CONNECTING = 0                  # SYN sent, waiting for SYN+ACK
+REQUESTED = 1                   # SYN received, waiting for the client to accept
+ESTABLISHED = 2
+CLOSING = 3                     # FIN sent, waiting for its ACK
+CLOSED = 4                      # Removed from the table
+
+
+class LocalClient:
+    """
+    A client connected to this daemon. A client takes part in at most one chat at a time, and in any
+    number of rooms.
+    """
+    __slots__ = ('username', 'addr', 'session', 'binary', 'batching', 'outbox', 'outbox_bytes', 'flush_timer',
+                 'rooms', 'credit', 'queue', 'queued_bytes', 'dropped')
+
+    def __init__(self, username, addr, binary=False, batching=False):
+        self.username = username
+        self.addr = addr
+        self.session = None
+        self.binary = binary                    # Client talks the binary format instead of JSON
+        self.batching = batching                # Client accepts several messages in one 'batch' datagram
+        self.outbox = []                        # Encoded messages waiting to be flushed as one batch
+        self.outbox_bytes = 0
+        self.flush_timer = None
+        self.rooms = {}                         # Room name -> Room the client is in (besides its chat)
+        self.credit = None                      # Chat messages it can still take, None without flow control
+        self.queue = deque()                    # Messages waiting for credit, see Daemon.deliver_to_client()
+        self.queued_bytes = 0
+        self.dropped = 0                        # Room messages dropped since it was last told
+
+
+class Session:
+    """
+    State of one chat between a local client and a user on another daemon.
+    """
+    __slots__ = ('peer_addr', 'peer_username', 'client', 'state', 'sequence_number',
+                 'last_received_seq', 'has_turn', 'last_activity', 'estimator', 'send_window',
+                 'receive_window', 'batching', 'flush_timer', 'fragments', 'next_message_id', 'stream_id',
+                 'stream_offset', 'datagrams_sent', 'datagrams_received', 'bytes_sent', 'bytes_received', 'log',
+                 'log_next', 'log_unacked', 'ticket', 'resumable', 'resuming', 'early_data', 'peer_credit',
+                 'credit_in_flight', 'advertised_credit', 'version', 'local_id', 'peer_id', 'compress')
+
+    def __init__(self, peer_addr, peer_username, client, state, has_turn, now):
+        self.peer_addr = peer_addr
+        self.peer_username = peer_username      # None until the peer's SYN+ACK tells us
+        self.client = client
+        self.state = state
+        self.sequence_number = 0
+        self.last_received_seq = 0              # Track last received sequence number, chat starts at 1
+        self.has_turn = has_turn
+        self.last_activity = now
+        self.estimator = RTOEstimator()         # RTT differs per peer, so every session has its own RTO
+        self.send_window = None                 # Both set only in the windowed mode, see use_window()
+        self.receive_window = None
+        self.batching = False                   # Both sides agreed on batch datagrams (windowed mode only)
+        self.flush_timer = None                 # Pending flush of the send queue, see Daemon.send_windowed()
+        self.fragments = deque()                # Fragment payloads waiting to be sent, they go before the queue
+        self.next_message_id = 0                # Ids of fragmented messages and streams
+        self.stream_id = None                   # Outgoing stream the client is sending chunks of
+        self.stream_offset = 0
+        self.datagrams_sent = 0                 # Chat, batch and fragment datagrams (without retransmissions)
+        self.datagrams_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.log = None                         # Store-and-forward session: the log it sends from or stores into
+        self.log_next = 0                       # Next record of the log to send
+        self.log_unacked = 0                    # Records sent but not acknowledged yet
+        self.ticket = None                      # Resume ticket of the chat, see simp_resume
+        self.resumable = False                  # The peer asked for a ticket
+        self.resuming = None                    # ResumeRecord sent in our SYN
+        self.early_data = None                  # First message of the client, sent with the handshake
+        self.peer_credit = None                 # Messages the peer's client can take, None if the peer doesn't say
+        self.credit_in_flight = 0               # Messages sent that the peer hasn't acknowledged yet
+        self.advertised_credit = 0              # Last credit we sent the peer
+        self.version = 1                        # Wire format both daemons agreed on in the handshake
+        self.local_id = None                    # Our id for the session, set by SessionTable.add()
+        self.peer_id = None                     # The peer's id for it (version 2), its datagrams get the compact header
+        self.compress = False                   # Payloads to the peer are compressed (version 2)
+
+    @property
+    def windowed(self):
+        return self.send_window is not None
+
+    def use_window(self, size, next_seq=1, expected=1):
+        """
+        Switches the session to the sliding window mode (size > 1) or back to turn-taking.
+        """
+        if size > 1:
+            self.send_window = SendWindow(size, next_seq)
+            self.receive_window = ReceiveWindow(size, expected)
+        else:
+            self.send_window = None
+            self.receive_window = None
+
+    def restore(self, window, batching, send_seq, receive_seq):
+        """
+        Continues a resumed chat: send_seq is the last sequence number we sent and receive_seq the
+        last one the peer sent, as the two daemons agreed on in the handshake.
+        """
+        self.use_window(window, send_seq + 1, receive_seq + 1)
+        self.batching = self.windowed and batching
+        if not self.windowed:
+            self.sequence_number = send_seq % 256
+            self.last_received_seq = receive_seq % 256
+
+    @property
+    def key(self):
+        return (self.peer_addr, self.peer_username)
+
+    def memory_usage(self):
+        """
+        Approximate number of bytes used by the session, with the fragments, windows and log it
+        buffers (the usernames are shared with the clients).
+        """
+        size = (sys.getsizeof(self) + sys.getsizeof(self.estimator) + sys.getsizeof(self.key)
+                + sys.getsizeof(self.fragments) + sum(sys.getsizeof(fragment) for fragment in self.fragments))
+        if self.windowed:
+            size += self.send_window.memory_usage() + self.receive_window.memory_usage()
+        if self.log is not None:
+            size += self.log.memory_usage()
+        return size
+
+
+class SessionTable:
+    """
+    All sessions of a daemon, keyed by (peer address, peer username) so an incoming datagram is
+    matched to its session with one dict lookup. The dict is kept in least-recently-active order,
+    so idle sessions are found at the front without scanning the whole table. Every session also
+    gets an id, which peers of the wire format version 2 send instead of the username.
+    """
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, max_sessions=MAX_SESSIONS):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = min(max_sessions, MAX_SESSION_ID)   # Every session needs an id of its own
+        self.sessions = OrderedDict()
+        self.ids = {}                           # Session id -> session
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    @property
+    def full(self):
+        return len(self.sessions) >= self.max_sessions
+
+    def get(self, peer_addr, peer_username):
+        return self.sessions.get((peer_addr, peer_username))
+
+    def get_handshake(self, peer_addr, peer_username):
+        """
+        Like get(), but also finds an outgoing handshake that doesn't know the peer's username yet.
+        """
+        session = self.sessions.get((peer_addr, peer_username))
+        if session is None:
+            session = self.sessions.get((peer_addr, None))
+        return session
+
+    def by_id(self, session_id):
+        return self.ids.get(session_id)
+
+    def find_peer_id(self, peer_addr, peer_id):
+        """
+        The session the peer at peer_addr knows by peer_id. Scans the table, it is only needed when
+        the peer ends a chat we sent a datagram of with an id it doesn't know.
+        """
+        for session in self.sessions.values():
+            if session.peer_id == peer_id and session.peer_addr == peer_addr:
+                return session
+        return None
+
+    def add(self, session):
+        """
+        Adds a session, which gets an id if it has none yet. Callers check full first, a table
+        without a free id raises ValueError.
+        """
+        if session.local_id is None:
+            session.local_id = self.next_id()
+            if session.local_id is None:
+                raise ValueError("No free session id")
+        self.sessions[session.key] = session
+        self.ids[session.local_id] = session
+
+    def next_id(self):
+        """
+        A free session id, counting up so a closed session's id isn't used again right away.
+        None if all of them are taken.
+        """
+        for _ in range(MAX_SESSION_ID):
+            self.last_id = self.last_id % MAX_SESSION_ID + 1
+            if self.last_id not in self.ids:
+                return self.last_id
+        return None
+
+    def remove(self, session):
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+            del self.ids[session.local_id]
+
+    def rename(self, session, peer_username):
+        """
+        Sets the peer's username of a session and re-keys it (its id stays).
+        """
+        self.remove(session)
+        session.peer_username = peer_username
+        self.add(session)
+
+    def touch(self, session, now):
+        session.last_activity = now
+        if self.sessions.get(session.key) is session:
+            self.sessions.move_to_end(session.key)
+
+    def evict_idle(self, now):
+        """
+        Removes and returns the sessions that have been idle for longer than idle_timeout.
+        """
+        evicted = []
+        while self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_activity < self.idle_timeout:
+                break
+            del self.sessions[session.key]
+            del self.ids[session.local_id]
+            evicted.append(session)
+        return evicted
+
+    def memory_usage(self):
+        """
+        Approximate number of bytes used by the table and its sessions.
+        """
+        return (sys.getsizeof(self.sessions) + sys.getsizeof(self.ids)
+                + sum(session.memory_usage() for session in self.sessions.values()))
+
+
+class PartialMessage:
+    """
+    The fragments of one message (or the current chunk of a stream) received so far.
+    """
+    __slots__ = ('data', 'offset', 'last_activity')
+
+    def __init__(self, now):
+        self.data = bytearray()
+        self.offset = 0                         # Offset in the message the next fragment must have
+        self.last_activity = now
+
+
+class ReassemblyBuffer:
+    """
+    Partial messages of all sessions, keyed by (session, message id). Fragments are passed in the
+    order they were sent (the window or the turn-taking already sorts them), so reassembling is just
+    appending. The buffer holds at most limit bytes, the least recently active messages are dropped
+    first, as are messages that get no fragment for timeout seconds.
+    """
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, limit=REASSEMBLY_LIMIT, max_message=MAX_MESSAGE_SIZE):
+        self.timeout = timeout
+        self.limit = limit
+        self.max_message = max_message
+        self.partials = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.partials)
+
+    def add(self, session, message_id, offset, data, now):
+        """
+        Appends a fragment to its message. Returns the PartialMessage, or None if the fragment
+        doesn't continue a message we have (the start was dropped) or the message got too big.
+        """
+        key = (session, message_id)
+        partial = self.partials.get(key)
+        if partial is None:
+            if offset != 0:
+                return None
+            partial = self.partials[key] = PartialMessage(now)
+        elif offset != partial.offset:
+            self.discard(session, message_id)
+            return None
+        if len(partial.data) + len(data) > self.max_message:
+            self.discard(session, message_id)
+            return None
+        partial.data += data
+        partial.offset = (partial.offset + len(data)) & 0xFFFFFFFF    # Same width as the offset field
+        partial.last_activity = now
+        self.partials.move_to_end(key)
+        self.size += len(data)
+        while self.size > self.limit:
+            (oldest_session, oldest_id), _ = next(iter(self.partials.items()))
+            self.discard(oldest_session, oldest_id)
+        return self.partials.get(key)
+
+    def take(self, session, message_id, last):
+        """
+        Returns the data received so far and clears it. The message is forgotten if last is set,
+        otherwise (streams) it keeps collecting the next chunk.
+        """
+        key = (session, message_id)
+        partial = self.partials[key]
+        data = bytes(partial.data)
+        self.size -= len(data)
+        if last:
+            del self.partials[key]
+        else:
+            partial.data.clear()
+        return data
+
+    def discard(self, session, message_id):
+        partial = self.partials.pop((session, message_id), None)
+        if partial is not None:
+            self.size -= len(partial.data)
+
+    def discard_session(self, session):
+        for key in [key for key in self.partials if key[0] is session]:
+            self.discard(*key)
+
+    def evict_idle(self, now):
+        """
+        Drops the messages that got no fragment for longer than timeout, returns how many.
+        """
+        evicted = 0
+        while self.partials:
+            (session, message_id), partial = next(iter(self.partials.items()))
+            if now - partial.last_activity < self.timeout:
+                break
+            self.discard(session, message_id)
+            evicted += 1
+        return evicted
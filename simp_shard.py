@@ -0,0 +1,289 @@
+"""
+Multi-process daemon: worker processes share the daemon port (SO_REUSEPORT) and every peer daemon
+is served by one of them, so one daemon can use several cores. A front end owns the client port and
+passes every client message to the worker that has the client's session.
+"""
+import multiprocessing
+import signal
+import socket
+import struct
+import sys
+import threading
+from simp_daemon import RECEIVE_BUFFER_SIZE, Daemon
+from simp_protocol import (CLIENT_EVENTS, decode_client_message, decode_json_message, encode_client_message,
+                           encode_json_message, is_json_message)
+from simp_session import CONNECTING
+from simp_transport import open_reuseport_group, open_udp_socket
+
+# Every datagram between the front end and a worker starts with: tag (1 byte), client IPv4 address,
+# client port. Then follows the client message as the client sent it (or as it is sent to the client).
+ENVELOPE = struct.Struct('!B4sH')
+# Front end -> worker
+DELIVER = 0x00
+QUIET = 0x01                            # Handle it but don't answer (a connect every worker has to know)
+# Worker -> front end
+SEND = 0x00                             # Pass on to the client
+BIND_OUTGOING = 0x01                    # The client started a chat on this worker
+BIND_INCOMING = 0x02                    # A peer asked the client for a chat on this worker
+RELEASE = 0x03                          # The client's chat on this worker is over
+
+
+def worker_for_port(port, workers):
+    """
+    The worker that serves the peer daemon on port, the same choice the kernel makes with the BPF
+    program of open_reuseport_group.
+    """
+    return port % workers
+
+
+class ShardWorker(Daemon):
+    """
+    One worker of a ShardedDaemon. It is a normal daemon for the peers it gets from the kernel, but
+    its clients are reached through the front end: client messages arrive from the front end with
+    the client's address in front, and everything for a client goes back the same way.
+    """
+    def __init__(self, daemon_socket, channel, front_addr, daemon_port, client_port, **options):
+        self.shared_daemon_socket = daemon_socket
+        self.channel = channel
+        super().__init__(daemon_port, client_port, **options)
+        self.front_addr = front_addr
+        self.quiet = False                  # Set while handling a QUIET message
+        self.addresses = {}                 # Packed client address -> (ip, port)
+
+    def open_sockets(self):
+        return self.shared_daemon_socket, self.channel
+
+    def send_client_bytes(self, data, addr):
+        if not self.quiet:
+            self.send_to_front_end(SEND, addr, data)
+
+    def send_to_front_end(self, tag, addr, data=b""):
+        self.channel.sendto(ENVELOPE.pack(tag, socket.inet_aton(addr[0]), addr[1]) + data, self.front_addr)
+
+    def client_bound(self, client):
+        self.send_to_front_end(BIND_OUTGOING if client.session.state == CONNECTING else BIND_INCOMING, client.addr)
+
+    def client_released(self, client):
+        self.send_to_front_end(RELEASE, client.addr)
+
+    def handle_client_messages(self):
+        """
+        Receives the client messages the front end passes on (in its own thread).
+        """
+        if self.profiler is not None:
+            self.profiler.add_thread('client')
+        buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        data = memoryview(buffer)
+        while True:
+            try:
+                size, _ = self.channel.recvfrom_into(buffer)
+                tag, ip, port = ENVELOPE.unpack_from(buffer)
+                addr = self.addresses.get((ip, port))
+                if addr is None:
+                    addr = self.addresses[(ip, port)] = (socket.inet_ntoa(ip), port)
+                with self.lock:
+                    self.quiet = tag == QUIET
+                    try:
+                        self.process_client_message(data[ENVELOPE.size:size], addr)
+                    finally:
+                        self.quiet = False
+            except Exception as e:
+                print(f"Error message from client: {e}")
+
+    def run(self):
+        self.retransmit.start()
+        self.start_metrics()
+        self.start_eviction()
+        threading.Thread(target=self.handle_daemon_messages, daemon=True).start()
+        self.handle_client_messages()
+
+
+def _run_worker(index, daemon_socket, channel, front_addr, daemon_port, client_port, ip, options):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl-C stops the front end, which stops the workers
+    if options.get('metrics_port') is not None:
+        options['metrics_port'] += index            # One endpoint per worker
+    worker = ShardWorker(daemon_socket, channel, front_addr, daemon_port, client_port, **options)
+    worker.ip = ip
+    worker.run()
+
+
+class ShardedDaemon:
+    """
+    A daemon that runs as workers worker processes plus a front end (this process). The kernel gives
+    the datagrams of the peer daemon on port p to worker p % workers, which keeps all sessions with
+    that peer. The front end receives the client messages: start_chat goes to the worker of the
+    target port, everything else to the worker that has the client's chat (the workers say when a
+    client gets and leaves a chat). Every worker knows every client, a connect goes to all of them.
+    options are passed to every worker's Daemon. UDP clients only, and without flow control: the
+    credit of a client would have to be split between the workers.
+    """
+    def __init__(self, daemon_port, client_port, workers, **options):
+        self.daemon_port = daemon_port
+        self.client_port = client_port
+        self.workers = workers
+        self.options = options
+        self.ip = "127.0.0.1"
+        self.processes = []
+        self.client_socket = None
+        self.channel = None                 # The front end's socket to the workers
+        self.worker_addrs = []
+        self.worker_index = {}              # Worker address -> worker number
+        self.bindings = {}                  # Client address -> worker that has the client's chat
+        self.binary = {}                    # Client address -> the client talks the binary format
+        self.client_addrs = {}              # Username -> client address
+        self.packed = {}                    # Client address -> packed for the envelope
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Binds the sockets and starts the workers.
+        """
+        daemon_sockets = open_reuseport_group(self.ip, self.daemon_port, self.workers)
+        self.client_socket = open_udp_socket(self.ip, self.client_port)
+        self.channel = open_udp_socket(self.ip, 0)
+        front_addr = self.channel.getsockname()
+        for index, daemon_socket in enumerate(daemon_sockets):
+            channel = open_udp_socket(self.ip, 0)
+            self.worker_addrs.append(channel.getsockname())
+            self.worker_index[channel.getsockname()] = index
+            process = multiprocessing.Process(target=_run_worker, daemon=True, args=(
+                index, daemon_socket, channel, front_addr, self.daemon_port, self.client_port, self.ip,
+                dict(self.options)))
+            process.start()
+            self.processes.append(process)
+            channel.close()                 # The worker has its own copy
+            daemon_socket.close()
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def envelope(self, tag, addr):
+        packed = self.packed.get(addr)
+        if packed is None:
+            packed = self.packed[addr] = socket.inet_aton(addr[0]), addr[1]
+        return ENVELOPE.pack(tag, *packed)
+
+    def forward(self, worker, tag, data, addr):
+        self.channel.sendto(self.envelope(tag, addr) + data, self.worker_addrs[worker])
+
+    def send_to_client(self, msg, addr):
+        data = encode_client_message(msg) if self.binary.get(addr) else encode_json_message(msg)
+        self.client_socket.sendto(data, addr)
+
+    def process_client_message(self, data, addr):
+        """
+        Passes one client message on to the worker it is for.
+        """
+        if is_json_message(data):
+            msg = decode_json_message(data)
+            msg_type = msg['type']
+        else:
+            msg = None                      # Only decoded if needed
+            msg_type = CLIENT_EVENTS[data[0]][0]
+
+        if msg_type == 'connect':
+            msg = msg or decode_client_message(data)
+            self.binary[addr] = not is_json_message(data)
+            if msg.pop('credit', None):
+                data = encode_client_message(msg) if self.binary[addr] else encode_json_message(msg)
+            old_addr = self.client_addrs.get(msg['username'])
+            if old_addr is not None and old_addr != addr and old_addr in self.bindings:
+                self.bindings[addr] = self.bindings.pop(old_addr)   # Same user again, its chat moves along
+            self.client_addrs[msg['username']] = addr
+            for worker in range(self.workers):
+                self.forward(worker, DELIVER if worker == 0 else QUIET, data, addr)   # Only one answers
+            return
+
+        if msg_type == 'credit':
+            return  # The workers don't know the credit (see above)
+
+        if msg_type == 'join_room':
+            # The kernel spreads the datagrams of the member daemons over all workers
+            self.send_to_client({
+                'type': 'error',
+                'message': 'Rooms need a daemon without --workers'
+            }, addr)
+            return
+
+        worker = self.bindings.get(addr)
+        if msg_type == 'start_chat':
+            if worker is not None:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': 'Already in a chat'
+                }, addr)
+                return
+            msg = msg or decode_client_message(data)
+            try:
+                worker = worker_for_port(int(msg['target_port']), self.workers)
+            except (KeyError, ValueError):
+                worker = 0                  # It answers with the error
+        self.forward(worker if worker is not None else 0, DELIVER, data, addr)
+
+    def process_worker_message(self, data, worker):
+        """
+        Handles one datagram from a worker: a message for a client, or a client getting or leaving
+        a chat on that worker.
+        """
+        tag, ip, port = ENVELOPE.unpack_from(data)
+        addr = (socket.inet_ntoa(ip), port)
+        bound = self.bindings.get(addr)
+        if tag == SEND:
+            if bound is None or bound == worker:    # Not a chat_request the client had no time for
+                self.client_socket.sendto(data[ENVELOPE.size:], addr)
+        elif tag == RELEASE:
+            if bound == worker:
+                del self.bindings[addr]
+        elif bound is None or bound == worker:
+            self.bindings[addr] = worker
+        else:
+            # The client got a chat on another worker meanwhile: give this one up like a declined request
+            self.forward(worker, DELIVER, encode_json_message({'type': 'quit'}), addr)
+            if tag == BIND_OUTGOING:
+                self.send_to_client({
+                    'type': 'error',
+                    'message': 'Already in a chat'
+                }, addr)
+
+    def handle_client_messages(self):
+        buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        data = memoryview(buffer)
+        while True:
+            try:
+                size, addr = self.client_socket.recvfrom_into(buffer)
+                with self.lock:
+                    self.process_client_message(data[:size], addr)
+            except Exception as e:
+                print(f"Error message from client: {e}")
+
+    def handle_worker_messages(self):
+        buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        data = memoryview(buffer)
+        while True:
+            try:
+                size, addr = self.channel.recvfrom_into(buffer)
+                worker = self.worker_index.get(addr)
+                if worker is not None:
+                    with self.lock:
+                        self.process_worker_message(data[:size], worker)
+            except Exception as e:
+                print(f"Error message from worker: {e}")
+
+    def run(self):
+        print(f"Daemon running on {self.ip} ({self.workers} workers)")
+        print(f"Listening to daemons on port {self.daemon_port}")
+        print(f"Listening to clients on port {self.client_port} (udp)")
+        self.start()
+        # SIGTERM ends the front end like Ctrl-C, so the workers are stopped too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            threading.Thread(target=self.handle_worker_messages, daemon=True).start()
+            self.handle_client_messages()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
@@ -0,0 +1,354 @@
+"""
+Store-and-forward: messages that can't be delivered yet are kept in append-only logs on disk, one
+log per peer and user, until they are delivered. A log is a directory of memory-mapped segment files.
+"""
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+from urllib.parse import quote, unquote
+
+SEGMENT_SIZE = 16 << 20         # Bytes per segment file, a longer record gets a segment of its own
+RECORD = struct.Struct('!BIQI') # Marker, payload length, record id, CRC-32 of the payload
+RECORD_MARKER = 0xA5            # Unwritten space is zeros, so a record never starts with 0
+CURSOR = struct.Struct('!Q')    # First record that isn't delivered yet
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"           # Offsets of the records of a full segment, written when it is sealed
+CURSOR_FILE = "cursor"
+SENDER = struct.Struct('!B')    # Records of incoming logs start with the length of the sender's name
+
+
+class Segment:
+    """
+    One segment file of a log, mapped into memory. offsets holds the position of every record in
+    it, record first_id + i starts at offsets[i].
+    """
+    __slots__ = ('path', 'first_id', 'file', 'map', 'offsets', 'position', 'dirty')
+
+    def __init__(self, path, first_id, size=None):
+        self.path = path
+        self.first_id = first_id
+        self.file = open(path, 'r+b' if size is None else 'w+b')
+        if size is not None:
+            self.file.truncate(size)            # Sparse, the unwritten rest reads as zeros
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.offsets = array('I')
+        self.position = 0
+        self.dirty = False
+
+    @property
+    def end_id(self):
+        return self.first_id + len(self.offsets)
+
+    def scan(self):
+        """
+        Finds the records by walking the headers. Stops at the first one that was never written
+        completely (zeros, or a CRC that doesn't match after a crash).
+        """
+        record_id, position, size = self.first_id, 0, len(self.map)
+        while position + RECORD.size <= size:
+            marker, length, stored_id, crc = RECORD.unpack_from(self.map, position)
+            end = position + RECORD.size + length
+            if (marker != RECORD_MARKER or stored_id != record_id or end > size
+                    or zlib.crc32(self.map[position + RECORD.size:end]) != crc):
+                break
+            self.offsets.append(position)
+            record_id += 1
+            position = end
+        self.position = position
+
+    def load_index(self):
+        """
+        Reads the offsets of a sealed segment from its index file. Returns False if there is none.
+        """
+        try:
+            with open(self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX, 'rb') as f:
+                self.offsets.frombytes(f.read())
+        except OSError:
+            return False
+        self.position = len(self.map)
+        return True
+
+    def seal(self):
+        """
+        Writes the index of a full segment, so it never has to be scanned again.
+        """
+        self.flush()
+        path = self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        with open(path + ".tmp", 'wb') as f:
+            self.offsets.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def fits(self, length):
+        return self.position + RECORD.size + length <= len(self.map)
+
+    def append(self, record_id, payload):
+        position = self.position
+        RECORD.pack_into(self.map, position, RECORD_MARKER, len(payload), record_id, zlib.crc32(payload))
+        self.map[position + RECORD.size:position + RECORD.size + len(payload)] = payload
+        self.offsets.append(position)
+        self.position = position + RECORD.size + len(payload)
+        self.dirty = True
+
+    def read(self, record_id):
+        position = self.offsets[record_id - self.first_id]
+        _, length, _, _ = RECORD.unpack_from(self.map, position)
+        return self.map[position + RECORD.size:position + RECORD.size + length]
+
+    def flush(self):
+        if self.dirty:
+            self.map.flush()
+            self.dirty = False
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SegmentedLog:
+    """
+    Append-only log of records (bytes), numbered from 0 on. New records go into the last segment,
+    a full one is sealed and a new segment is started. ack() moves the cursor past the delivered
+    records, and segments that only hold delivered records are deleted (a drained log keeps no
+    segment at all). Nothing is written to disk synchronously: sync() flushes what was appended
+    and the cursor, the daemon calls it on a timer so one fsync covers many messages.
+    """
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.name = os.path.basename(directory)
+        self.segment_size = segment_size
+        self.segments = []
+        self.first_ids = []                     # first_id of every segment, for bisect
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, CURSOR_FILE), 'rb') as f:
+                (self.cursor,) = CURSOR.unpack(f.read(CURSOR.size))
+        except (OSError, struct.error):
+            self.cursor = 0
+        self.synced_cursor = self.cursor
+        names = sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+        for index, name in enumerate(names):
+            path = os.path.join(directory, name)
+            if not os.path.getsize(path):
+                os.remove(path)                 # Created, but the process ended before it was sized
+                continue
+            segment = Segment(path, int(name[:-len(SEGMENT_SUFFIX)]))
+            last = index == len(names) - 1
+            if last or not segment.load_index():    # Only the last segment can be incomplete
+                segment.scan()
+            if segment.end_id <= self.cursor and not last:
+                segment.remove()                # Delivered, the process ended before it was deleted
+                continue
+            self.segments.append(segment)
+            self.first_ids.append(segment.first_id)
+        if self.segments and self.cursor < self.first_ids[0]:
+            self.cursor = self.first_ids[0]     # The records before the first segment were delivered and deleted
+        self.next_id = self.segments[-1].end_id if self.segments else self.cursor
+        self.cursor = min(self.cursor, self.next_id)
+        self.compact()
+
+    def __len__(self):
+        """
+        Number of records that aren't delivered yet.
+        """
+        return self.next_id - self.cursor
+
+    def append(self, payload):
+        """
+        Adds a record and returns its id.
+        """
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or not segment.fits(len(payload)):
+            if segment is not None:
+                segment.seal()
+            size = max(self.segment_size, RECORD.size + len(payload))
+            segment = Segment(os.path.join(self.directory, f"{self.next_id:020d}{SEGMENT_SUFFIX}"), self.next_id,
+                              size)
+            self.segments.append(segment)
+            self.first_ids.append(self.next_id)
+        segment.append(self.next_id, payload)
+        self.next_id += 1
+        return self.next_id - 1
+
+    def read(self, record_id):
+        """
+        Returns the payload of a record.
+        """
+        return self.segments[bisect_right(self.first_ids, record_id) - 1].read(record_id)
+
+    def pending(self, start=None, limit=None):
+        """
+        Yields (id, payload) of the records that aren't delivered yet, from start (default: the
+        cursor) on, at most limit of them.
+        """
+        record_id = self.cursor if start is None else max(start, self.cursor)
+        end = self.next_id if limit is None else min(self.next_id, record_id + limit)
+        index = bisect_right(self.first_ids, record_id) - 1
+        while record_id < end:
+            segment = self.segments[index]
+            while record_id < end and record_id < segment.end_id:
+                yield record_id, segment.read(record_id)
+                record_id += 1
+            index += 1
+
+    def ack(self, record_id):
+        """
+        Marks all records up to record_id as delivered.
+        """
+        if record_id >= self.cursor:
+            self.cursor = min(record_id + 1, self.next_id)
+            self.compact()
+
+    def compact(self):
+        """
+        Deletes the segments whose records are all delivered. The cursor is on disk before, so a
+        crash never leaves a cursor that points into deleted segments.
+        """
+        drop = 0
+        while drop < len(self.segments) and self.segments[drop].end_id <= self.cursor:
+            if drop == len(self.segments) - 1 and self.cursor < self.next_id:
+                break
+            drop += 1
+        if drop and self.cursor != self.synced_cursor:
+            self.write_cursor(durable=True)
+        for segment in self.segments[:drop]:
+            segment.remove()
+        del self.segments[:drop]
+        del self.first_ids[:drop]
+
+    def memory_usage(self):
+        """
+        Approximate number of bytes the log keeps in memory (the mapped segments are left out, they
+        are paged in and out by the kernel).
+        """
+        return (sys.getsizeof(self) + sys.getsizeof(self.segments) + sys.getsizeof(self.first_ids)
+                + sum(sys.getsizeof(segment) + sys.getsizeof(segment.offsets) for segment in self.segments))
+
+    def sync(self):
+        """
+        Flushes the appended records and the cursor to disk.
+        """
+        for segment in reversed(self.segments):
+            if not segment.dirty:
+                break                           # Only the newest segments can have unwritten records
+            segment.flush()
+        if self.cursor != self.synced_cursor:
+            self.write_cursor()
+
+    def write_cursor(self, durable=False):
+        """
+        Replaces the cursor file in one step. durable also waits until the file and the rename are
+        on disk.
+        """
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(CURSOR.pack(self.cursor))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        if durable:
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        self.synced_cursor = self.cursor
+
+    def close(self):
+        self.sync()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        self.first_ids = []
+
+
+def outgoing_log_name(peer_addr, peer_username, username):
+    """
+    Name of the log of the messages from the local user username to peer_username at peer_addr.
+    """
+    return ",".join(quote(str(part), safe="") for part in ("out", peer_addr[0], peer_addr[1], peer_username, username))
+
+
+def incoming_log_name(username):
+    """
+    Name of the log of the messages for the local user username.
+    """
+    return ",".join(quote(part, safe="") for part in ("in", username))
+
+
+def parse_log_name(name):
+    """
+    Returns ('out', peer_addr, peer_username, username) or ('in', username).
+    """
+    parts = [unquote(part) for part in name.split(",")]
+    if parts[0] == "out":
+        return "out", (parts[1], int(parts[2])), parts[3], parts[4]
+    return "in", parts[1]
+
+
+def encode_stored_message(sender, message):
+    """
+    Record of an incoming log: the sender's username and the message.
+    """
+    name = sender.encode('utf-8')
+    return SENDER.pack(len(name)) + name + message
+
+
+def decode_stored_message(record):
+    (length,) = SENDER.unpack_from(record)
+    return str(record[SENDER.size:SENDER.size + length], 'utf-8'), record[SENDER.size + length:]
+
+
+class MessageStore:
+    """
+    The logs of a daemon, one directory each under directory. The logs that are there when the
+    daemon starts are opened right away, so their messages can be forwarded.
+    """
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.logs = {}                          # Log name -> SegmentedLog
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if os.path.isdir(os.path.join(directory, name)):
+                self.log(name)
+
+    def log(self, name):
+        """
+        Returns the log with the given name, created if there is none.
+        """
+        log = self.logs.get(name)
+        if log is None:
+            log = self.logs[name] = SegmentedLog(os.path.join(self.directory, name), self.segment_size)
+        return log
+
+    def pending_logs(self, kind):
+        """
+        Yields (name, log) of the logs of one kind ('out' or 'in') with undelivered records.
+        """
+        for name, log in list(self.logs.items()):
+            if len(log) and name.startswith(kind + ","):
+                yield name, log
+
+    def sync(self):
+        for log in self.logs.values():
+            log.sync()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+        self.logs = {}
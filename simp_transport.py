@@ -0,0 +1,612 @@
+import ctypes
+import errno
+import os
+import secrets
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+
+TRANSPORTS = ("udp", "unix", "shm")     # How a client talks to its daemon, udp is the default
+RING_SIZE = 1 << 20                     # Bytes of messages one ring holds, a full ring blocks like a full socket queue
+RING_PREFIX = "simp-ring-"              # Name of every ring a client creates, the daemon attaches nothing else
+RING_POLL_INTERVAL = 0.01               # A sleeping reader also looks at its rings this often, in case a wakeup was missed
+RING_DATA = 64                          # The ring header takes the first cache line, messages follow
+UNIX_BACKLOG = 4096                     # Messages kept for an AF_UNIX client whose queue is full, more are dropped
+UNIX_RETRY = 0.001                      # How soon sending to a full AF_UNIX client (or ring) is tried again
+SOCKET_BUFFER_SIZE = 4 << 20            # Receive buffer asked for on UDP sockets of the daemon (capped by rmem_max)
+MULTICAST_TTL = 1                       # Multicast datagrams of the daemons stay on the LAN
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, 'SO_ATTACH_REUSEPORT_CBPF', 51)     # Linux
+SKF_NET_OFF = -0x100000                 # Classic BPF loads relative to the IP header start here
+UDP_SOURCE_PORT = 20                    # Offset of the UDP source port behind an IPv4 header without options
+# Classic BPF opcodes (linux/filter.h)
+BPF_LD_H_ABS = 0x28
+BPF_ALU_MOD_K = 0x94
+BPF_RET_A = 0x16
+BPF_INSTRUCTION = struct.Struct('HBBI')   # code, jump if true, jump if false, k (native byte order)
+
+# Ring header: read position, write position (both count bytes without wrapping), reader-is-sleeping flag.
+# Native format on purpose: the positions are aligned 8-byte fields that struct reads and writes in one
+# go, so the other process never sees half of an update ('=' formats go byte by byte)
+RING_HEADER = struct.Struct('QQB')
+RING_POSITION = struct.Struct('Q')
+RING_RECORD = struct.Struct('I')        # Length in front of every message in a ring
+
+# Datagrams starting with a null byte are for the transport itself, never for the daemon
+# (client messages start with '{' or an event code >= 1)
+DOORBELL = b"\0"                        # "There is something in your ring"
+ATTACH = b"\0A"                         # Followed by the names of the client's two rings
+DETACH = b"\0D"
+
+
+def unix_path(port):
+    """
+    Path of the AF_UNIX socket of the daemon whose client port is port, so clients still find their
+    daemon by the same number.
+    """
+    return os.path.join(tempfile.gettempdir(), f"simp-{port}.sock")
+
+
+def open_udp_socket(ip, port):
+    """
+    Creates a bound UDP socket with a big receive buffer: the default one overflows when many
+    clients (or daemons) send at the same moment, and a dropped datagram from a client is lost.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.bind((ip, port))
+    return sock
+
+
+def open_reuseport_group(ip, port, count):
+    """
+    Creates count UDP sockets bound to the same port (SO_REUSEPORT) and makes the kernel give every
+    datagram to socket number (source port % count), with a classic BPF program. So all datagrams of
+    one peer go to the same socket, and which one is known in advance. Linux only (IPv4).
+    """
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.bind((ip, port))           # The index in the group is the order of binding
+        sockets.append(sock)
+    instructions = [
+        BPF_INSTRUCTION.pack(BPF_LD_H_ABS, 0, 0, (SKF_NET_OFF + UDP_SOURCE_PORT) & 0xFFFFFFFF),   # A = source port
+        BPF_INSTRUCTION.pack(BPF_ALU_MOD_K, 0, 0, count),                                       # A %= count
+        BPF_INSTRUCTION.pack(BPF_RET_A, 0, 0, 0),                                               # socket number A
+    ]
+    program = ctypes.create_string_buffer(b"".join(instructions))
+    # struct sock_fprog: number of instructions, pointer to them (the kernel copies the program)
+    fprog = struct.pack('HL', len(instructions), ctypes.addressof(program))
+    sockets[0].setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    return sockets
+
+
+def open_multicast_socket(ip, group, port):
+    """
+    Creates a UDP socket that receives what is sent to an IPv4 multicast group and port, joined on
+    the interface of ip. Several daemons on one host can listen to the same group, each gets a copy.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.bind((group, port))            # Not the wildcard, so unicast datagrams to the port don't end up here
+    membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(ip))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return sock
+
+
+def enable_multicast(sock, ip):
+    """
+    Lets a socket send to multicast groups, out of the interface of ip and to the listeners on this
+    host as well.
+    """
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(ip))
+
+
+def open_daemon_socket(transport, ip, port):
+    """
+    Creates the socket a daemon receives client messages on.
+    """
+    if transport == "udp":
+        return open_udp_socket(ip, port)
+    path = unix_path(port)
+    if os.path.exists(path):        # Left over from a daemon that didn't shut down cleanly
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    return sock
+
+
+def open_client_socket(transport, ip, port):
+    """
+    Creates what a client talks to its daemon through and returns it with the daemon's address.
+    For shm that is a SharedMemoryClient, which has the socket methods the clients use.
+    """
+    if transport == "udp":
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (ip, port)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind("")                   # Linux picks an unused abstract address, so the daemon can answer
+    if transport == "shm":
+        return SharedMemoryClient(sock, unix_path(port)), unix_path(port)
+    return sock, unix_path(port)
+
+
+def _set_timeout(sock, timeout):
+    # settimeout() is a syscall, skip it when nothing changes
+    if sock.gettimeout() != timeout:
+        sock.settimeout(timeout)
+
+
+def _attach_shared_memory(name):
+    """
+    Opens a ring created by the other process. Only the creator unlinks it, so it is taken away
+    from this process's resource tracker (which would unlink it at exit otherwise).
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)     # Python 3.13+
+    except TypeError:
+        pass
+    memory = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(memory._name, "shared_memory")
+    return memory
+
+
+class Ring:
+    """
+    Single-producer single-consumer queue of messages in shared memory. The producer only moves the
+    write position and the consumer only the read position, so there is no locking. Wakeups work
+    like an eventfd: the consumer sets the sleeping flag before it blocks, and only then does the
+    producer send a doorbell, so a busy consumer gets no syscalls at all.
+    """
+    def __init__(self, memory):
+        self.memory = memory
+        self.buf = memory.buf
+        self.capacity = len(self.buf) - RING_DATA
+
+    @classmethod
+    def create(cls, size=RING_SIZE):
+        memory = shared_memory.SharedMemory(RING_PREFIX + secrets.token_hex(8), create=True, size=size + RING_DATA)
+        ring = cls(memory)
+        RING_HEADER.pack_into(ring.buf, 0, 0, 0, 1)     # A new reader counts as sleeping
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """
+        Opens a ring a client created. Raises ValueError for names a client's ring can't have, so a
+        client can't make the daemon map any other shared memory.
+        """
+        suffix = name[len(RING_PREFIX):]
+        if not name.startswith(RING_PREFIX) or not (suffix.isascii() and suffix.isalnum()):
+            raise ValueError(f"Not a ring: {name!r}")
+        ring = cls(_attach_shared_memory(name))
+        if ring.capacity <= RING_RECORD.size:
+            ring.close()
+            raise ValueError(f"Ring too small: {name!r}")
+        return ring
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+    def _copy_in(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.buf[RING_DATA + offset:RING_DATA + offset + first] = data[:first]
+        if first < len(data):
+            self.buf[RING_DATA:RING_DATA + len(data) - first] = data[first:]
+
+    def _copy_out(self, position, buffer, size):
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        buffer[:first] = self.buf[RING_DATA + offset:RING_DATA + offset + first]
+        if first < size:
+            buffer[first:size] = self.buf[RING_DATA:RING_DATA + size - first]
+
+    def put(self, data):
+        """
+        Appends one message. Returns False if the ring is full (nothing is written).
+        """
+        read, write, _ = RING_HEADER.unpack_from(self.buf)
+        needed = RING_RECORD.size + len(data)
+        if needed > self.capacity - (write - read):
+            return False
+        self._copy_in(write, RING_RECORD.pack(len(data)))
+        self._copy_in(write + RING_RECORD.size, data)
+        RING_POSITION.pack_into(self.buf, 8, write + needed)    # Publish only after the message is written
+        return True
+
+    def get_into(self, buffer):
+        """
+        Copies the oldest message into buffer (cut off if it doesn't fit, like recvfrom_into) and
+        returns its size, or None if the ring is empty. The other process can write anything into
+        the shared memory, so positions and lengths that don't add up raise ValueError.
+        """
+        read, write, _ = RING_HEADER.unpack_from(self.buf)
+        if read == write:
+            return None
+        if not RING_RECORD.size <= write - read <= self.capacity:
+            raise ValueError(f"Corrupt ring {self.name!r}: read {read}, write {write}")
+        length = bytearray(RING_RECORD.size)
+        self._copy_out(read, length, RING_RECORD.size)
+        (size,) = RING_RECORD.unpack(length)
+        if RING_RECORD.size + size > write - read:
+            raise ValueError(f"Corrupt ring {self.name!r}: message of {size} bytes")
+        copied = min(size, len(buffer))
+        self._copy_out(read + RING_RECORD.size, memoryview(buffer), copied)
+        RING_POSITION.pack_into(self.buf, 0, read + RING_RECORD.size + size)
+        return copied
+
+    def empty(self):
+        read, write, _ = RING_HEADER.unpack_from(self.buf)
+        return read == write
+
+    def sleep(self):
+        self.buf[16] = 1
+
+    def wake(self):
+        self.buf[16] = 0
+
+    def wakeup_needed(self):
+        """
+        Called by the producer after put(): True if the consumer sleeps and needs a doorbell.
+        """
+        if self.buf[16]:
+            self.buf[16] = 0
+            return True
+        return False
+
+
+class SharedMemoryClient:
+    """
+    Client end of the shared memory transport. Messages go through two rings (one per direction)
+    the client creates and announces to the daemon with ATTACH over the AF_UNIX socket, which then
+    only carries doorbells. It has the socket methods the clients use, so it replaces the socket.
+    """
+    def __init__(self, sock, daemon_addr, ring_size=RING_SIZE):
+        self.sock = sock
+        self.daemon_addr = daemon_addr
+        self.outbound = Ring.create(ring_size)
+        self.inbound = Ring.create(ring_size)
+        self.timeout = None
+        self.lock = threading.Lock()    # Several threads of a client may send
+        self.attached = False
+        try:
+            self.attach()
+        except OSError:                 # The daemon isn't there yet, sendto() tries again
+            pass
+
+    def attach(self):
+        _set_timeout(self.sock, None)       # This one must arrive, wait if the daemon's queue is full
+        self.sock.sendto(ATTACH + f"{self.outbound.name}\0{self.inbound.name}".encode(), self.daemon_addr)
+        self.attached = True
+
+    def sendto(self, data, addr=None):
+        """
+        Puts a message into the outbound ring. Like a blocking socket it waits while the ring is
+        full, at most the timeout (without one, BlockingIOError is raised right away).
+        """
+        if RING_RECORD.size + len(data) > self.outbound.capacity:
+            raise OSError(errno.EMSGSIZE, "Message too long")
+        with self.lock:
+            if not self.attached:
+                self.attach()
+            deadline = None if not self.timeout else time.monotonic() + self.timeout
+            while not self.outbound.put(data):
+                if self.timeout == 0.0:
+                    raise BlockingIOError("ring full")
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise socket.timeout("timed out")
+                time.sleep(UNIX_RETRY)          # The daemon is reading, the ring has room again soon
+            if self.outbound.wakeup_needed():
+                try:
+                    self.sock.sendto(DOORBELL, self.daemon_addr)
+                except BlockingIOError:     # A full queue already wakes the daemon
+                    pass
+        return len(data)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def setblocking(self, flag):
+        self.timeout = None if flag else 0.0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def sleep(self):
+        """
+        For waiting on fileno() with a selector: asks the daemon to ring the doorbell for new
+        messages. Returns False (without sleeping) if a message is already waiting. Call wake()
+        when the wait is over.
+        """
+        self.inbound.sleep()
+        if not self.inbound.empty():
+            self.inbound.wake()
+            return False
+        return True
+
+    def wake(self):
+        self.inbound.wake()
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        if self.timeout == 0.0 or flags & socket.MSG_DONTWAIT:
+            return self._recvfrom_nowait(buffer)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            size = self._get_into(buffer)
+            if size is not None:
+                return size, self.daemon_addr
+            self.inbound.sleep()
+            if not self.inbound.empty():       # Something came in before the flag was seen
+                self.inbound.wake()
+                continue
+            wait = RING_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    self.inbound.wake()
+                    raise socket.timeout("timed out")
+            _set_timeout(self.sock, wait)
+            try:
+                size, addr = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            finally:
+                self.inbound.wake()
+            if size != len(DOORBELL) or buffer[0] != 0:
+                return size, addr               # Not through the ring, e.g. sent before the daemon attached it
+
+    def _get_into(self, buffer):
+        try:
+            return self.inbound.get_into(buffer)
+        except ValueError as e:
+            raise OSError(errno.EIO, str(e)) from None
+
+    def _recvfrom_nowait(self, buffer):
+        """
+        Non-blocking receive. Doorbells waiting in the socket are read as well, otherwise a
+        selector would keep seeing it readable.
+        """
+        while True:
+            size = self._get_into(buffer)
+            if size is not None:
+                return size, self.daemon_addr
+            _set_timeout(self.sock, 0.0)    # Not MSG_DONTWAIT: with a timeout set, Python waits before reading
+            try:
+                size, addr = self.sock.recvfrom_into(buffer)
+            except BlockingIOError:
+                raise BlockingIOError("no message") from None
+            if size != len(DOORBELL) or buffer[0] != 0:
+                return size, addr
+
+    def close(self):
+        try:
+            self.sock.sendto(DETACH, self.daemon_addr)
+        except OSError:
+            pass
+        self.sock.close()
+        self.outbound.close(unlink=True)
+        self.inbound.close(unlink=True)
+
+
+class UnixServer:
+    """
+    Daemon end of the AF_UNIX transport. Plain AF_UNIX clients just send datagrams; clients that
+    attached rings (SharedMemoryClient) are read from and written to through their rings.
+    recvfrom_into() serves the threaded daemon, datagram_received() the asyncio one.
+    """
+    def __init__(self, sock, call_later=None, buffer_size=65536):
+        self.sock = sock
+        self.send = self.send_nowait    # How datagrams go out, the asyncio daemon uses its transport
+        self.call_later = call_later    # call_later(delay, callback), for retrying full clients
+        self.rings = {}                 # client address -> (inbound ring, outbound ring)
+        self.backlog = {}               # client address -> messages waiting for room in its queue
+        self.retry = None
+        self.lock = threading.Lock()    # Sending threads vs. attaching and detaching
+        self.sleeping = False
+        self.buffer = bytearray(buffer_size)
+
+    def sendto(self, data, addr):
+        with self.lock:
+            rings = self.rings.get(addr)
+            if rings is not None:
+                if addr in self.backlog or not rings[1].put(data):
+                    return self._defer(data, addr)     # Full, it waits in order like for a full AF_UNIX queue
+                if not rings[1].wakeup_needed():
+                    return len(data)
+                data = DOORBELL
+            try:
+                return self.send(data, addr)
+            except OSError:
+                if data is DOORBELL:    # The client is gone, or its doorbells are already queued
+                    return 0
+                raise
+
+    def send_nowait(self, data, addr):
+        """
+        AF_UNIX datagram queues are short (net.unix.max_dgram_qlen, 10 by default) and a full one
+        blocks the sender. Instead of stalling the daemon, messages for a full client wait in a
+        backlog (in order) that is retried from a timer.
+        """
+        if data is DOORBELL or addr not in self.backlog:   # A ring client's backlog is for its ring
+            try:
+                return self.sock.sendto(data, socket.MSG_DONTWAIT, addr)
+            except BlockingIOError:
+                if data is DOORBELL:
+                    return 0            # A full queue already wakes the client
+        return self._defer(data, addr)
+
+    def _defer(self, data, addr):
+        """
+        Adds a message for a client whose queue or ring is full to its backlog.
+        """
+        queue = self.backlog.get(addr)
+        if queue is None:
+            queue = self.backlog[addr] = deque()
+        if len(queue) < UNIX_BACKLOG:
+            queue.append(bytes(data))
+        self._schedule_retry()
+        return len(data)
+
+    def _schedule_retry(self):
+        if self.retry is None and self.call_later is not None:
+            self.retry = self.call_later(UNIX_RETRY, self._retry_backlog)
+
+    def _retry_backlog(self):
+        with self.lock:
+            self.retry = None
+            for addr, queue in list(self.backlog.items()):
+                rings = self.rings.get(addr)
+                if rings is not None:
+                    while queue and rings[1].put(queue[0]):
+                        queue.popleft()
+                    if rings[1].wakeup_needed():
+                        self._ring_doorbell(addr)
+                    if queue:
+                        continue
+                try:
+                    while queue:
+                        self.sock.sendto(queue[0], socket.MSG_DONTWAIT, addr)
+                        queue.popleft()
+                except BlockingIOError:
+                    continue
+                except OSError:         # The client is gone
+                    queue.clear()
+                del self.backlog[addr]
+            if self.backlog:
+                self._schedule_retry()
+
+    def _ring_doorbell(self, addr):
+        try:
+            self.send(DOORBELL, addr)
+        except OSError:                 # The client is gone, or its doorbells are already queued
+            pass
+
+    def control(self, data, addr):
+        """
+        Handles a transport datagram (ATTACH, DETACH or a doorbell) from a client.
+        """
+        data = bytes(data)
+        if data.startswith(ATTACH):
+            self.detach(addr)
+            try:
+                inbound_name, outbound_name = data[len(ATTACH):].decode().split("\0")
+                inbound = Ring.attach(inbound_name)
+            except (OSError, ValueError) as e:
+                print(f"Refused rings of client {addr}: {e}")
+                return
+            try:
+                outbound = Ring.attach(outbound_name)
+            except (OSError, ValueError) as e:
+                inbound.close()
+                print(f"Refused rings of client {addr}: {e}")
+                return
+            rings = (inbound, outbound)
+            with self.lock:
+                self.rings[addr] = rings
+        elif data.startswith(DETACH):
+            self.detach(addr)
+
+    def detach(self, addr):
+        with self.lock:
+            rings = self.rings.pop(addr, None)
+            self.backlog.pop(addr, None)
+        if rings is not None:
+            for ring in rings:
+                ring.close()
+
+    def _poll(self, buffer):
+        for addr, (inbound, _) in list(self.rings.items()):
+            try:
+                size = inbound.get_into(buffer)
+            except ValueError as e:     # The client wrote garbage, stop trusting its rings
+                print(f"Detached rings of client {addr}: {e}")
+                self.detach(addr)
+                continue
+            if size is not None:
+                self._rotate(addr)
+                return size, addr
+        return None
+
+    def _rotate(self, addr):
+        # Move a client that was just served to the end, so one busy client can't starve the others
+        with self.lock:
+            rings = self.rings.pop(addr, None)
+            if rings is not None:
+                self.rings[addr] = rings
+
+    def _sleep(self):
+        self.sleeping = True
+        for inbound, _ in self.rings.values():
+            inbound.sleep()
+
+    def _wake(self):
+        if self.sleeping:
+            self.sleeping = False
+            for inbound, _ in self.rings.values():
+                inbound.wake()
+
+    def recvfrom_into(self, buffer):
+        while True:
+            message = self._poll(buffer)
+            if message is not None:
+                self._wake()
+                return message
+            if not self.sleeping:
+                self._sleep()
+                continue            # Look again, a client may have written before seeing the flags
+            _set_timeout(self.sock, RING_POLL_INTERVAL if self.rings else None)
+            try:
+                size, addr = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            self._wake()
+            if size and buffer[0] == 0:
+                self.control(memoryview(buffer)[:size], addr)
+                continue
+            return size, addr
+
+    def datagram_received(self, data, addr, handler):
+        """
+        For the asyncio daemon: handles one datagram from the socket, then everything in the rings.
+        """
+        self._wake()
+        if data and data[0] == 0:
+            self.control(data, addr)
+        else:
+            handler(data, addr)
+        self.drain(handler)
+
+    def drain(self, handler):
+        """
+        Passes every message waiting in the rings to handler(data, addr).
+        """
+        view = memoryview(self.buffer)
+        while True:
+            message = self._poll(self.buffer)
+            if message is None:
+                self._sleep()
+                message = self._poll(self.buffer)
+                if message is None:
+                    return          # Sleeping: the next message comes with a doorbell
+                self._wake()
+            size, addr = message
+            handler(view[:size], addr)
+
+    def close(self):
+        for addr in list(self.rings):
+            self.detach(addr)
@@ -0,0 +1,159 @@
+import sys
+from collections import deque
+
+MAX_WINDOW = 127        # Half of the 1-byte sequence space, so a wrapped sequence number is never ambiguous
+SEQ_SPACE = 256         # The seq_num field is 1 byte
+DUPLICATE_THRESHOLD = 3 # A gap with 3 later datagrams acknowledged counts as lost (fast retransmit)
+
+
+def unwrap(wire_seq, reference):
+    """
+    Turns a 1-byte sequence number from the wire back into the full sequence number closest to
+    reference (serial number arithmetic). Works as long as both sides stay within half the space.
+    """
+    diff = (wire_seq - reference) % SEQ_SPACE
+    if diff < SEQ_SPACE // 2:
+        return reference + diff
+    return reference - (SEQ_SPACE - diff)
+
+
+class SendWindow:
+    """
+    Sender side of the Selective Repeat mode. Sequence numbers are counted without limit here and
+    only their low byte is sent. Every outstanding datagram has its own retransmission timer (in
+    the retransmit queue), so only the lost ones are sent again.
+    """
+    __slots__ = ('size', 'base', 'next_seq', 'acked', 'highest_acked', 'fast_retransmitted', 'queue',
+                 'queued_bytes')
+
+    def __init__(self, size, start=1):
+        self.size = size
+        self.base = start               # Oldest sequence number that isn't acknowledged
+        self.next_seq = start           # 1, or where a resumed chat left off
+        self.acked = set()              # Selectively acknowledged numbers above base
+        self.highest_acked = start - 1
+        self.fast_retransmitted = set()
+        self.queue = deque()            # Messages waiting for room in the window (or to be batched)
+        self.queued_bytes = 0
+
+    @property
+    def in_flight(self):
+        return self.next_seq - self.base
+
+    def can_send(self):
+        return self.next_seq - self.base < self.size
+
+    def take_seq(self):
+        seq = self.next_seq
+        self.next_seq += 1
+        return seq
+
+    def on_ack(self, wire_cumulative, sack):
+        """
+        Processes an ACK: everything up to the cumulative number is received, and bit i of the
+        SACK bitmap says that cumulative + 2 + i is received as well.
+        Returns the full sequence numbers that are newly acknowledged.
+        """
+        cumulative = unwrap(wire_cumulative, self.base - 1)
+        if cumulative < self.base - 1 or cumulative >= self.next_seq:
+            return []                   # Old or bogus ACK
+        newly_acked = [seq for seq in range(self.base, cumulative + 1) if seq not in self.acked]
+        for index, byte in enumerate(sack):
+            while byte:
+                bit = (byte & -byte).bit_length() - 1
+                byte &= byte - 1
+                seq = cumulative + 2 + index * 8 + bit
+                if seq < self.next_seq and seq not in self.acked:
+                    self.acked.add(seq)
+                    newly_acked.append(seq)
+                    self.highest_acked = max(self.highest_acked, seq)
+        self.highest_acked = max(self.highest_acked, cumulative)
+
+        if cumulative >= self.base:
+            self.base = cumulative + 1
+            while self.base in self.acked:
+                self.acked.discard(self.base)
+                self.base += 1
+            self.acked = {seq for seq in self.acked if seq >= self.base}
+            self.fast_retransmitted = {seq for seq in self.fast_retransmitted if seq >= self.base}
+        return newly_acked
+
+    def memory_usage(self):
+        """
+        Approximate number of bytes used by the window and the messages queued in it.
+        """
+        return (sys.getsizeof(self) + sys.getsizeof(self.acked) + sys.getsizeof(self.fast_retransmitted)
+                + sys.getsizeof(self.queue) + sum(sys.getsizeof(message) for message in self.queue))
+
+    def lost(self):
+        """
+        Returns the sequence numbers that are still missing although DUPLICATE_THRESHOLD later ones
+        were acknowledged. Each is returned only once, after that its retransmission timer takes over.
+        """
+        lost = [seq for seq in range(self.base, self.highest_acked - DUPLICATE_THRESHOLD + 1)
+                if seq not in self.acked and seq not in self.fast_retransmitted]
+        self.fast_retransmitted.update(lost)
+        return lost
+
+
+class ReceiveWindow:
+    """
+    Receiver side of the Selective Repeat mode: out-of-order datagrams inside the window are
+    buffered and handed out in order.
+    """
+    __slots__ = ('size', 'expected', 'buffered')
+
+    def __init__(self, size, start=1):
+        self.size = size
+        self.expected = start
+        self.buffered = {}
+
+    def is_duplicate(self, wire_seq):
+        """
+        Tells if a datagram was already received (delivered or buffered).
+        """
+        seq = unwrap(wire_seq, self.expected)
+        return seq < self.expected or seq in self.buffered
+
+    def receive(self, wire_seq, item):
+        """
+        Takes one received datagram (item is whatever should be delivered) and returns the list of
+        items that can be delivered now, in order. Duplicates give an empty list.
+        """
+        seq = unwrap(wire_seq, self.expected)
+        if seq < self.expected or seq >= self.expected + self.size:
+            return []
+        if seq != self.expected:
+            self.buffered.setdefault(seq, item)
+            return []
+        delivered = [item]
+        self.expected += 1
+        while self.expected in self.buffered:
+            delivered.append(self.buffered.pop(self.expected))
+            self.expected += 1
+        return delivered
+
+    def memory_usage(self):
+        """
+        Approximate number of bytes used by the window and the datagrams it buffers (items that are
+        tuples are counted with what they hold).
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.buffered)
+        for item in self.buffered.values():
+            size += sys.getsizeof(item)
+            if isinstance(item, tuple):
+                size += sum(sys.getsizeof(part) for part in item)
+        return size
+
+    def ack(self):
+        """
+        Returns the cumulative ACK as 1-byte sequence number and the SACK bitmap of buffered datagrams.
+        """
+        cumulative = self.expected - 1
+        if not self.buffered:
+            return cumulative % SEQ_SPACE, b""
+        sack = bytearray((max(self.buffered) - cumulative - 2) // 8 + 1)
+        for seq in self.buffered:
+            index = seq - cumulative - 2
+            sack[index // 8] |= 1 << (index % 8)
+        return cumulative % SEQ_SPACE, bytes(sack)